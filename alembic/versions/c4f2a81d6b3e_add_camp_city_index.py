@@ -0,0 +1,26 @@
+"""add an index on camp (city, id) for paging through the camps of a city
+
+Revision ID: c4f2a81d6b3e
+Revises: 211dc3349d49
+Create Date: 2026-10-17 10:12:31.402175
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4f2a81d6b3e'
+down_revision: Union[str, None] = '211dc3349d49'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('idx_camp_city_id', 'camp', ['city', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('idx_camp_city_id', table_name='camp')
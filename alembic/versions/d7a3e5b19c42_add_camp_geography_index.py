@@ -0,0 +1,27 @@
+"""add a GiST index on geography(camp.geo_location) for nearest camps in metres
+
+Revision ID: d7a3e5b19c42
+Revises: c4f2a81d6b3e
+Create Date: 2026-10-17 15:40:12.518306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7a3e5b19c42'
+down_revision: Union[str, None] = 'c4f2a81d6b3e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('idx_camp_geography', 'camp', [sa.text('geography(geo_location)')], unique=False,
+                    postgresql_using='gist')
+
+
+def downgrade() -> None:
+    op.drop_index('idx_camp_geography', table_name='camp', postgresql_using='gist')
@@ -0,0 +1,78 @@
+"""Time of a full cryptographic audit of a stored chain, in one process and across every core.
+
+Writes a synthetic but valid chain once (real hashes and merkle roots, with a target every hash meets), then
+audits it with 1 worker and with all of them.
+Run from the repository root:  python -m benchmarks.bench_audit [blocks] [directory]
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from blockchain.Blockchain import Blockchain
+from blockchain.audit import audit_chain
+from blockchain.block import Block, BlockHeader, Transaction, encode_header, now_timestamp, state_root
+from blockchain.difficulty import MAX_TARGET
+from blockchain.merkle import merkle_root
+from blockchain.storage import ChainStore
+
+CHECKPOINT_INTERVAL = 100
+BLOCK_INTERVAL = 60
+
+
+def write_chain(directory, blocks):
+    store = ChainStore(directory, sync_every=10_000, sync_interval=60)
+    previous_hash = bytes(32)
+    balances = {}
+    # the last block is mined now, a block from the future would not pass the audit
+    started = now_timestamp() - blocks * BLOCK_INTERVAL * 1_000_000
+    for index in range(1, blocks + 1):
+        receiver = f'user{index % 1000}@forest.io'
+        if index == 1:
+            transactions, deltas = [], {'camp': 10 * blocks}
+        else:
+            transactions, deltas = [Transaction(str(index), 'camp', receiver, 10)], {'camp': -10, receiver: 10}
+        for address, delta in deltas.items():
+            balances[address] = balances.get(address, 0) + delta
+        checkpoint = dict(balances) if index == 1 or index % CHECKPOINT_INTERVAL == 0 else None
+        # blocks exactly BLOCK_INTERVAL apart keep the target where it is
+        header = BlockHeader(index, started + index * BLOCK_INTERVAL * 1_000_000, previous_hash,
+                             merkle_root(transactions), state_root(deltas, checkpoint), MAX_TARGET)
+        block = Block(header, transactions, nonce=0, deltas=deltas, balances=checkpoint,
+                      hash=hashlib.sha256(encode_header(header) + b'0').digest())
+        store.append(block)
+        previous_hash = block.hash
+    store.close()
+
+
+def measure(blockchain, workers):
+    for report in audit_chain(blockchain, workers=workers):
+        pass
+    assert report['valid'], report
+    return report['elapsed']
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    directory = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp(prefix='chain-audit-')
+    try:
+        started = time.perf_counter()
+        write_chain(directory, blocks)
+        print(f'wrote {blocks:,} blocks in {time.perf_counter() - started:.1f} s')
+
+        blockchain = Blockchain(mining_workers=1, checkpoint_interval=CHECKPOINT_INTERVAL, store=ChainStore(directory),
+                                initial_target=MAX_TARGET, block_interval=BLOCK_INTERVAL)
+        single = measure(blockchain, 1)
+        print(f'audit, 1 worker:   {single:6.2f} s  ({blocks / single:10,.0f} blocks/s)')
+        parallel = measure(blockchain, os.cpu_count())
+        print(f'audit, {os.cpu_count()} workers: {parallel:6.2f} s  ({blocks / parallel:10,.0f} blocks/s)')
+        blockchain.chain.close()
+    finally:
+        if len(sys.argv) <= 2:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
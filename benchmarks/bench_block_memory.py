@@ -0,0 +1,76 @@
+"""Memory of the chain with dict blocks (before) vs slotted Block/BlockHeader/Transaction objects (after).
+
+Every layout runs in its own interpreter and reports the RSS growth for the whole chain.
+Run from the repository root:  python -m benchmarks.bench_block_memory [blocks] [transactions per block]
+"""
+import datetime
+import hashlib
+import os
+import subprocess
+import sys
+import uuid
+
+from blockchain.block import Block, BlockHeader, Transaction
+from blockchain.difficulty import DEFAULT_TARGET
+
+# addresses are shared between blocks in both layouts, like a real chain with returning users
+ADDRESSES = [f'user{number}@forest.io' for number in range(10_000)]
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def dict_block(index, per_block):
+    transactions = [{'id': uuid.uuid4().hex, 'sender': 'camp', 'receiver': ADDRESSES[(index + i) % len(ADDRESSES)],
+                     'amount': 10.0} for i in range(per_block)]
+    return {
+        'index': index,
+        'timestamp': str(datetime.datetime.now()),
+        'previous_hash': hashlib.sha256(str(index - 1).encode()).hexdigest(),
+        'merkle_root': hashlib.sha256(str(index).encode() + b'merkle').hexdigest(),
+        'transactions': transactions,
+        'nonce': index * 7,
+        'deltas': {transaction['receiver']: 10.0 for transaction in transactions},
+        'hash': hashlib.sha256(str(index).encode()).hexdigest(),
+    }
+
+
+def slotted_block(index, per_block):
+    transactions = [Transaction(uuid.uuid4().hex, 'camp', ADDRESSES[(index + i) % len(ADDRESSES)], 10.0)
+                    for i in range(per_block)]
+    return Block(
+        header=BlockHeader(index, 1733924256549201 + index, hashlib.sha256(str(index - 1).encode()).digest(),
+                           hashlib.sha256(str(index).encode() + b'merkle').digest(),
+                           hashlib.sha256(str(index).encode() + b'state').digest(), DEFAULT_TARGET),
+        transactions=transactions,
+        nonce=index * 7,
+        hash=hashlib.sha256(str(index).encode()).digest(),
+        deltas={transaction.receiver: 10.0 for transaction in transactions},
+    )
+
+
+def run(layout, blocks, per_block):
+    make = dict_block if layout == 'dict' else slotted_block
+    baseline = rss_kb()
+    chain = [make(index, per_block) for index in range(1, blocks + 1)]
+    growth = (rss_kb() - baseline) * 1024
+    print(f'{layout:8} {len(chain):,} blocks, {blocks * per_block:,} transactions: '
+          f'{growth / 2 ** 20:8.1f} MiB  ({growth / blocks:,.0f} bytes per block)')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('dict', 'slotted'):
+        run(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+        return
+
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    per_block = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for layout in ('dict', 'slotted'):
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_block_memory', layout, str(blocks), str(per_block)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
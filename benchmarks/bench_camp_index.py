@@ -0,0 +1,96 @@
+"""p50/p99 latency of radius and nearest-camp queries: the in-memory camp index against PostGIS.
+
+The index is filled with the ~30k places of us_cities.csv. The PostGIS side runs the same queries against the camp
+table of the configured database (import us_cities.csv into it first); it is skipped when the database or its
+drivers are not available.
+Run from the repository root:  python -m benchmarks.bench_camp_index [queries]
+"""
+import asyncio
+import csv
+import random
+import statistics
+import sys
+import time
+
+from service.camp_index import CampEntry, CampIndex
+
+RADIUS = 10_000
+
+
+def read_camps(path='us_cities.csv'):
+    with open(path, newline='') as file:
+        return [CampEntry(int(row['ID']), f"{row['CITY']}, {row['STATE_CODE']}", row['CITY'], float(row['LATITUDE']),
+                          float(row['LONGITUDE'])) for row in csv.DictReader(file)]
+
+
+# query points a few km around random places
+def query_points(camps, count):
+    random.seed(0)
+    return [(camp.latitude + random.uniform(-0.05, 0.05), camp.longitude + random.uniform(-0.05, 0.05))
+            for camp in random.choices(camps, k=count)]
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p50 = statistics.median(timings) * 1e6
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1e6
+    print(f'{name:32} p50 {p50:10.1f} us   p99 {p99:10.1f} us')
+
+
+def bench_index(camps, points):
+    index = CampIndex()
+    started = time.perf_counter()
+    index.load(camps)
+    print(f'index of {len(index):,} camps built in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+    for name, query in (('index: within 10 km', lambda point: index.within(*point, RADIUS)),
+                        ('index: nearest camp', lambda point: index.nearest(*point)),
+                        ('index: nearest within 10 m', lambda point: index.nearest(*point, max_distance=10))):
+        timings = []
+        for point in points:
+            started = time.perf_counter()
+            query(point)
+            timings.append(time.perf_counter() - started)
+        report(name, timings)
+
+
+async def bench_postgis(points):
+    from sqlalchemy import func, select
+
+    from database.geodb import async_session_maker, engine
+    from model.Camp import Camp
+    from service import service
+
+    def around(latitude, longitude):
+        return func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326)
+
+    queries = (
+        ('postgis: within 10 km', lambda point: select(Camp.id, Camp.camp_name).where(
+            func.ST_DWithin(service.geography(Camp.geo_location), service.geography(around(*point)), RADIUS))),
+        ('postgis: nearest camp', lambda point: select(Camp.id, Camp.camp_name).order_by(
+            service.geography(Camp.geo_location).distance_centroid(service.geography(around(*point)))).limit(1)),
+    )
+    async with async_session_maker() as session:
+        for name, query in queries:
+            timings = []
+            for point in points:
+                started = time.perf_counter()
+                (await session.execute(query(point))).all()
+                timings.append(time.perf_counter() - started)
+            report(name, timings)
+    await engine.dispose()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    camps = read_camps()
+    points = query_points(camps, count)
+    bench_index(camps, points)
+    try:
+        asyncio.run(bench_postgis(points[:1000]))
+    except Exception as e:
+        print(f'postgis: skipped ({type(e).__name__}: {e})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Restart time of a Blockchain backed by the on-disk ChainStore.
+
+Writes a synthetic chain (no proof-of-work) once, then measures how long it takes to reopen it.
+Run from the repository root:  python -m benchmarks.bench_chain_store [blocks] [directory]
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from blockchain.Blockchain import Blockchain
+from blockchain.block import Block, BlockHeader, Transaction
+from blockchain.difficulty import DEFAULT_TARGET
+from blockchain.storage import ChainStore
+
+CHECKPOINT_INTERVAL = 100
+
+
+def write_chain(directory, blocks):
+    store = ChainStore(directory, sync_every=10_000, sync_interval=60)
+    previous_hash = bytes(32)
+    balances = {}
+    for index in range(1, blocks + 1):
+        receiver = f'user{index % 1000}@forest.io'
+        deltas = {'camp': -10, receiver: 10} if index > 1 else {}
+        for address, delta in deltas.items():
+            balances[address] = balances.get(address, 0) + delta
+        block = Block(
+            header=BlockHeader(index, 1733924256549201 + index, previous_hash,
+                               hashlib.sha256(str(index).encode()).digest(),
+                               hashlib.sha256(str(index).encode() + b'state').digest(), DEFAULT_TARGET),
+            transactions=[Transaction(str(index), 'camp', receiver, 10)] if index > 1 else [],
+            nonce=index,
+            hash=hashlib.sha256(str(index).encode() + b'block').digest(),
+            deltas=deltas,
+        )
+        if index == 1 or index % CHECKPOINT_INTERVAL == 0:
+            block.balances = dict(balances)
+        store.append(block)
+        previous_hash = block.hash
+    store.close()
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    directory = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp(prefix='chain-store-')
+    try:
+        started = time.perf_counter()
+        write_chain(directory, blocks)
+        size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+        print(f'wrote {blocks:,} blocks ({size / 2 ** 20:.0f} MiB) in {time.perf_counter() - started:.1f} s')
+
+        started = time.perf_counter()
+        blockchain = Blockchain(mining_workers=1, checkpoint_interval=CHECKPOINT_INTERVAL, store=ChainStore(directory))
+        print(f'restart: {time.perf_counter() - started:.2f} s  '
+              f'(height {len(blockchain.chain):,}, {len(blockchain.state.balances):,} accounts)')
+        blockchain.chain.close()
+    finally:
+        if len(sys.argv) <= 2:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Hashes per second of the proof-of-work inner loop, before and after midstate reuse.
+
+Run from the repository root:  python -m benchmarks.bench_hashing [nonces]
+"""
+import datetime
+import hashlib
+import json
+import sys
+import time
+
+from blockchain.difficulty import target_for_zero_bits
+from blockchain.mining import search_range
+
+# an impossible difficulty so both loops walk the full range
+DIFFICULTY = '0' * 64
+TARGET = bytes(32)
+
+
+# the original Blockchain.hash loop: rebuild the whole buffer and the hex digest on every try
+def legacy_search_range(encoded_block, difficulty, start, stop):
+    for nonce in range(start, stop):
+        hash_operation = hashlib.sha256(encoded_block + str(nonce).encode()).hexdigest()
+        if hash_operation[:len(difficulty)] == difficulty:
+            return nonce, hash_operation
+    return None
+
+
+def measure(search, encoded_block, difficulty, nonces):
+    started = time.perf_counter()
+    search(encoded_block, difficulty, 0, nonces)
+    return nonces / (time.perf_counter() - started)
+
+
+def main():
+    nonces = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    block = {'index': 1, 'timestamp': str(datetime.datetime(2024, 12, 11, 14, 37, 36))}
+    encoded_block = json.dumps(block, sort_keys=True).encode()
+
+    # both loops must agree on which nonce wins (four hex zeros are a 16 zero bit target)
+    target = target_for_zero_bits(16).to_bytes(32, 'big')
+    assert legacy_search_range(encoded_block, '0000', 0, 200_000) == search_range(encoded_block, target, 0, 200_000)
+
+    before = measure(legacy_search_range, encoded_block, DIFFICULTY, nonces)
+    after = measure(search_range, encoded_block, TARGET, nonces)
+    print(f"block: {encoded_block.decode()}  nonces: {nonces}")
+    print(f"before (full rehash + hexdigest): {before:12,.0f} H/s")
+    print(f"after  (midstate + raw digest):   {after:12,.0f} H/s  ({after / before:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
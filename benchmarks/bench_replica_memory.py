@@ -0,0 +1,67 @@
+"""RSS growth of the peer replica per 10k blocks: deep copy of the chain (before) vs append-only hashes (after).
+
+Every variant runs in its own interpreter so the numbers do not bleed into each other.
+Run from the repository root:  python -m benchmarks.bench_replica_memory [blocks] [users]
+"""
+import copy
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+from blockchain.replica import PeerReplica
+
+STEP = 10_000
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def make_block(index, users):
+    return {
+        'index': index,
+        'timestamp': '2024-12-11 14:37:36.549201',
+        'nonce': index * 7,
+        'balances': {f'user{u}@forest.io': 10.0 * u for u in range(users)},
+        'transactions': [{'sender': 'camp', 'receiver': f'user{index % users}@forest.io', 'amount': 10}],
+        'previous_hash': hashlib.sha256(str(index - 1).encode()).hexdigest(),
+        'hash': hashlib.sha256(str(index).encode()).hexdigest(),
+    }
+
+
+def run(variant, blocks, users):
+    chain = []
+    peer_b = [] if variant == 'deepcopy' else PeerReplica()
+    baseline = rss_kb()
+    for index in range(1, blocks + 1):
+        block = make_block(index, users)
+        chain.append(block)
+        if variant == 'replica':
+            peer_b.append(bytes.fromhex(block['hash']))
+        elif index % STEP == 0:
+            # the old code deep-copies after every block; copying at each report point holds the same memory
+            started = time.perf_counter()
+            peer_b = copy.deepcopy(chain)
+            print(f'  deepcopy at height {index}: {(time.perf_counter() - started) * 1000:.0f} ms per block')
+        if index % STEP == 0:
+            print(f'  {variant:8} {index:>8} blocks: +{(rss_kb() - baseline) / 1024:8.1f} MiB')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('deepcopy', 'replica'):
+        run(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
+        return
+
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    for variant in ('deepcopy', 'replica'):
+        print(f'{variant} (the chain itself is included in both):')
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_replica_memory', variant, str(blocks), str(users)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Cost of encoding a /get_chain page: json.dumps of every block dict against the bytes cached at sealing time.
+
+Run from the repository root:  python -m benchmarks.bench_serialization [blocks per page] [rounds]
+"""
+import json
+import sys
+import time
+
+from benchmarks.bench_block_memory import slotted_block
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    chain = [slotted_block(index, 20) for index in range(1, blocks + 1)]
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        json.dumps({'chain': [block.to_dict() for block in chain], 'length': blocks, 'next_cursor': None})
+    before = (time.perf_counter() - started) / rounds
+
+    for block in chain:
+        block.encode()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        b'{"chain":[' + b','.join(block.encode() for block in chain) + b'],"length":0,"next_cursor":null}'
+    after = (time.perf_counter() - started) / rounds
+
+    print(f"page of {blocks} blocks with 20 transactions each")
+    print(f"before (to_dict + json.dumps): {before * 1000:8.2f} ms")
+    print(f"after  (cached canonical bytes): {after * 1000:6.2f} ms  ({before / after:.0f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Size and restore time of a binary snapshot, compared with replaying the same chain from JSON blocks.
+
+Reuses the synthetic chain of bench_audit. The JSON side is what a node gets from /get_chain: one JSON document
+per block that has to be parsed back into a Block and checked before it can be adopted, with the same checks
+(audit_blocks) the snapshot restore runs. The trusted restore only verifies the checksum, the links and the
+balances; it is compared with parsing the JSON blocks without any check.
+Run from the repository root:  python -m benchmarks.bench_snapshot [blocks]
+"""
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_audit import BLOCK_INTERVAL, CHECKPOINT_INTERVAL, write_chain
+from blockchain.Blockchain import Blockchain
+from blockchain.audit import audit_blocks
+from blockchain.block import Block
+from blockchain.difficulty import MAX_TARGET
+from blockchain.snapshot import export_snapshot, restore_snapshot
+from blockchain.storage import ChainStore
+
+
+def measure(label, restore):
+    gc.collect()
+    started = time.perf_counter()
+    restore()
+    elapsed = time.perf_counter() - started
+    print(f'{label + ":":32}{elapsed:6.2f} s')
+    return elapsed
+
+
+# what a node does with JSON blocks from a peer before it adopts them: parse every block, then check it
+def replay_json(lines, rules):
+    chain = [Block.from_dict(json.loads(line)) for line in lines]
+    _, problems = audit_blocks(((block.hash, block) for block in chain), 1, len(chain), rules)
+    assert not problems, problems[0]
+    return chain
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    directory = tempfile.mkdtemp(prefix='chain-snapshot-')
+    try:
+        write_chain(os.path.join(directory, 'source'), blocks)
+        blockchain = Blockchain(mining_workers=1, checkpoint_interval=CHECKPOINT_INTERVAL, initial_target=MAX_TARGET,
+                                block_interval=BLOCK_INTERVAL, store=ChainStore(os.path.join(directory, 'source')))
+
+        path = os.path.join(directory, 'chain.snapshot')
+        started = time.perf_counter()
+        export_snapshot(blockchain, path)
+        print(f'export: {time.perf_counter() - started:6.2f} s  ({os.path.getsize(path) / 2 ** 20:.1f} MiB)')
+
+        lines = [json.dumps(block.to_dict()) for block in blockchain.chain]
+        print(f'json:              ({sum(len(line) + 1 for line in lines) / 2 ** 20:.1f} MiB)')
+
+        rules = blockchain.rules()
+        checked = measure('restore snapshot into memory', lambda: restore_snapshot(path, []))
+        replayed = measure('replay json blocks into memory', lambda: replay_json(lines, rules))
+        print(f'  snapshot is {replayed / checked:.1f}x faster')
+
+        trusted = measure('trusted restore into memory', lambda: restore_snapshot(path, [], trusted=True))
+        parsed = measure('parse json blocks, no checks', lambda: [Block.from_dict(json.loads(line)) for line in lines])
+        print(f'  snapshot is {parsed / trusted:.1f}x faster')
+
+        started = time.perf_counter()
+        store = ChainStore(os.path.join(directory, 'restored'), sync_every=10_000, sync_interval=60)
+        restore_snapshot(path, store)
+        store.close()
+        print(f'{"restore snapshot into a store:":32}{time.perf_counter() - started:6.2f} s')
+        blockchain.chain.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,125 +1,475 @@
-import datetime
 import hashlib
-import json
-import copy
+import logging
+import math
+import uuid
+from typing import NamedTuple
+
+from blockchain.block import Block, BlockHeader, encode_header, now_timestamp, state_root
+from blockchain.difficulty import DEFAULT_TARGET, block_work, meets_target, target_at
+from blockchain.mempool import Mempool
+from blockchain.merkle import merkle_root
+from blockchain.mining import Miner
+from blockchain.replica import PeerReplica
+from blockchain.state import AccountState
+
+
+logger = logging.getLogger(__name__)
+
+# previous hash of the genesis block
+GENESIS_PREVIOUS_HASH = bytes(32)
+
+
+# the parameters every block of a chain is checked against (a snapshot carries them, the audit workers get them)
+class ChainRules(NamedTuple):
+    initial_target: int
+    retarget_interval: int
+    block_interval: float
+    checkpoint_interval: int
 
 
 # Define the Blockchain class
 class Blockchain:
-    def __init__(self):
+    def __init__(self, mining_workers=None, checkpoint_interval=100, store=None, mempool=None,
+                 initial_target=DEFAULT_TARGET, retarget_interval=10, block_interval=60):
         # Initialize the blockchain with an empty chain, difficulty, transactions, balances, and a copy of the chain
         # for peer comparison
 
-        # stores the chain of blocks
-        self.chain = []
+        # stores the chain of Block objects (in memory, or in a ChainStore on disk that survives restarts)
+        self.chain = store if store is not None else []
+
+        # a block hash, read as a 256-bit number, must not exceed the target of its height; the chain starts at
+        # `initial_target` and every `retarget_interval` blocks the target is adjusted so that a block takes about
+        # `block_interval` seconds to mine
+        if retarget_interval < 2:
+            raise ValueError("retarget_interval must be at least 2 blocks")
+        self.initial_target = initial_target
+        self.retarget_interval = retarget_interval
+        self.block_interval = block_interval
+
+        # proof-of-work engine, spreads the nonce search over `mining_workers` processes (1 = single process)
+        self.miner = Miner(workers=mining_workers)
 
-        # the condition specifies that the block's hash must start with '00000'
-        self.difficulty = '00000'
+        # every block carries only its balance changes, every `checkpoint_interval`-th block also the full state
+        self.checkpoint_interval = checkpoint_interval
 
-        # will contain the pending transactions awaiting mining confirmation
-        self.transactions = []
+        # will contain the pending transactions awaiting mining confirmation (indexed by id, bounded in size)
+        self.mempool = mempool if mempool is not None else Mempool()
 
         # dictionary(Map) that tracks users balances within the blockchain
         # Each key-value pair represents a user’s public key and their corresponding balance
         self.balances = dict()
 
-        # the very first block and it's hardcoded because there are no previous blocks
-        self.genesis_block()
+        # balance of every address at the tip (and at older heights), kept up to date as blocks are appended
+        self.state = AccountState()
 
-        # This is an order to make a copy of a chain
-        # ************A deep copy means that all elements of self.chain are duplicated,
-        # including nested objects.
-        # This ensures that the copied object (self.peer_b) is completely independent of the original (self.chain),
-        # so changes to self.chain won’t affect self.peer_b and vice versa.
-        # *************A shallow copy, on the other hand, would only copy the references to objects,
-        # meaning changes in nested objects could still affect the copy.
-        self.peer_b = copy.deepcopy(self.chain)
+        # pending balances of the block that is being mined (None when no block is being mined)
+        self.in_flight_balances = None
+
+        # number of blocks at the start of the chain that is_chain_valid already checked
+        self.verified_height = 0
+
+        # summed work of the blocks of the chain, computed on first use (see work)
+        self._work = None
+
+        # Append-only replica of the chain used for peer comparison: only the hash of every block, one entry
+        # appended per block (instead of a deep copy of the whole chain after every block)
+        self.peer_b = PeerReplica()
+
+        # a stored chain can only be reopened with the rules its blocks were built with
+        if hasattr(self.chain, 'bind_rules'):
+            self.chain.bind_rules(self.rules()._asdict())
+
+        if self.chain:
+            # a stored chain: every block in it was validated before it was written
+            if hasattr(self.chain, 'raw_hashes'):
+                self.peer_b = PeerReplica.from_bytes(self.chain.raw_hashes())
+            else:
+                self.peer_b = PeerReplica(block.hash for block in self.chain)
+            self.state.restore(len(self.chain), self.balances_at(len(self.chain)))
+            self.verified_height = len(self.chain)
+        else:
+            # the very first block and it's hardcoded because there are no previous blocks
+            self.genesis_block()
 
     # ---------------------------------------------------------------------------------------------------------------
 
     # CREATE THE FIRST BLOCK
     def genesis_block(self):
-        block = self.create_block(balances=dict(), previous_hash='0' * 64)
-        self.chain.append(block)
+        self.mine_block()
 
-    # CREATE BLOCK METHOD
-    def create_block(self, balances, previous_hash):
-        # increment the block index and add the creation date
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': str(datetime.datetime.now()),
-        }
+    # CREATE BLOCK METHOD: take the pending transactions, find the proof-of-work and append the block
+    def mine_block(self):
+        block = self.prepare_block()
 
         # nonce is the number of miners compute to meet the difficulty condition
-        nonce, hash = self.hash(block)
-        block['nonce'] = nonce
+        nonce, hash = self.hash(block.header)
+        return self.append_mined_block(block, nonce, hash)
 
-        # Copying the balances and pending transactions
-        block['balances'] = copy.deepcopy(balances)
-        block['transactions'] = self.transactions
+    # START A BLOCK ON TOP OF THE CHAIN WITH THE PENDING TRANSACTIONS
+    # The transactions and pending balances move into the block; until the block is appended (or aborted) they
+    # still count towards the pending state, and new submissions go to the next block. A transaction its sender
+    # can no longer cover is left out and dropped, so it cannot make the block fail after its proof-of-work.
+    def prepare_block(self):
+        batch = self.mempool.drain()
+        self._drop_unfunded(batch)
+        transactions = list(batch.transactions.values())
+        index = len(self.chain) + 1
 
-        # Setting the previous hash and the generated hash
-        block['previous_hash'] = previous_hash
-        block['hash'] = hash
+        # The block only carries what changes: the pending balances plus what every address received minus what
+        # it sent (the mempool summed both as the transactions arrived). The genesis block and every
+        # checkpoint_interval-th block also carry the full state, so any height can be rebuilt from the nearest
+        # checkpoint. The header commits to both, so they are fixed before the proof-of-work.
+        deltas = dict(self.balances)
+        for sender, amount in batch.sent.items():
+            deltas[sender] = deltas.get(sender, 0) - amount
+        for receiver, amount in batch.received.items():
+            deltas[receiver] = deltas.get(receiver, 0) + amount
+        balances = None
+        if index == 1 or index % self.checkpoint_interval == 0:
+            balances = {**self.state.balances, **self._changes(deltas)}
 
-        # Clearing the lists for transactions and balances
-        self.transactions = []
+        header = BlockHeader(
+            index=index,
+            # a block must be younger than its parent, even when the clock was set back
+            timestamp=max(now_timestamp(), self.chain[-1].header.timestamp + 1 if self.chain else 0),
+            previous_hash=self.tip_hash(),
+            merkle_root=merkle_root(transactions),
+            state_root=state_root(deltas, balances),
+            target=self.target_at(index),
+        )
+        block = Block(header, transactions, deltas=deltas, balances=balances)
+        self.in_flight_balances = self.balances
         self.balances = dict()
         return block
 
-    # hashing method
-    def hash(self, block):
-        encoded_block = json.dumps(block, sort_keys=True).encode()
-        nonce = 0
+    # take out of `batch` the transactions a sender can no longer cover, keeping its earliest ones that fit
+    def _drop_unfunded(self, batch):
+        funds = {sender: self.balances.get(sender, 0) + self.state.balance(sender) for sender in batch.sent}
+        overdrawn = {sender for sender, sent in batch.sent.items() if sent > funds[sender]}
+        if not overdrawn:
+            return
+        spent = {}
+        for transaction in list(batch.transactions.values()):
+            if transaction.sender not in overdrawn:
+                continue
+            total = spent.get(transaction.sender, 0) + transaction.amount
+            if total > funds[transaction.sender]:
+                self._drop(batch.remove(transaction.id), f"{transaction.sender} cannot cover it")
+            else:
+                spent[transaction.sender] = total
 
-        while True:
-            hash_operation = hashlib.sha256(encoded_block + str(nonce).encode()).hexdigest()
+    # the balance every address in `deltas` ends up with at the tip
+    def _changes(self, deltas):
+        return {address: self.state.balance(address) + delta for address, delta in deltas.items()}
 
-            if hash_operation[:5] == self.difficulty:
-                break
-            else:
-                nonce += 1
+    # HASH OF THE LAST BLOCK (what the next block points to)
+    def tip_hash(self):
+        return self.chain[-1].hash if self.chain else GENESIS_PREVIOUS_HASH
+
+    # hash of the block at `height` (1-based, 0 is the genesis previous hash), None when the chain is not that long
+    def hash_at(self, height):
+        if height > len(self.peer_b):
+            return None
+        return self.peer_b[height - 1] if height else GENESIS_PREVIOUS_HASH
+
+    # GIVE THE TRANSACTIONS AND PENDING BALANCES OF A BLOCK THAT WILL NOT BE APPENDED BACK TO THE PENDING POOL
+    def abort_block(self, block):
+        if self.in_flight_balances is None:
+            return
+        self.mempool.restore()
+        # a pending balance set while the block was mined was added on top of the one the block carried (see
+        # pending_funds), and transactions may already spend both
+        for receiver, amount in self.in_flight_balances.items():
+            self.balances[receiver] = self.balances.get(receiver, 0) + amount
+        self.in_flight_balances = None
+
+    # SEAL A PREPARED BLOCK WITH ITS PROOF-OF-WORK, APPLY ITS BALANCE CHANGES AND APPEND IT
+    # raises ValueError (and gives the transactions back to the pending pool) when the block no longer fits on the
+    # tip or its hash does not meet the target; as long as the tip is the one the block was prepared on, the
+    # balances its deltas were computed from did not change either
+    def append_mined_block(self, block, nonce, hash):
+        # the previous hash must still be the one of the last block
+        if block.previous_hash != self.tip_hash():
+            self.abort_block(block)
+            raise ValueError(f"Block {block.index} does not extend the current chain")
+
+        if not meets_target(hash, block.header.target):
+            self.abort_block(block)
+            raise ValueError(f"Hash of block {block.index} does not meet its target")
+
+        changes = self._changes(block.deltas)
+        block.nonce = nonce
+        block.hash = hash
+
+        # Append the mined block to the blockchain and update the peer copy
+        self.chain.append(block)
+        self.peer_b.append(hash)
+        self.state.apply(block.index, changes)
+        self._add_work(block)
+
+        # what is still pending only has to cover the transactions that did not make it into this block
+        self.in_flight_balances = None
+        self.mempool.confirm()
+        return block
+
+    # REPLACE THE BLOCKS ABOVE HEIGHT `fork` WITH A BRANCH FROM A PEER THAT HAS MORE WORK (`blocks` were validated
+    # by PeerSync against our chain as it was when its tip was `tip`; the branch is refused when the tip moved since)
+    # A block that is being mined is given back to the pending pool first (its job fails when it tries to append).
+    # What the rolled back blocks carried is not lost: their transactions that the new branch does not contain,
+    # and the pending balance credits in their deltas, go back to the pending pool if they are still valid. The
+    # transactions that were already pending are checked again too, against the balances of the new branch.
+    def adopt(self, fork, blocks, tip=None):
+        if tip is not None and tip != self.tip_hash():
+            raise ValueError("The chain changed since the branch was checked against it")
+        if not blocks or fork > len(self.chain) or blocks[0].previous_hash != (
+                self.chain[fork - 1].hash if fork else GENESIS_PREVIOUS_HASH):
+            raise ValueError(f"The branch does not fork from block {fork} of the chain")
+        if sum(block_work(block.header.target) for block in blocks) <= self.work_above(fork):
+            raise ValueError(f"The branch from block {fork} does not have more work than the chain")
+
+        self.abort_block(None)
+        rolled_back = self.chain[fork:]
+        self._truncate(fork)
+
+        for block in blocks:
+            changes = self._changes(block.deltas)
+            self.chain.append(block)
+            self.peer_b.append(block.hash)
+            self.state.apply(block.index, changes)
+            self._add_work(block)
+
+        confirmed = {transaction.id for block in blocks for transaction in block.transactions}
+        self.mempool.forget(transaction.id for block in rolled_back for transaction in block.transactions)
+        self.mempool.confirm_ids(confirmed)
+        for block in rolled_back:
+            net = {}
+            for transaction in block.transactions:
+                net[transaction.sender] = net.get(transaction.sender, 0) - transaction.amount
+                net[transaction.receiver] = net.get(transaction.receiver, 0) + transaction.amount
+            for address, delta in block.deltas.items():
+                credit = delta - net.get(address, 0)
+                if credit > 0:
+                    self.balances[address] = self.balances.get(address, 0) + credit
 
-        return nonce, hash_operation
+        # the rolled back transactions are older than the pending ones, so they are admitted first
+        pending = [self.mempool.remove(transaction_id) for transaction_id in list(self.mempool.transactions)]
+        resubmitted = [transaction for block in rolled_back for transaction in block.transactions
+                       if transaction.id not in confirmed]
+        for transaction in resubmitted + pending:
+            try:
+                self._admit(transaction.sender, transaction.receiver, transaction.amount, transaction.id)
+            except (ValueError, OverflowError) as e:
+                self._drop(transaction, f"no longer valid after the switch to a peer's branch: {e}")
+        return len(rolled_back)
+
+    # cut the chain back to its first `length` blocks
+    def _truncate(self, length):
+        if self._work is not None:
+            self._work -= self.work_above(length)
+        if hasattr(self.chain, 'truncate'):
+            self.chain.truncate(length)
+        else:
+            del self.chain[length:]
+        self.peer_b.truncate(length)
+        if length >= self.state.base_height:
+            self.state.rollback(length)
+        else:
+            self.state.restore(length, self.balances_at(length) if length else {})
+        self.verified_height = min(self.verified_height, length)
+
+    # FULL STATE AS OF BLOCK `height`: the nearest checkpoint at or below it plus the deltas of the blocks after it
+    def balances_at(self, height):
+        checkpoint = max(1, height - height % self.checkpoint_interval)
+        balances = dict(self.chain[checkpoint - 1].balances)
+        for position in range(checkpoint, height):
+            for address, delta in self.chain[position].deltas.items():
+                balances[address] = balances.get(address, 0) + delta
+        return balances
+
+    # BALANCE OF AN ADDRESS AT THE TIP OR AS OF BLOCK `height`
+    def balance(self, address, height=None):
+        if height is not None and height < self.state.base_height:
+            return self.balances_at(height).get(address, 0)
+        return self.state.balance(address, height)
+
+    # SUMMED WORK OF EVERY BLOCK OF THE CHAIN, what peers compare to pick the chain to follow
+    # The target only changes at the start of a retarget window, so the first call reads one header per window;
+    # after that every appended or rolled back block updates the sum.
+    def work(self):
+        if self._work is None:
+            length = len(self.chain)
+            self._work = sum(block_work(self.chain[first - 1].header.target)
+                             * (min(first + self.retarget_interval, length + 1) - first)
+                             for first in range(1, length + 1, self.retarget_interval))
+        return self._work
+
+    # summed work of the blocks above height `height`
+    def work_above(self, height):
+        return sum(block_work(self.chain[position].header.target) for position in range(height, len(self.chain)))
+
+    def _add_work(self, block):
+        if self._work is not None:
+            self._work += block_work(block.header.target)
+
+    def rules(self):
+        return ChainRules(self.initial_target, self.retarget_interval, self.block_interval, self.checkpoint_interval)
+
+    # TARGET THE BLOCK AT HEIGHT `index` HAS TO MEET
+    def target_at(self, index):
+        return target_at(index, lambda height: self.chain[height - 1].header,
+                         self.initial_target, self.retarget_interval, self.block_interval)
+
+    # the target the next block will be mined against
+    def current_target(self):
+        return self.target_at(len(self.chain) + 1)
+
+    # hashing method
+    def hash(self, header):
+        result = self.miner.mine(self.encode_block(header), header.target)
+        return result.nonce, bytes.fromhex(result.hash)
+
+    # the bytes the proof-of-work is computed over
+    def encode_block(self, header):
+        return encode_header(header)
 
     # THIS METHOD RETURNS THE PREVIOUS BLOCK
     def get_previous_block(self):
         return self.chain[-1]
 
     # THIS METHOD ADDS TRANSACTION TO THE BLOCKCHAIN (append a new transaction to the list of pending transactions)
-    def add_transaction(self, sender, receiver, amount):
-        self.transactions.append({
-            'sender': sender,
-            'receiver': receiver,
-            'amount': amount
-        })
+    # the transaction is checked against the pending state (last block's balances + pending balances - what the
+    # sender already spends in pending transactions), so a block never fails validation after its proof-of-work
+    # `transaction_id` is an optional client-chosen id: submitting the same id twice is rejected
+    # raises ValueError for an overdraft or a duplicate and OverflowError when the mempool is full
+    def add_transaction(self, sender, receiver, amount, transaction_id=None):
+        self._admit(sender, receiver, amount, transaction_id)
         previous_block = self.get_previous_block()
-        return previous_block['index'] + 1
+        return previous_block.index + 1
+
+    # ADD A BATCH OF TRANSACTIONS: each one is checked against the pending state including the ones accepted before
+    # it in the batch (run through the ChainWriter, no other submission gets in between).
+    # `transactions` is a list of (sender, receiver, amount, transaction_id) tuples; returns, in the same order,
+    # (transaction_id, None) for an accepted transaction and (None, reason) for a rejected one, plus the block the
+    # accepted ones are added to
+    def add_transactions(self, transactions):
+        results = []
+        for sender, receiver, amount, transaction_id in transactions:
+            try:
+                results.append((self._admit(sender, receiver, amount, transaction_id), None))
+            except (ValueError, OverflowError) as e:
+                results.append((None, str(e)))
+        return results, self.get_previous_block().index + 1
+
+    # check one transaction against the pending state and put it in the mempool, returns its id
+    # NaN passes every comparison below and would turn the sender's totals into NaN, so it is refused first
+    def _admit(self, sender, receiver, amount, transaction_id):
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError(f"Invalid transaction data for {sender}: amount must be a finite number greater than zero")
+        if self.mempool.debits(sender) + amount > self.pending_funds(sender):
+            raise ValueError(f"Invalid transaction data for {sender}: Not enough amount")
+
+        transaction_id = transaction_id or uuid.uuid4().hex
+        for evicted in self.mempool.add(sender, receiver, amount, transaction_id):
+            logger.warning("Mempool full, evicted pending transaction %s", evicted.id)
+        return transaction_id
+
+    # a pending transaction is given up: the mempool keeps it with the reason for /dropped_transactions
+    def _drop(self, transaction, reason):
+        self.mempool.drop(transaction, reason)
+        logger.warning("Dropped pending transaction %s: %s", transaction.id, reason)
 
     # ADD BALANCE METHOD
     def add_balance(self, receiver, amount):
         previous_block = self.get_previous_block()
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError(f"Balance of {receiver} must be a finite number greater than zero")
+
+        # the new pending balance replaces the old one (the one of a block being mined still counts), it must
+        # still cover what the receiver already spends
+        if self.mempool.debits(receiver) > (self.state.balance(receiver) + amount
+                                            + (self.in_flight_balances or dict()).get(receiver, 0)):
+            raise ValueError(f"Balance of {receiver} would not cover their pending transactions")
+
         self.balances[receiver] = amount
-        return previous_block['index'] + 1
+        return previous_block.index + 1
+
+    # WHAT AN ADDRESS CAN SPEND IN THE NEXT BLOCK: its balance at the tip merged with its pending balance
+    def pending_funds(self, address):
+        return (self.balances.get(address, 0) + (self.in_flight_balances or dict()).get(address, 0)
+                + self.state.balance(address))
+
+    # THE PENDING TRANSACTIONS, as dicts
+    def pending_transactions(self):
+        return [transaction.to_dict() for transaction in self.mempool]
+
+    # THE MOST RECENTLY DROPPED TRANSACTIONS, as dicts with the reason, newest first, and how many were ever dropped
+    def dropped_transactions(self, limit=100):
+        dropped = []
+        for transaction, reason in reversed(self.mempool.dropped.values()):
+            if len(dropped) == limit:
+                break
+            dropped.append({**transaction.to_dict(), 'reason': reason})
+        return dropped, self.mempool.dropped_total
+
+    # THE PENDING TRANSACTIONS AND BALANCES, to be saved across a restart
+    def pending_snapshot(self):
+        return {'transactions': self.pending_transactions(), 'balances': dict(self.balances)}
+
+    # RE-SUBMIT A SAVED PENDING STATE; returns the entries that no longer pass validation
+    def restore_pending(self, pending):
+        rejected = []
+        for receiver, amount in pending['balances'].items():
+            self.add_balance(receiver, amount)
+        for transaction in pending['transactions']:
+            try:
+                self.add_transaction(transaction['sender'], transaction['receiver'], transaction['amount'],
+                                     transaction.get('id'))
+            except (ValueError, OverflowError):
+                rejected.append(transaction)
+        return rejected
 
     # VALIDATE THE BLOCKCHAIN INTEGRITY
-    def is_chain_valid(self):
-        previous_block = self.chain[0]
-        block_index = 1
+    # only the blocks appended since the last successful check are walked, `full=True` walks the whole chain again
+    def is_chain_valid(self, full=False):
+        height = len(self.chain)
+        if not self.blocks_valid(0 if full else max(1, self.verified_height), height):
+            return False
+        self.verified_height = height
+        return True
+
+    # CHECK THE BLOCKS AT POSITIONS [start, end)
+    # Reads nothing but those blocks, their retarget windows and the hash index, so it can also run off the writer's
+    # thread against a height taken on it; a rollback in the meantime makes it return False or raise IndexError.
+    def blocks_valid(self, start, end):
+        block_index = start
+        previous_hash = self.chain[block_index - 1].hash if block_index else GENESIS_PREVIOUS_HASH
 
-        while block_index < len(self.chain):
+        while block_index < end:
             block = self.chain[block_index]
 
-            if block['previous_hash'] != previous_block['hash']:
+            if block.previous_hash != previous_hash:
+                return False
+
+            if block.hash != self.peer_b[block_index]:
+                return False
+
+            # the stored hash must be the hash of the header and nonce, so nothing the header commits to was changed
+            if hashlib.sha256(self.encode_block(block.header) + str(block.nonce).encode()).digest() != block.hash:
+                return False
+
+            # the block must have been mined against the target of its height, and its hash must meet it
+            if block.header.target != self.target_at(block.index) or not meets_target(block.hash, block.header.target):
                 return False
 
-            if block['hash'] != self.peer_b[block_index]['hash']:
+            # the transactions must be the ones the header (and so the proof-of-work) commits to
+            if block.header.merkle_root != merkle_root(block.transactions):
                 return False
 
-            if block['hash'][:5] != self.difficulty:
+            # so must the deltas and checkpoint balances
+            if block.header.state_root != state_root(block.deltas, block.balances):
                 return False
 
-            previous_block = block
+            previous_hash = block.hash
             block_index += 1
 
         return True
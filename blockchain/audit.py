@@ -0,0 +1,173 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from blockchain.Blockchain import GENESIS_PREVIOUS_HASH, ChainRules
+from blockchain.block import encode_header, now_timestamp, state_root
+from blockchain.difficulty import meets_target, target_at
+from blockchain.merkle import merkle_root
+from blockchain.mining import START_METHOD
+from blockchain.storage import ChainStore, scan_blocks
+
+
+# blocks per audit task, rounded up to a multiple of the checkpoint interval so that every range starts right
+# after a checkpoint block and can replay balances on its own
+RANGE_SIZE = 10_000
+
+# amounts are floats: balances replayed in a different order may differ by rounding
+TOLERANCE = 1e-6
+
+# a range stops listing problems after this many (the first ones are the interesting ones)
+MAX_PROBLEMS = 100
+
+# how far (in microseconds) a block's timestamp may be ahead of the clock of the node that checks it
+MAX_FUTURE = 2 * 60 * 60 * 1_000_000
+
+
+# WHAT IS WRONG WITH THE HEADER OF THE BLOCK AT `height`, an empty list when nothing is
+# `previous_hash` is the hash of the block before and `header_at(height)` the header of an earlier block (for the
+# retarget window). The proof-of-work is checked from scratch: the header is re-serialized and re-hashed with the
+# nonce, and the result must be the stored hash and meet the target of the height. The timestamp must be after the
+# one of the block before and at most MAX_FUTURE ahead of the clock: the retarget trusts the timestamps, and a
+# chain with made-up ones could otherwise lower its difficulty at will.
+def check_header(height, header, nonce, hash, previous_hash, header_at, rules: ChainRules):
+    errors = []
+    if header.index != height:
+        errors.append(f"Block claims index {header.index}")
+    if header.previous_hash != previous_hash:
+        errors.append("Previous hash does not match the hash of the block before")
+    if height > 1 and header.timestamp <= header_at(height - 1).timestamp:
+        errors.append("Timestamp is not after the timestamp of the block before")
+    if header.timestamp > now_timestamp() + MAX_FUTURE:
+        errors.append("Timestamp is too far in the future")
+    digest = hashlib.sha256(encode_header(header) + str(nonce).encode()).digest()
+    if digest != hash:
+        errors.append("Stored hash does not match the hash of the header and nonce")
+    if header.target != target_at(height, header_at, rules.initial_target, rules.retarget_interval,
+                                  rules.block_interval):
+        errors.append("Target does not match the target of this height")
+    if not meets_target(digest, header.target):
+        errors.append("Hash does not meet the target")
+    return errors
+
+
+# CHECK THE BLOCKS AT HEIGHTS [first, last]
+# `blocks` yields (hash in the index, block) from height max(1, first - retarget_interval) on: the blocks before
+# `first` are only read for the previous hash, the retarget window and the checkpoint balances to start from.
+# Returns the number of blocks checked and the problems found, as {'index', 'error'} dicts.
+# The header commits to the transactions (merkle root) and to the deltas and checkpoint balances (state root), so
+# a block whose stored body was edited after it was mined is caught. The replay itself cannot tell a forged
+# credit from a pending balance: a delta may exceed what the block's transactions explain by any amount, as long
+# as the balances it leads to are never negative and agree with the checkpoints.
+def audit_blocks(blocks, first, last, rules: ChainRules):
+    headers = {}
+    hashes = {0: GENESIS_PREVIOUS_HASH}
+    balances = {}
+    problems = []
+    checked = 0
+
+    def problem(height, error):
+        if len(problems) < MAX_PROBLEMS:
+            problems.append({'index': height, 'error': error})
+
+    for height, (index_hash, block) in enumerate(blocks, start=max(1, first - rules.retarget_interval)):
+        headers[height] = block.header
+        hashes[height] = block.hash
+        headers.pop(height - rules.retarget_interval - 1, None)
+        hashes.pop(height - rules.retarget_interval - 1, None)
+
+        if height < first:
+            if height == first - 1:
+                if block.balances is None:
+                    problem(height, "Expected a checkpoint block before the audited range")
+                balances = dict(block.balances or {})
+            continue
+
+        checked += 1
+        header = block.header
+        for error in check_header(height, header, block.nonce, block.hash, hashes[height - 1], headers.__getitem__,
+                                  rules):
+            problem(height, error)
+        if block.hash != index_hash:
+            problem(height, "Stored hash does not match the chain index")
+        if merkle_root(block.transactions) != header.merkle_root:
+            problem(height, "Merkle root does not match the transactions")
+        if state_root(block.deltas, block.balances) != header.state_root:
+            problem(height, "State root does not match the deltas and balances")
+
+        # replay balances: the deltas are the transactions plus pending balance credits, which are never negative
+        net = {}
+        for transaction in block.transactions:
+            net[transaction.sender] = net.get(transaction.sender, 0) - transaction.amount
+            net[transaction.receiver] = net.get(transaction.receiver, 0) + transaction.amount
+        for address, amount in net.items():
+            if block.deltas.get(address, 0) - amount < -TOLERANCE:
+                problem(height, f"Balance change of {address} does not match its transactions")
+        for address, delta in block.deltas.items():
+            balances[address] = balances.get(address, 0) + delta
+            if balances[address] < -TOLERANCE:
+                problem(height, f"Balance of {address} goes negative")
+
+        if height == 1 or height % rules.checkpoint_interval == 0:
+            if block.balances is None:
+                problem(height, "Checkpoint block does not carry the full balances")
+            elif (block.balances.keys() != balances.keys()
+                  or any(abs(block.balances[address] - balance) > TOLERANCE for address, balance in balances.items())):
+                problem(height, "Checkpoint balances do not match the replayed balances")
+            balances = dict(block.balances or balances)
+        elif block.balances is not None:
+            problem(height, "Only checkpoint blocks carry full balances")
+
+    return checked, problems
+
+
+# process pool entry point: audit one range of a chain stored on disk
+def _audit_range(directory, first, last, rules):
+    try:
+        return audit_blocks(scan_blocks(directory, max(1, first - rules.retarget_interval), last), first, last, rules)
+    except ValueError as e:
+        return 0, [{'index': first, 'error': f"Range {first}-{last} could not be read: {e}"}]
+
+
+# AUDIT THE WHOLE CHAIN, yielding a progress report after every range and the result at the end
+# The chain is split into contiguous height ranges that are audited in `workers` processes (every core by
+# default); each range replays balances from the checkpoint right before it, and that checkpoint is checked by
+# the range before, so together they cover every block. An in-memory chain is audited in the calling process.
+# The pool starts its processes the way the miners do (START_METHOD): forking the threaded server is not safe.
+def audit_chain(blockchain, workers=None, range_size=RANGE_SIZE):
+    started = time.perf_counter()
+    rules = blockchain.rules()
+    height = len(blockchain.chain)
+    size = -(-max(1, range_size) // rules.checkpoint_interval) * rules.checkpoint_interval
+    ranges = [(first, min(first + size - 1, height)) for first in range(1, height + 1, size)]
+
+    checked = 0
+    found = 0
+
+    def report(done, problems):
+        return {'checked': checked, 'height': height, 'ranges_done': done, 'ranges': len(ranges),
+                'problems': problems, 'elapsed': time.perf_counter() - started}
+
+    if isinstance(blockchain.chain, ChainStore):
+        context = multiprocessing.get_context(START_METHOD)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as pool:
+            tasks = [pool.submit(_audit_range, blockchain.chain.directory, first, last, rules)
+                     for first, last in ranges]
+            for done, task in enumerate(as_completed(tasks), start=1):
+                range_checked, problems = task.result()
+                checked += range_checked
+                found += len(problems)
+                yield report(done, problems)
+    else:
+        for done, (first, last) in enumerate(ranges, start=1):
+            start = max(1, first - rules.retarget_interval)
+            blocks = ((blockchain.peer_b[position], blockchain.chain[position]) for position in range(start - 1, last))
+            range_checked, problems = audit_blocks(blocks, first, last, rules)
+            checked += range_checked
+            found += len(problems)
+            yield report(done, problems)
+
+    yield {'done': True, 'valid': found == 0 and checked == height, 'checked': checked, 'height': height,
+           'problems': found, 'elapsed': time.perf_counter() - started}
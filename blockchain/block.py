@@ -0,0 +1,124 @@
+import hashlib
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from blockchain.encoding import canonical_json
+
+
+# timestamps are whole microseconds since the epoch (UTC)
+def now_timestamp() -> int:
+    return time.time_ns() // 1000
+
+
+# The chain is made of these slotted types: hashes are raw 32-byte digests and timestamps integers.
+# They only turn into JSON-friendly dicts (hex hashes) at the edges: the API, the disk and the proof-of-work encoding.
+
+@dataclass(slots=True)
+class Transaction:
+    id: str
+    sender: str
+    receiver: str
+    amount: float
+
+    def to_dict(self) -> dict:
+        return {'id': self.id, 'sender': self.sender, 'receiver': self.receiver, 'amount': self.amount}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Transaction':
+        return cls(data['id'], data['sender'], data['receiver'], data['amount'])
+
+
+# the part of a block the proof-of-work covers
+@dataclass(slots=True)
+class BlockHeader:
+    index: int
+    timestamp: int
+    previous_hash: bytes
+    merkle_root: bytes
+    # what the block does to the balances (see state_root)
+    state_root: bytes
+    # the 256-bit number the block hash must not exceed
+    target: int
+
+    def to_dict(self) -> dict:
+        return {
+            'index': self.index,
+            'timestamp': self.timestamp,
+            'previous_hash': self.previous_hash.hex(),
+            'merkle_root': self.merkle_root.hex(),
+            'state_root': self.state_root.hex(),
+            'target': f'{self.target:064x}',
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BlockHeader':
+        return cls(data['index'], data['timestamp'], bytes.fromhex(data['previous_hash']),
+                   bytes.fromhex(data['merkle_root']), bytes.fromhex(data['state_root']), int(data['target'], 16))
+
+
+# THE HASH A HEADER COMMITS TO FOR THE BALANCES: the block's deltas and, on a checkpoint block, the full balances
+# Without it the proof-of-work would only cover the transactions, and the deltas and checkpoints of a block could
+# be rewritten without mining it again.
+def state_root(deltas: Dict[str, float], balances: Optional[Dict[str, float]] = None) -> bytes:
+    return hashlib.sha256(canonical_json({'deltas': deltas, 'balances': balances})).digest()
+
+
+# the bytes the proof-of-work is computed over (the nonce's decimal digits are appended to them)
+def encode_header(header: BlockHeader) -> bytes:
+    return canonical_json(header.to_dict())
+
+
+@dataclass(slots=True)
+class Block:
+    header: BlockHeader
+    transactions: List[Transaction]
+    nonce: int = 0
+    hash: bytes = b''
+    # balance change of every address the block touches
+    deltas: Dict[str, float] = field(default_factory=dict)
+    # full balances, only on checkpoint blocks
+    balances: Optional[Dict[str, float]] = None
+    # the canonical JSON of the sealed block, encoded once (see encode)
+    encoded: Optional[bytes] = field(default=None, repr=False, compare=False)
+
+    @property
+    def index(self) -> int:
+        return self.header.index
+
+    @property
+    def previous_hash(self) -> bytes:
+        return self.header.previous_hash
+
+    # the block without its body: the header plus the proof-of-work
+    def summary(self) -> dict:
+        summary = self.header.to_dict()
+        summary['nonce'] = self.nonce
+        summary['hash'] = self.hash.hex()
+        return summary
+
+    def to_dict(self) -> dict:
+        data = self.summary()
+        data['transactions'] = [transaction.to_dict() for transaction in self.transactions]
+        data['deltas'] = self.deltas
+        if self.balances is not None:
+            data['balances'] = self.balances
+        return data
+
+    # the canonical JSON of the block; a block is only encoded once it is sealed (appended), after that the bytes
+    # are cached, because a sealed block never changes
+    def encode(self) -> bytes:
+        if self.encoded is None:
+            self.encoded = canonical_json(self.to_dict())
+        return self.encoded
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Block':
+        return cls(
+            header=BlockHeader.from_dict(data),
+            transactions=[Transaction.from_dict(transaction) for transaction in data['transactions']],
+            nonce=data['nonce'],
+            hash=bytes.fromhex(data['hash']),
+            deltas=data['deltas'],
+            balances=data.get('balances'),
+        )
@@ -1,12 +1,16 @@
+from typing import Optional
+
 from pydantic import BaseModel
 
 
 # define the data model for the transaction
+# `id` is optional: a client that sets it can safely retry, a second submission with the same id is rejected
 
 class TransactionRequest(BaseModel):
     sender: str
     receiver: str
     amount: float
+    id: Optional[str] = None
 
 
 
@@ -19,3 +23,8 @@ class BalanceRequest(BaseModel):
     amount: float
 
 
+# define the data model for a peer node (its base URL, e.g. http://127.0.0.1:8001)
+
+
+class PeerRequest(BaseModel):
+    url: str
@@ -0,0 +1,50 @@
+# Difficulty is a 256-bit target: a block is valid when its hash, read as a big-endian number, is at most the
+# target. Every `retarget_interval` blocks the target is scaled by how long the last window of blocks actually
+# took compared to `block_interval` seconds per block, so the chain keeps growing at about the same rate
+# whatever mining capacity is behind it.
+
+MAX_TARGET = 2 ** 256 - 1
+
+# a retarget never moves the target by more than this factor in either direction
+MAX_ADJUSTMENT = 4
+
+
+# the target that requires the first `bits` bits of the hash to be zero ('00000' in hex is 20 bits)
+def target_for_zero_bits(bits: int) -> int:
+    return (1 << (256 - bits)) - 1
+
+
+# the target the chain started with before this was configurable: five leading hex zeros
+DEFAULT_TARGET = target_for_zero_bits(20)
+
+
+def meets_target(hash: bytes, target: int) -> bool:
+    return int.from_bytes(hash, 'big') <= target
+
+
+# EXPECTED NUMBER OF HASHES IT TAKES TO MEET `target`: the work a block adds to its chain
+# Chains are compared by the sum of their blocks' work, not by their length: a branch of many blocks mined against
+# an easy target is still cheaper than a shorter one that took more hashes.
+def block_work(target: int) -> int:
+    return 2 ** 256 // (target + 1)
+
+
+# SCALE `target` BY HOW LONG THE WINDOW TOOK (`actual`) COMPARED TO HOW LONG IT SHOULD HAVE TAKEN (`expected`)
+def retarget(target: int, actual: int, expected: int) -> int:
+    actual = min(max(actual, expected // MAX_ADJUSTMENT), expected * MAX_ADJUSTMENT)
+    return min(max(target * actual // expected, 1), MAX_TARGET)
+
+
+# TARGET THE BLOCK AT HEIGHT `index` HAS TO MEET, `header_at(height)` returns the header of an earlier block
+# The first block of every retarget window scales the target of the window before by how long that window's
+# blocks actually took compared to `block_interval` seconds each; every other block keeps its parent's target.
+def target_at(index, header_at, initial_target, retarget_interval, block_interval):
+    if index == 1:
+        return initial_target
+    previous = header_at(index - 1)
+    if (index - 1) % retarget_interval:
+        return previous.target
+    first = header_at(index - retarget_interval)
+    # timestamps are microseconds, a window of N blocks spans N - 1 block intervals
+    expected = int((retarget_interval - 1) * block_interval * 1_000_000)
+    return retarget(previous.target, previous.timestamp - first.timestamp, expected)
@@ -0,0 +1,13 @@
+import orjson
+
+
+# The one JSON encoding of the chain: compact, keys sorted at every level. The proof-of-work is computed over the
+# encoded header, merkle leaves over the encoded transactions, and a sealed block is encoded once and the same bytes
+# are written to disk and sent by the chain endpoints.
+
+def canonical_json(value) -> bytes:
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+
+
+def load_json(data):
+    return orjson.loads(data)
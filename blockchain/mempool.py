@@ -0,0 +1,170 @@
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional
+
+from blockchain.block import Transaction
+
+
+# what add() does when the pool is full: refuse the new transaction, or drop the oldest pending one
+EVICTION_POLICIES = ('reject', 'oldest')
+
+
+class MempoolBatch:
+    """The transactions taken out of the pool for one block, with the per-address totals the pool kept for them."""
+
+    __slots__ = ('transactions', 'sent', 'received')
+
+    def __init__(self, transactions: OrderedDict, sent: Dict[str, float], received: Dict[str, float]):
+        # id -> transaction, in arrival order
+        self.transactions = transactions
+        self.sent = sent
+        self.received = received
+
+    def remove(self, transaction_id: str) -> Transaction:
+        transaction = self.transactions.pop(transaction_id)
+        _subtract(self.sent, transaction.sender, transaction.amount)
+        _subtract(self.received, transaction.receiver, transaction.amount)
+        return transaction
+
+
+class Mempool:
+    """Pending transactions, in arrival order and indexed by id.
+
+    Every transaction carries an `id` (the client's, or a generated one); a second submission with an id that
+    is pending, being mined or was confirmed recently is rejected. The pool keeps what every address sends and
+    receives in its pending transactions as they arrive, so admission checks and block assembly never walk
+    the whole pool. `capacity` bounds the number of pending transactions. Transactions that leave the pool
+    without a block (evicted, or no longer covered by their sender) are kept with the reason, so a client
+    can find out what happened to them.
+    """
+
+    def __init__(self, capacity: int = 100_000, eviction: str = 'reject', remembered: int = 100_000):
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {eviction!r}, expected one of {EVICTION_POLICIES}")
+        self.capacity = capacity
+        self.eviction = eviction
+        self.transactions: OrderedDict = OrderedDict()
+        self.sent: Dict[str, float] = {}
+        self.received: Dict[str, float] = {}
+        # the batch of the block that is being mined, None when no block is being mined
+        self.in_flight: Optional[MempoolBatch] = None
+        # the emptied containers of the last confirmed batch, the next drain hands them to the pool again
+        self.spare: Optional[MempoolBatch] = None
+        # ids of transactions that made it into a block, the most recent `remembered` of them
+        self.seen: OrderedDict = OrderedDict()
+        self.remembered = remembered
+        # transactions dropped from the pool, the most recent `remembered` of them: id -> (transaction, reason)
+        self.dropped: OrderedDict = OrderedDict()
+        # every transaction dropped since the pool was created
+        self.dropped_total = 0
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        return iter(self.transactions.values())
+
+    def __contains__(self, transaction_id) -> bool:
+        return (transaction_id in self.transactions or transaction_id in self.seen
+                or (self.in_flight is not None and transaction_id in self.in_flight.transactions))
+
+    # what `address` already spends in pending transactions, including the ones of the block being mined
+    def debits(self, address: str) -> float:
+        debits = self.sent.get(address, 0)
+        if self.in_flight is not None:
+            debits += self.in_flight.sent.get(address, 0)
+        return debits
+
+    # ADD A TRANSACTION; returns the transactions evicted to make room for it
+    def add(self, sender: str, receiver: str, amount: float,
+            transaction_id: Optional[str] = None) -> List[Transaction]:
+        transaction_id = transaction_id or uuid.uuid4().hex
+        if transaction_id in self:
+            raise ValueError(f"Transaction {transaction_id} was already submitted")
+
+        evicted = []
+        if len(self.transactions) >= self.capacity:
+            if self.eviction == 'reject' or not self.transactions:
+                raise OverflowError(f"The mempool is full ({self.capacity} pending transactions)")
+            evicted.append(self.remove(next(iter(self.transactions))))
+            self.drop(evicted[-1], "evicted, the mempool was full")
+
+        transaction = Transaction(transaction_id, sender, receiver, amount)
+        self.transactions[transaction_id] = transaction
+        # a dropped transaction submitted again is pending once more
+        self.dropped.pop(transaction_id, None)
+        self.sent[sender] = self.sent.get(sender, 0) + amount
+        self.received[receiver] = self.received.get(receiver, 0) + amount
+        return evicted
+
+    def remove(self, transaction_id: str) -> Transaction:
+        transaction = self.transactions.pop(transaction_id)
+        _subtract(self.sent, transaction.sender, transaction.amount)
+        _subtract(self.received, transaction.receiver, transaction.amount)
+        return transaction
+
+    # TAKE EVERY PENDING TRANSACTION OUT OF THE POOL FOR THE NEXT BLOCK (the pool starts empty again)
+    # The pool is double-buffered: its containers become the block's batch and the spare ones take their place,
+    # so the swap costs the same however many transactions are pending.
+    def drain(self) -> MempoolBatch:
+        if self.in_flight is not None:
+            raise RuntimeError("Another block is already being mined")
+        self.in_flight = MempoolBatch(self.transactions, self.sent, self.received)
+        spare, self.spare = self.spare, None
+        if spare is None:
+            spare = MempoolBatch(OrderedDict(), {}, {})
+        self.transactions, self.sent, self.received = spare.transactions, spare.sent, spare.received
+        return self.in_flight
+
+    # THE BLOCK OF THE IN-FLIGHT BATCH WAS APPENDED: remember its ids so they cannot be submitted again
+    def confirm(self):
+        self._remember(self.in_flight.transactions)
+        batch, self.in_flight = self.in_flight, None
+        for container in (batch.transactions, batch.sent, batch.received):
+            container.clear()
+        self.spare = batch
+
+    # TRANSACTIONS THAT WERE CONFIRMED BY A BLOCK FROM A PEER: drop them from the pool and remember their ids
+    def confirm_ids(self, transaction_ids):
+        for transaction_id in transaction_ids:
+            if transaction_id in self.transactions:
+                self.remove(transaction_id)
+        self._remember(transaction_ids)
+
+    # A TRANSACTION LEFT THE POOL WITHOUT MAKING IT INTO A BLOCK: keep it and the reason
+    def drop(self, transaction: Transaction, reason: str):
+        self.dropped.pop(transaction.id, None)
+        self.dropped[transaction.id] = (transaction, reason)
+        self.dropped_total += 1
+        while len(self.dropped) > self.remembered:
+            self.dropped.popitem(last=False)
+
+    # TRANSACTIONS OF BLOCKS THAT WERE ROLLED BACK: they may be submitted again
+    def forget(self, transaction_ids):
+        for transaction_id in transaction_ids:
+            self.seen.pop(transaction_id, None)
+
+    def _remember(self, transaction_ids):
+        for transaction_id in transaction_ids:
+            self.seen[transaction_id] = None
+        while len(self.seen) > self.remembered:
+            self.seen.popitem(last=False)
+
+    # THE BLOCK OF THE IN-FLIGHT BATCH WAS NOT APPENDED: put its transactions back in front of the pool
+    def restore(self):
+        batch, self.in_flight = self.in_flight, None
+        if batch is None:
+            return
+        batch.transactions.update(self.transactions)
+        self.transactions = batch.transactions
+        for totals, extra in ((self.sent, batch.sent), (self.received, batch.received)):
+            for address, amount in extra.items():
+                totals[address] = amount + totals.get(address, 0)
+
+
+def _subtract(totals, address, amount):
+    remaining = totals.get(address, 0) - amount
+    if remaining <= 0:
+        totals.pop(address, None)
+    else:
+        totals[address] = remaining
@@ -0,0 +1,58 @@
+import hashlib
+from typing import Dict, List
+
+from blockchain.block import Transaction
+from blockchain.encoding import canonical_json
+
+
+# leaves and inner nodes are hashed with different prefixes so a leaf can never pass for an inner node
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def leaf_hash(transaction: Transaction) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + canonical_json(transaction.to_dict())).digest()
+
+
+def node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+# every level of the tree, from the leaves up to the root; an odd node at the end of a level is carried up as is
+def merkle_levels(transactions: List[Transaction]) -> List[List[bytes]]:
+    level = [leaf_hash(transaction) for transaction in transactions]
+    levels = [level]
+    while len(level) > 1:
+        level = [node_hash(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+
+# MERKLE ROOT OF A LIST OF TRANSACTIONS, the sha256 of nothing for an empty block
+def merkle_root(transactions: List[Transaction]) -> bytes:
+    if not transactions:
+        return hashlib.sha256(b'').digest()
+    return merkle_levels(transactions)[-1][0]
+
+
+# INCLUSION PROOF FOR THE TRANSACTION AT `position`: the sibling hashes from the leaf up to the root
+def merkle_proof(transactions: List[Transaction], position: int) -> List[Dict[str, str]]:
+    if not 0 <= position < len(transactions):
+        raise IndexError('transaction position out of range')
+    proof = []
+    for level in merkle_levels(transactions)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append({'hash': level[sibling].hex(), 'side': 'left' if sibling < position else 'right'})
+        position //= 2
+    return proof
+
+
+# CHECK THAT `transaction` IS PART OF THE TREE WITH ROOT `root`
+def verify_proof(transaction: Transaction, proof: List[Dict[str, str]], root: bytes) -> bool:
+    current = leaf_hash(transaction)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        current = node_hash(sibling, current) if step['side'] == 'left' else node_hash(current, sibling)
+    return current == root
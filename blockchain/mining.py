@@ -0,0 +1,204 @@
+import hashlib
+import multiprocessing
+import os
+import queue
+import time
+from typing import NamedTuple, Optional
+
+
+# number of nonces a worker tries before it checks whether another worker already found a hash
+# (a multiple of SUFFIX_SPAN so every chunk starts on a suffix boundary)
+CHUNK_SIZE = 20_000
+
+# nonces are hashed as their decimal digits; the last SUFFIX_DIGITS digits come from a precomputed table
+SUFFIX_DIGITS = 4
+SUFFIX_SPAN = 10 ** SUFFIX_DIGITS
+NONCE_SUFFIXES = tuple(str(low).zfill(SUFFIX_DIGITS).encode() for low in range(SUFFIX_SPAN))
+
+# how often (in seconds) the parent of the workers checks that they are all still running
+POLL_INTERVAL = 0.5
+
+# mining processes start from a fresh interpreter (forkserver, or spawn where there is none): a fork of the API
+# process would copy it in the middle of what its other threads are doing, locks they hold included
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+if START_METHOD == 'forkserver':
+    # the fork server imports this module once, instead of every mining process importing it again
+    multiprocessing.get_context(START_METHOD).set_forkserver_preload([__name__])
+
+
+# the result of a proof-of-work search
+class MiningResult(NamedTuple):
+    nonce: int
+    hash: str
+    hashes: int
+    elapsed: float
+
+    # hashes per second over the whole search (all workers together)
+    @property
+    def hash_rate(self) -> float:
+        if self.elapsed <= 0:
+            return float(self.hashes)
+        return self.hashes / self.elapsed
+
+
+# TRY EVERY NONCE IN [start, stop) AND RETURN THE FIRST ONE WHOSE HASH IS AT MOST `target`
+def search_range(encoded_block: bytes, target: bytes, start: int, stop: int):
+    """Same result as hashing `encoded_block + str(nonce).encode()` for each nonce, without redoing the work.
+
+    The block prefix is absorbed into a sha256 state once; for every run of SUFFIX_SPAN nonces that share
+    their leading digits those digits are absorbed once more, and each try only copies that state and feeds
+    the precomputed trailing digits. `target` is the 256-bit target as 32 big-endian bytes, so comparing it
+    with the raw digest is a single bytes comparison; the hex string is only built for the winning nonce.
+    """
+    block_state = hashlib.sha256(encoded_block)
+
+    nonce = start
+    # nonces below SUFFIX_SPAN have no zero padding, hash them the plain way
+    while nonce < min(stop, SUFFIX_SPAN):
+        state = block_state.copy()
+        state.update(str(nonce).encode())
+        if state.digest() <= target:
+            return nonce, state.hexdigest()
+        nonce += 1
+
+    while nonce < stop:
+        high, low = divmod(nonce, SUFFIX_SPAN)
+        high_state = block_state.copy()
+        high_state.update(str(high).encode())
+        copy = high_state.copy
+        last = min(SUFFIX_SPAN, low + stop - nonce)
+        for index in range(low, last):
+            state = copy()
+            state.update(NONCE_SUFFIXES[index])
+            if state.digest() <= target:
+                return high * SUFFIX_SPAN + index, state.hexdigest()
+        nonce += last - low
+    return None
+
+
+# worker process: walks every `step`-th chunk of the nonce space starting at chunk `offset`
+def _worker(encoded_block, target, offset, step, chunk_size, found, results, progress, stop):
+    chunk = offset
+    hashes = 0
+    while not found.is_set() and not _stopped(stop):
+        start = chunk * chunk_size
+        match = search_range(encoded_block, target, start, start + chunk_size)
+        if match is not None:
+            hashes += match[0] - start + 1
+            found.set()
+            results.put((offset, match[0], match[1], hashes))
+            return
+        hashes += chunk_size
+        _report(progress, chunk_size)
+        chunk += step
+    results.put((offset, None, None, hashes))
+
+
+def _stopped(stop):
+    return stop is not None and stop.is_set()
+
+
+# add finished nonces to the shared progress counter, if the caller asked for one
+def _report(progress, hashes):
+    if progress is not None:
+        with progress.get_lock():
+            progress.value += hashes
+
+
+class Miner:
+    """Proof-of-work engine that splits the nonce space across worker processes.
+
+    `workers=1` runs the search in the calling process, which is what tests should use.
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        # the last search, so callers can report the hash rate of the last mined block
+        self.last_result: Optional[MiningResult] = None
+
+    def mine(self, encoded_block: bytes, target: int, progress=None, stop=None) -> Optional[MiningResult]:
+        """Find a nonce for `encoded_block` whose hash, read as a 256-bit number, is at most `target`.
+
+        `progress` is an optional shared `multiprocessing.Value` that is increased by the number of nonces
+        tried after every chunk, so another process can follow a long search. `stop` is an optional
+        `multiprocessing.Event`; once it is set the search gives up and returns None. Raises RuntimeError
+        when a worker process dies before it reports.
+        """
+        started = time.perf_counter()
+        target = target.to_bytes(32, 'big')
+        if self.workers == 1:
+            nonce, hash_operation, hashes = self._mine_single(encoded_block, target, progress, stop)
+        else:
+            nonce, hash_operation, hashes = self._mine_parallel(encoded_block, target, progress, stop)
+        if nonce is None:
+            return None
+        self.last_result = MiningResult(nonce, hash_operation, hashes, time.perf_counter() - started)
+        return self.last_result
+
+    def _mine_single(self, encoded_block, target, progress, stop):
+        start = 0
+        while not _stopped(stop):
+            match = search_range(encoded_block, target, start, start + self.chunk_size)
+            if match is not None:
+                return match[0], match[1], match[0] + 1
+            _report(progress, self.chunk_size)
+            start += self.chunk_size
+        return None, None, start
+
+    def _mine_parallel(self, encoded_block, target, progress, stop):
+        context = multiprocessing.get_context(START_METHOD)
+        found = context.Event()
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_worker,
+                args=(encoded_block, target, offset, self.workers, self.chunk_size, found, results, progress, stop),
+                daemon=True,
+            )
+            for offset in range(self.workers)
+        ]
+        for process in processes:
+            process.start()
+
+        # every worker reports exactly once: either its match or the number of hashes it tried before stopping.
+        # A worker puts its report in the queue before it exits, so one that is still gone without a report a
+        # poll after it exited was killed or crashed, and the search would otherwise wait for it forever.
+        matches = []
+        hashes = 0
+        reported = set()
+        exited = set()
+        try:
+            while len(reported) < len(processes):
+                try:
+                    offset, nonce, hash_operation, tried = results.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    gone = {offset for offset, process in enumerate(processes)
+                            if offset not in reported and process.exitcode is not None}
+                    for offset in gone & exited:
+                        raise RuntimeError(f"Mining worker {offset} exited with code {processes[offset].exitcode} "
+                                           f"without a result")
+                    exited = gone
+                    continue
+                reported.add(offset)
+                hashes += tried
+                if nonce is not None:
+                    matches.append((nonce, hash_operation))
+        finally:
+            found.set()
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+            try:
+                while True:
+                    results.get_nowait()
+            except queue.Empty:
+                pass
+
+        if not matches:
+            return None, None, hashes
+
+        # several workers can hit a match in the same round, keep the lowest nonce
+        nonce, hash_operation = min(matches)
+        return nonce, hash_operation, hashes
@@ -0,0 +1,190 @@
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from typing import Optional
+
+from blockchain.mining import START_METHOD, Miner
+
+
+# how often the job thread looks at cancellation, the timeout and the mining process
+POLL_INTERVAL = 0.1
+
+
+class JobState(str, Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    TIMED_OUT = 'timed_out'
+
+
+FINISHED_STATES = (JobState.DONE, JobState.FAILED, JobState.CANCELLED, JobState.TIMED_OUT)
+
+
+# entry point of the mining process: search for the nonce and send it back to the job thread
+def _mine(encoded_block, target, workers, progress, stop, results):
+    result = Miner(workers=workers).mine(encoded_block, target, progress=progress, stop=stop)
+    if result is not None:
+        results.put((result.nonce, bytes.fromhex(result.hash)))
+
+
+class MiningJob:
+    def __init__(self, block, timeout):
+        context = multiprocessing.get_context(START_METHOD)
+        self.id = uuid.uuid4().hex
+        self.state = JobState.PENDING
+        # the prepared block while mining, the sealed block once the job is done
+        self.block = block
+        self.error = None
+        self.timeout = timeout
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # nonces tried so far, written by the mining process
+        self.progress = context.Value('Q', 0)
+        # tells the mining process to give up
+        self.stop = context.Event()
+
+    def is_finished(self):
+        return self.state in FINISHED_STATES
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def hash_rate(self):
+        elapsed = self.elapsed()
+        return self.progress.value / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'state': self.state.value,
+            'index': self.block.index,
+            'target': f'{self.block.header.target:064x}',
+            'nonces_tried': self.progress.value,
+            'hash_rate': self.hash_rate(),
+            'elapsed': self.elapsed(),
+            'block': self.block.to_dict() if self.state == JobState.DONE else None,
+            'error': self.error,
+        }
+
+
+class MiningJobManager:
+    """Mines blocks in a separate process so the API keeps serving while the proof-of-work runs.
+
+    Only one job mines at a time, since every block is built on top of the previous one. The block is prepared,
+    appended or aborted through `writer` (a ChainWriter), never by the job thread itself.
+    """
+
+    def __init__(self, blockchain, writer, timeout: float = 600, history: int = 100):
+        self.blockchain = blockchain
+        self.writer = writer
+        self.timeout = timeout
+        # finished jobs kept around so clients can still read their result
+        self.history = history
+        self.jobs = OrderedDict()
+        self.active: Optional[MiningJob] = None
+        self.lock = threading.Lock()
+
+    def submit(self, timeout: Optional[float] = None) -> MiningJob:
+        with self.lock:
+            if self.active is not None and not self.active.is_finished():
+                raise RuntimeError(f"Block {self.active.block.index} is already being mined "
+                                   f"by job {self.active.id}")
+            job = MiningJob(self.writer.call(self.blockchain.prepare_block), timeout or self.timeout)
+            self.active = job
+            self.jobs[job.id] = job
+            self._prune()
+
+        threading.Thread(target=self._run, args=(job,), name=f"mining-job-{job.id}", daemon=True).start()
+        return job
+
+    def get(self, job_id) -> Optional[MiningJob]:
+        return self.jobs.get(job_id)
+
+    # raises RuntimeError when the job has already finished
+    def cancel(self, job_id) -> Optional[MiningJob]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.is_finished():
+            raise RuntimeError(f"Mining job {job.id} is already {job.state.value}")
+        job.stop.set()
+        return job
+
+    # stop the running job, if any, and wait until its transactions are back in the pending pool
+    def shutdown(self, timeout: float = 10):
+        job = self.active
+        if job is None or job.is_finished():
+            return
+        job.stop.set()
+        deadline = time.time() + timeout
+        while not job.is_finished() and time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+
+    # drop the oldest finished jobs once there are more than `history`
+    def _prune(self):
+        for job_id in list(self.jobs):
+            if len(self.jobs) <= self.history:
+                break
+            if self.jobs[job_id].is_finished():
+                del self.jobs[job_id]
+
+    # a job that does not end with an appended block gives its transactions back to the pending pool
+    def _finish(self, job, state, error=None):
+        if state != JobState.DONE:
+            self.writer.call(self.blockchain.abort_block, job.block)
+        job.error = error
+        job.finished_at = time.time()
+        job.state = state
+
+    # job thread: starts the mining process, waits for it and appends the block when it is done
+    def _run(self, job):
+        context = multiprocessing.get_context(START_METHOD)
+        results = context.Queue()
+        process = context.Process(
+            target=_mine,
+            args=(self.blockchain.encode_block(job.block.header), job.block.header.target,
+                  self.blockchain.miner.workers, job.progress, job.stop, results),
+            name=f"mining-job-{job.id}",
+        )
+        job.started_at = time.time()
+        job.state = JobState.RUNNING
+        process.start()
+
+        try:
+            while True:
+                try:
+                    nonce, hash = results.get(timeout=POLL_INTERVAL)
+                    break
+                except queue.Empty:
+                    pass
+
+                if job.stop.is_set():
+                    self._finish(job, JobState.CANCELLED)
+                    return
+                if job.elapsed() > job.timeout:
+                    job.stop.set()
+                    self._finish(job, JobState.TIMED_OUT, f"Mining took longer than {job.timeout} seconds")
+                    return
+                if not process.is_alive() and results.empty():
+                    self._finish(job, JobState.FAILED, f"Mining process exited with code {process.exitcode}")
+                    return
+        finally:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        try:
+            job.block = self.writer.call(self.blockchain.append_mined_block, job.block, nonce, hash)
+        except Exception as e:
+            self._finish(job, JobState.FAILED, str(e))
+            return
+        self._finish(job, JobState.DONE)
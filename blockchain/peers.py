@@ -0,0 +1,305 @@
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+
+from blockchain.Blockchain import GENESIS_PREVIOUS_HASH
+from blockchain.audit import audit_blocks, check_header
+from blockchain.block import Block, BlockHeader
+from blockchain.difficulty import block_work
+
+
+# Several nodes keep the same chain by polling each other: every SYNC_INTERVAL seconds a node asks its peers for
+# their tip, and when a peer claims a chain with more work (the summed work of its blocks, not their number) it
+# downloads the headers first, checks their proof-of-work, targets and timestamps and the work they really add,
+# then fetches the block bodies in parallel batches and switches to that chain if every block checks out. To try
+# it on one machine, start every node with its own data directory, port and peers, e.g.
+#
+#   CHAIN_DATA_DIR=node1 PEERS=http://127.0.0.1:8002 uvicorn main:app --port 8001
+#   CHAIN_DATA_DIR=node2 PEERS=http://127.0.0.1:8001 uvicorn main:app --port 8002
+
+logger = logging.getLogger(__name__)
+
+# headers per /get_chain request (the endpoint's own page limit)
+HEADER_BATCH = 1000
+
+# full blocks per /get_chain request
+BODY_BATCH = 100
+
+
+class PeerClient:
+    """HTTP client for one peer that keeps up to `connections` keep-alive connections open and reuses them."""
+
+    def __init__(self, url: str, connections: int = 4, timeout: float = 10):
+        parts = urlsplit(url)
+        self.url = url.rstrip('/')
+        self.host = parts.hostname
+        self.port = parts.port
+        self.secure = parts.scheme == 'https'
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(connections)
+
+    def _connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    # GET `path` and decode the JSON answer; raises ConnectionError when the peer cannot be reached or fails
+    def get(self, path: str, **params):
+        target = f'{path}?{urlencode(params)}' if params else path
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                connection.request('GET', target, headers={'Accept': 'application/json'})
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise ConnectionError(f"{self.url}{path}: {e}") from e
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+
+        if response.status != 200:
+            raise ConnectionError(f"{self.url}{path} answered {response.status}")
+        return json.loads(body)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def _header(summary) -> tuple:
+    return BlockHeader.from_dict(summary), summary['nonce'], bytes.fromhex(summary['hash'])
+
+
+class PeerSync:
+    """Keeps the chain in line with the valid chain with the most work among `peers`.
+
+    Downloads run on `workers` threads over the pooled connections of every peer; the switch to a longer chain
+    goes through `writer` (the ChainWriter), like every other change to the chain.
+    """
+
+    def __init__(self, blockchain, writer, peers=(), interval: float = 10, workers: int = 4):
+        self.blockchain = blockchain
+        self.writer = writer
+        self.interval = interval
+        self.workers = workers
+        self.peers: Dict[str, PeerClient] = {}
+        # url -> what the last sync with that peer found
+        self.status: Dict[str, dict] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        # one sync at a time (the background rounds and POST /sync)
+        self._syncing = threading.Lock()
+        for url in peers:
+            self.add_peer(url)
+
+    def add_peer(self, url: str):
+        url = url.rstrip('/')
+        with self._lock:
+            if url not in self.peers:
+                self.peers[url] = PeerClient(url, connections=self.workers)
+                self.status[url] = {'peer': url, 'height': None, 'last_sync': None, 'error': None}
+
+    def remove_peer(self, url: str):
+        with self._lock:
+            client = self.peers.pop(url.rstrip('/'), None)
+            self.status.pop(url.rstrip('/'), None)
+        if client is not None:
+            client.close()
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="peer-sync", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        for client in list(self.peers.values()):
+            client.close()
+
+    # a round that fails in a way sync_all does not expect is reported, and the next round runs as usual
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sync_all()
+            except Exception as e:
+                logger.warning("Peer sync round failed: %r", e)
+
+    # SYNC WITH EVERY PEER, the one with the most work first; returns the status of every peer
+    def sync_all(self) -> List[dict]:
+        with self._syncing:
+            return self._sync_all()
+
+    # Whatever a peer answers, a failure only ends the sync with that peer: it is recorded in the peer's status
+    # and the next peer is tried. A peer removed in the middle of a round is skipped.
+    def _sync_all(self):
+        tips = {}
+        for url, client in list(self.peers.items()):
+            try:
+                tip = client.get('/tip')
+                tips[url] = int(tip['height']), int(tip['work'], 16)
+                self._update_status(url, height=tips[url][0], error=None)
+            except Exception as e:
+                self._update_status(url, error=str(e) or repr(e))
+
+        # the work a peer claims only decides whether to look at its chain, sync checks what its headers add up to
+        for url in sorted(tips, key=lambda url: tips[url][1], reverse=True):
+            if tips[url][1] <= self.writer.call(self.blockchain.work):
+                break
+            client = self.peers.get(url)
+            if client is None:
+                continue
+            try:
+                adopted = self.sync(client, tips[url][0])
+                self._update_status(url, last_sync=time.time(), error=None, **adopted)
+            except Exception as e:
+                self._update_status(url, error=str(e) or repr(e))
+        return list(self.status.values())
+
+    def _update_status(self, url, **fields):
+        status = self.status.get(url)
+        if status is not None:
+            status.update(fields)
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    # SWITCH TO THE CHAIN OF `client` (`height` blocks long) IF IT HAS MORE WORK AND IS VALID
+    # raises ConnectionError when the peer fails and ValueError when its chain does not check out
+    # Our chain is only read on the writer's thread, and only while its tip is still the one the sync started from:
+    # a block mined or rolled back meanwhile ends the sync with ValueError (the next round starts again), and adopt
+    # refuses the branch for the same reason.
+    def sync(self, client: PeerClient, height: int) -> dict:
+        ours, tip = self.writer.call(lambda: (len(self.blockchain.chain), self.blockchain.tip_hash()))
+        fork = self._find_fork(client, min(ours, height), tip)
+        if fork == height:
+            return {'fork': fork, 'adopted': 0, 'rolled_back': 0}
+        headers = self._fetch_headers(client, fork + 1, height)
+        # the search can stop below the real fork point: skip the blocks both chains share
+        hashes = self._read(tip, lambda: [self.blockchain.hash_at(position)
+                                          for position in range(fork + 1, min(ours, fork + len(headers)) + 1)])
+        shared = 0
+        while shared < len(hashes) and headers[shared][2] == hashes[shared]:
+            shared += 1
+        fork, headers = fork + shared, headers[shared:]
+        if sum(block_work(header.target) for header, _, _ in headers) <= self._read(tip, self.blockchain.work_above,
+                                                                                     fork):
+            return {'fork': fork, 'adopted': 0, 'rolled_back': 0}
+
+        below = self._blocks_below(fork, tip)
+        self._check_headers(fork, headers, below)
+        blocks = self._fetch_bodies(client, fork + 1, fork + len(headers))
+        self._check_blocks(fork, headers, blocks, below)
+
+        rolled_back = self.writer.call(self.blockchain.adopt, fork, blocks, tip)
+        return {'fork': fork, 'adopted': len(blocks), 'rolled_back': rolled_back}
+
+    # run `function` on the writer's thread, as long as the tip of our chain is still `tip`
+    def _read(self, tip, function, *args):
+        def read():
+            if self.blockchain.tip_hash() != tip:
+                raise ValueError("The chain changed during the sync")
+            return function(*args)
+        return self.writer.call(read)
+
+    # highest height (0 when none) at which both chains have the same block, stepping back exponentially
+    def _find_fork(self, client, height, tip):
+        step = 1
+        while height > 0:
+            summaries = client.get('/get_chain', start=height, limit=1, headers_only='true')['chain']
+            if len(summaries) != 1:
+                raise ConnectionError(f"{client.url} sent {len(summaries)} blocks for height {height}")
+            summary = summaries[0]
+            if bytes.fromhex(summary['hash']) == self._read(tip, self.blockchain.hash_at, height):
+                return height
+            height = max(0, height - step)
+            step *= 2
+        return 0
+
+    # height -> (hash, block) of our blocks the checks of a branch from `fork` read: the retarget window and the
+    # checkpoint at or below the fork, and what comes after it up to the fork
+    def _blocks_below(self, fork, tip):
+        rules = self.blockchain.rules()
+        checkpoint = max(1, fork - fork % rules.checkpoint_interval) if fork else 0
+        start = max(1, checkpoint + 1 - rules.retarget_interval)
+        return self._read(tip, lambda: {height: (self.blockchain.hash_at(height), self.blockchain.chain[height - 1])
+                                         for height in range(start, fork + 1)})
+
+    def _fetch(self, client, start, end, batch, **params):
+        ranges = [(first, min(first + batch - 1, end)) for first in range(start, end + 1, batch)]
+
+        def page(bounds):
+            first, last = bounds
+            summaries = client.get('/get_chain', start=first, end=last, limit=batch, **params)['chain']
+            if len(summaries) != last - first + 1:
+                raise ConnectionError(f"{client.url} sent {len(summaries)} blocks for heights {first}-{last}")
+            return summaries
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return [summary for summaries in pool.map(page, ranges) for summary in summaries]
+
+    def _fetch_headers(self, client, start, end):
+        return [_header(summary) for summary in self._fetch(client, start, end, HEADER_BATCH, headers_only='true')]
+
+    def _fetch_bodies(self, client, start, end):
+        return [Block.from_dict(data) for data in self._fetch(client, start, end, BODY_BATCH)]
+
+    # the header of `height` on the new branch: ours up to the fork, the peer's above it
+    def _header_at(self, fork, headers, below):
+        def header_at(height):
+            if height <= fork:
+                return below[height][1].header
+            return headers[height - fork - 1][0]
+        return header_at
+
+    # links, proof-of-work and targets, before any body is downloaded
+    def _check_headers(self, fork, headers, below):
+        rules = self.blockchain.rules()
+        header_at = self._header_at(fork, headers, below)
+        previous_hash = below[fork][0] if fork else GENESIS_PREVIOUS_HASH
+        for height, (header, nonce, hash) in enumerate(headers, start=fork + 1):
+            errors = check_header(height, header, nonce, hash, previous_hash, header_at, rules)
+            if errors:
+                raise ValueError(f"Header {height} from the peer is invalid: {errors[0]}")
+            previous_hash = hash
+
+    # the bodies must be the blocks of the checked headers, with matching merkle roots and balances; balances are
+    # replayed from the last checkpoint at or below the fork, so a few of our own blocks are checked again
+    def _check_blocks(self, fork, headers, blocks, below):
+        for (header, _, hash), block in zip(headers, blocks):
+            if block.hash != hash or block.header != header:
+                raise ValueError(f"Block {header.index} from the peer does not match its header")
+
+        rules = self.blockchain.rules()
+        checkpoint = max(1, fork - fork % rules.checkpoint_interval) if fork else 0
+        first = checkpoint + 1
+        start = max(1, first - rules.retarget_interval)
+        ours = (below[height] for height in range(start, fork + 1))
+        theirs = ((block.hash, block) for block in blocks)
+
+        def branch():
+            yield from ours
+            yield from theirs
+
+        _, problems = audit_blocks(branch(), first, fork + len(blocks), rules)
+        if problems:
+            raise ValueError(f"Block {problems[0]['index']} from the peer is invalid: {problems[0]['error']}")
@@ -0,0 +1,50 @@
+from typing import Iterator
+
+
+# size of a sha256 hash in bytes
+HASH_SIZE = 32
+
+
+class PeerReplica:
+    """Append-only copy of what chain validation compares against: the hash of every block, in order.
+
+    Hashes are packed as raw 32-byte digests into one bytearray, so the replica grows by 32 bytes per
+    block and is never copied.
+    """
+
+    __slots__ = ('_hashes',)
+
+    def __init__(self, hashes=()):
+        self._hashes = bytearray()
+        for hash in hashes:
+            self.append(hash)
+
+    # a replica over hashes that are already packed as consecutive 32-byte digests
+    @classmethod
+    def from_bytes(cls, hashes: bytes):
+        replica = cls()
+        replica._hashes += hashes
+        return replica
+
+    def append(self, hash: bytes):
+        self._hashes += hash
+
+    # keep the first `length` hashes
+    def truncate(self, length: int):
+        del self._hashes[length * HASH_SIZE:]
+
+    def __len__(self) -> int:
+        return len(self._hashes) // HASH_SIZE
+
+    # the hash of the block at `position` (0 is the genesis block)
+    def __getitem__(self, position: int) -> bytes:
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('replica position out of range')
+        start = position * HASH_SIZE
+        return bytes(self._hashes[start:start + HASH_SIZE])
+
+    def __iter__(self) -> Iterator[bytes]:
+        for position in range(len(self)):
+            yield self[position]
@@ -0,0 +1,357 @@
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+from typing import Dict, NamedTuple, Optional
+
+from blockchain.Blockchain import GENESIS_PREVIOUS_HASH, Blockchain, ChainRules
+from blockchain.audit import audit_blocks
+from blockchain.block import Block, BlockHeader, Transaction
+from blockchain.storage import ChainStore
+
+
+# A snapshot is one binary file, written front to back so it can be streamed:
+#
+#   file header   magic, version, the chain rules and the height
+#   records       one length-prefixed record per block, in height order
+#   addresses     every address the records use, once; records refer to addresses by their position here
+#   state         the balance of every address at the snapshot height
+#   index         the file offset of every block record (8 bytes per block)
+#   trailer       offsets of the index, the addresses and the state, sha256 of everything before the trailer, magic
+#
+# Transactions, deltas and balances are arrays of fixed-size entries, so a record decodes with a few
+# struct.iter_unpack calls. Amounts keep their JSON type (int or float), because transactions are hashed as JSON
+# into the merkle root.
+
+MAGIC = b'FMSNAP\x00\x01'
+VERSION = 3
+
+FILE_HEADER = struct.Struct('<8sH32sIdIQ')
+TRAILER = struct.Struct('<QQQ32s8s')
+RECORD_LENGTH = struct.Struct('<I')
+OFFSET = struct.Struct('<Q')
+COUNT = struct.Struct('<I')
+# ids and addresses come from clients with no length limit
+STRING_LENGTH = struct.Struct('<I')
+
+# index, timestamp, previous hash, merkle root, state root, target, nonce, hash, transactions, deltas, balances
+# (NO_BALANCES for a block that is not a checkpoint)
+BLOCK_HEADER = struct.Struct('<QQ32s32s32s32sQ32sIII')
+NO_BALANCES = 0xFFFFFFFF
+
+# id length, sender, receiver, whether the amount is an int, amount; the ids follow the entries
+TRANSACTION = struct.Struct('<IIIBd')
+
+# address, whether the amount is an int, amount
+AMOUNT = struct.Struct('<IBd')
+
+# ints are stored as doubles, so they must be exact as one
+MAX_EXACT_INT = 2 ** 53
+
+# the export is handed out in chunks of about this size
+CHUNK_SIZE = 1024 * 1024
+
+
+# what a snapshot restored: the chain rules it was taken with, its height and the balances at that height
+class SnapshotInfo(NamedTuple):
+    rules: ChainRules
+    height: int
+    balances: Dict[str, float]
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# encoding
+
+# number of every address, in order of first use
+class _Addresses(dict):
+    def __missing__(self, address):
+        self[address] = len(self)
+        return self[address]
+
+
+def _is_int(amount):
+    if isinstance(amount, int):
+        if abs(amount) > MAX_EXACT_INT:
+            raise ValueError(f"Amount {amount} is too large for a snapshot")
+        return True
+    return False
+
+
+def _pack_amounts(buffer, amounts, addresses):
+    for address, amount in amounts.items():
+        buffer += AMOUNT.pack(addresses[address], _is_int(amount), amount)
+
+
+def encode_block(block: Block, addresses) -> bytes:
+    header = block.header
+    buffer = bytearray(BLOCK_HEADER.pack(
+        header.index, header.timestamp, header.previous_hash, header.merkle_root, header.state_root,
+        header.target.to_bytes(32, 'big'), block.nonce, block.hash, len(block.transactions), len(block.deltas),
+        NO_BALANCES if block.balances is None else len(block.balances)))
+    ids = [transaction.id.encode() for transaction in block.transactions]
+    for transaction, transaction_id in zip(block.transactions, ids):
+        buffer += TRANSACTION.pack(len(transaction_id), addresses[transaction.sender], addresses[transaction.receiver],
+                                   _is_int(transaction.amount), transaction.amount)
+    buffer += b''.join(ids)
+    _pack_amounts(buffer, block.deltas, addresses)
+    if block.balances is not None:
+        _pack_amounts(buffer, block.balances, addresses)
+    return bytes(buffer)
+
+
+def _pack_addresses(buffer, addresses):
+    buffer += COUNT.pack(len(addresses))
+    for address in addresses:
+        encoded = address.encode()
+        buffer += STRING_LENGTH.pack(len(encoded))
+        buffer += encoded
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# decoding
+
+def _unpack_amounts(data, position, count, names):
+    end = position + count * AMOUNT.size
+    return {names[address]: int(amount) if is_int else amount
+            for address, is_int, amount in AMOUNT.iter_unpack(data[position:end])}, end
+
+
+# the record starts at `offset` of `data`
+def decode_block(data: bytes, names, offset: int = 0) -> Block:
+    (index, timestamp, previous_hash, root, state_root, target, nonce, hash,
+     transactions, deltas, balances) = BLOCK_HEADER.unpack_from(data, offset)
+    position = offset + BLOCK_HEADER.size + transactions * TRANSACTION.size
+    entries = TRANSACTION.iter_unpack(data[offset + BLOCK_HEADER.size:position])
+
+    block_transactions = []
+    for length, sender, receiver, is_int, amount in entries:
+        transaction_id = data[position:position + length].decode()
+        position += length
+        block_transactions.append(Transaction(transaction_id, names[sender], names[receiver],
+                                              int(amount) if is_int else amount))
+
+    block_deltas, position = _unpack_amounts(data, position, deltas, names)
+    block_balances = None
+    if balances != NO_BALANCES:
+        block_balances, position = _unpack_amounts(data, position, balances, names)
+    return Block(BlockHeader(index, timestamp, previous_hash, root, state_root, int.from_bytes(target, 'big')),
+                 block_transactions, nonce, hash, block_deltas, block_balances)
+
+
+def _unpack_addresses(data):
+    count, = COUNT.unpack_from(data)
+    names = []
+    position = COUNT.size
+    for _ in range(count):
+        length, = STRING_LENGTH.unpack_from(data, position)
+        position += STRING_LENGTH.size
+        names.append(data[position:position + length].decode())
+        position += length
+    return names
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# export
+
+# THE SNAPSHOT OF THE CHAIN AS IT IS NOW, as chunks of bytes (for a file or a streamed response)
+# The height is fixed when the export starts, blocks appended meanwhile are not part of it. The chain is read while
+# the writer keeps working: when a reorg replaces exported blocks the export stops with RuntimeError, rather than
+# mixing two branches (a client then gets a short file, which fails its checksum).
+def snapshot_chunks(blockchain):
+    height = len(blockchain.chain)
+    rules = blockchain.rules()
+    digest = hashlib.sha256()
+    addresses = _Addresses()
+    offsets = bytearray()
+    buffer = bytearray(FILE_HEADER.pack(MAGIC, VERSION, rules.initial_target.to_bytes(32, 'big'),
+                                        rules.retarget_interval, rules.block_interval, rules.checkpoint_interval,
+                                        height))
+    written = 0
+
+    previous_hash = GENESIS_PREVIOUS_HASH
+    for position in range(height):
+        block = blockchain.chain[position]
+        if block.previous_hash != previous_hash:
+            raise RuntimeError(f"The chain was reorganized at height {position + 1} during the export")
+        previous_hash = block.hash
+        record = encode_block(block, addresses)
+        offsets += OFFSET.pack(written + len(buffer))
+        buffer += RECORD_LENGTH.pack(len(record))
+        buffer += record
+        if len(buffer) >= CHUNK_SIZE:
+            digest.update(buffer)
+            written += len(buffer)
+            yield bytes(buffer)
+            buffer.clear()
+
+    balances = blockchain.balances_at(height)
+    if height and blockchain.chain[height - 1].hash != previous_hash:
+        raise RuntimeError(f"The chain was reorganized below height {height} during the export")
+    # the state may name addresses no record used yet, they are numbered before the table is written
+    for address in balances:
+        addresses[address]
+    addresses_offset = written + len(buffer)
+    _pack_addresses(buffer, addresses)
+    state_offset = written + len(buffer)
+    buffer += COUNT.pack(len(balances))
+    _pack_amounts(buffer, balances, addresses)
+    index_offset = written + len(buffer)
+    buffer += offsets
+    digest.update(buffer)
+    buffer += TRAILER.pack(index_offset, addresses_offset, state_offset, digest.digest(), MAGIC)
+    yield bytes(buffer)
+
+
+# WRITE A SNAPSHOT TO `path` (through a temporary file, so a crash never leaves half a snapshot behind)
+def export_snapshot(blockchain, path):
+    with open(path + '.tmp', 'wb') as file:
+        for chunk in snapshot_chunks(blockchain):
+            file.write(chunk)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# ---------------------------------------------------------------------------------------------------------------
+# import
+
+# APPEND THE BLOCKS OF A SNAPSHOT TO `chain` (an empty list or ChainStore), without re-mining anything
+# The checksum is verified before anything is appended. Every block is then checked like the audit does (links,
+# hash and proof-of-work, target, timestamp, merkle and state roots, balance changes and checkpoints), and the
+# balances replayed from the deltas must match the state the snapshot was taken with. With `rules`, a snapshot
+# taken with other chain rules is refused before anything is read. Raises ValueError otherwise, after dropping
+# whatever was appended.
+# `trusted=True` is for a snapshot from a node one trusts (one's own export): only the checksum, the links between
+# the blocks and the replayed balances are checked, no header or merkle root is hashed again. The checksum is part
+# of the file, so it catches a corrupt file, not a forged one.
+def restore_snapshot(path, chain, rules: Optional[ChainRules] = None, trusted: bool = False) -> SnapshotInfo:
+    if len(chain):
+        raise ValueError("A snapshot can only be restored into an empty chain")
+
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size < FILE_HEADER.size + TRAILER.size:
+            raise ValueError("Not a snapshot: file too short")
+        file.seek(size - TRAILER.size)
+        index_offset, addresses_offset, state_offset, checksum, magic = TRAILER.unpack(file.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Not a snapshot: bad magic")
+
+        file.seek(0)
+        magic, version, initial_target, retarget_interval, block_interval, checkpoint_interval, height = \
+            FILE_HEADER.unpack(file.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        snapshot_rules = ChainRules(int.from_bytes(initial_target, 'big'), retarget_interval, block_interval,
+                                    checkpoint_interval)
+        if rules is not None and snapshot_rules != rules:
+            raise ValueError(f"Snapshot was taken with {snapshot_rules}, this chain runs with {rules}")
+
+        file.seek(0)
+        digest = hashlib.sha256()
+        remaining = size - TRAILER.size
+        while remaining:
+            chunk = file.read(min(CHUNK_SIZE, remaining))
+            digest.update(chunk)
+            remaining -= len(chunk)
+        if digest.digest() != checksum:
+            raise ValueError("Snapshot checksum does not match, the file is corrupt")
+
+        file.seek(addresses_offset)
+        names = _unpack_addresses(file.read(state_offset - addresses_offset))
+        count, = COUNT.unpack(file.read(COUNT.size))
+        state, _ = _unpack_amounts(file.read(index_offset - state_offset - COUNT.size), 0, count, names)
+        offsets = [offset for offset, in OFFSET.iter_unpack(file.read(height * OFFSET.size))]
+
+        balances = {}
+        # the records are decoded straight from the mapped file, without a read per record
+        records = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        end = FILE_HEADER.size
+
+        # every block is appended as it is decoded and handed to the audit, which checks it from scratch
+        def blocks():
+            nonlocal end
+            for position in range(height):
+                if end != offsets[position]:
+                    raise ValueError(f"Snapshot index does not match the record of block {position + 1}")
+                length, = RECORD_LENGTH.unpack_from(records, end)
+                end += RECORD_LENGTH.size + length
+                if end > addresses_offset:
+                    raise ValueError(f"Record of block {position + 1} runs past the records")
+                block = decode_block(records, names, end - length)
+                for address, delta in block.deltas.items():
+                    balances[address] = balances.get(address, 0) + delta
+                chain.append(block)
+                yield block.hash, block
+
+        try:
+            if trusted:
+                previous_hash = GENESIS_PREVIOUS_HASH
+                for position, (_, block) in enumerate(blocks(), start=1):
+                    if block.index != position or block.previous_hash != previous_hash:
+                        raise ValueError(f"Block {position} of the snapshot does not follow the block before")
+                    previous_hash = block.hash
+            else:
+                _, problems = audit_blocks(blocks(), 1, height, snapshot_rules)
+                if problems:
+                    raise ValueError(f"Block {problems[0]['index']} of the snapshot is invalid: "
+                                     f"{problems[0]['error']}")
+            if end != addresses_offset:
+                raise ValueError("Snapshot records do not end where the trailer says")
+            if state != balances:
+                raise ValueError("Balances replayed from the snapshot do not match its account state")
+        except BaseException:
+            if isinstance(chain, ChainStore):
+                chain.truncate(0)
+            else:
+                del chain[:]
+            raise
+        finally:
+            records.close()
+
+    return SnapshotInfo(snapshot_rules, height, state)
+
+
+# RESTORE A SNAPSHOT AS THE CHAIN STORED IN `directory`, unless that directory already holds a chain (None then)
+# The blocks go to a staging directory next to it, which replaces `directory` only once every block checked out:
+# a bad snapshot, or a restore cut short, leaves no half-restored chain behind.
+def restore_snapshot_directory(path, directory, rules: Optional[ChainRules] = None,
+                               trusted: bool = False) -> Optional[SnapshotInfo]:
+    if os.path.isdir(directory):
+        store = ChainStore(directory)
+        length = len(store)
+        store.close()
+        if length:
+            return None
+
+    staging = directory.rstrip(os.sep) + '.restoring'
+    shutil.rmtree(staging, ignore_errors=True)
+    store = ChainStore(staging, sync_every=10_000, sync_interval=60)
+    try:
+        info = restore_snapshot(path, store, rules, trusted)
+        store.bind_rules(info.rules._asdict())
+    except BaseException:
+        store.close()
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    store.close()
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    parent = os.open(os.path.dirname(os.path.abspath(directory)), os.O_RDONLY)
+    try:
+        os.fsync(parent)
+    finally:
+        os.close(parent)
+    return info
+
+
+# A BLOCKCHAIN LOADED FROM A SNAPSHOT, with the rules the snapshot was taken with
+# `store` is an empty ChainStore to restore into (in memory when None); `options` go to the Blockchain.
+def import_snapshot(path, store=None, trusted=False, **options) -> Blockchain:
+    chain = store if store is not None else []
+    info = restore_snapshot(path, chain, trusted=trusted)
+    return Blockchain(store=chain, initial_target=info.rules.initial_target,
+                      retarget_interval=info.rules.retarget_interval, block_interval=info.rules.block_interval,
+                      checkpoint_interval=info.rules.checkpoint_interval, **options)
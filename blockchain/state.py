@@ -0,0 +1,60 @@
+from bisect import bisect_right
+from typing import Dict, Optional
+
+
+class AccountState:
+    """Live index of account balances, updated once per appended block.
+
+    `balances` holds the balance of every address at the chain tip. For lookups at an older height every
+    address also keeps the heights at which its balance changed, so a historical read is a binary search
+    over that address' own changes.
+    """
+
+    def __init__(self):
+        self.height = 0
+        # heights below this one are not covered by `history` (the index was restored from a snapshot of the tip)
+        self.base_height = 0
+        self.balances: Dict[str, float] = {}
+        # address -> (heights where the balance changed, balance from that height on)
+        self.history: Dict[str, tuple] = {}
+
+    # record the balances a block at `height` changed
+    def apply(self, height: int, changes: Dict[str, float]):
+        for address, balance in changes.items():
+            if self.balances.get(address) == balance:
+                continue
+            self.balances[address] = balance
+            heights, values = self.history.setdefault(address, ([], []))
+            heights.append(height)
+            values.append(balance)
+        self.height = height
+
+    # forget every block above `height` (the chain was cut back to it); `height` must not be below base_height
+    def rollback(self, height: int):
+        for address in list(self.history):
+            heights, values = self.history[address]
+            position = bisect_right(heights, height)
+            del heights[position:], values[position:]
+            if heights:
+                self.balances[address] = values[-1]
+            else:
+                del self.history[address]
+                self.balances.pop(address, None)
+        self.height = height
+
+    # start from the full balances at `height`, e.g. after reloading a stored chain
+    def restore(self, height: int, balances: Dict[str, float]):
+        self.height = height
+        self.base_height = height
+        self.balances = dict(balances)
+        self.history = {address: ([height], [balance]) for address, balance in balances.items()}
+
+    # balance of `address` at the tip, or right after block `height` was applied
+    def balance(self, address: str, height: Optional[int] = None) -> float:
+        if height is None or height >= self.height:
+            return self.balances.get(address, 0)
+        if address not in self.history:
+            return 0
+        heights, values = self.history[address]
+        position = bisect_right(heights, height)
+        return values[position - 1] if position else 0
@@ -0,0 +1,374 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from blockchain.block import Block
+from blockchain.encoding import load_json
+
+
+# a record in a segment: payload length, crc32 of the payload, then the block's canonical JSON
+RECORD_HEADER = struct.Struct('<II')
+
+# an entry in the offset index, one per block: segment number, record offset, block hash (32 raw bytes)
+INDEX_ENTRY = struct.Struct('<IQ32s')
+
+# a new segment file is started once the active one would grow past this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# number of decoded blocks kept in memory (the tip is what the API reads the most)
+CACHE_SIZE = 4096
+
+INDEX_FILE = 'index.bin'
+PENDING_FILE = 'pending.json'
+RULES_FILE = 'rules.json'
+
+
+def _segment_name(number):
+    return f'segment-{number:06d}.log'
+
+
+# a stored record is the block's canonical JSON, so the block keeps it as its encoded bytes
+def _decode(payload):
+    block = Block.from_dict(load_json(payload))
+    block.encoded = payload
+    return block
+
+
+class ChainStore:
+    """Durable, append-only storage of the chain that behaves like the list `Blockchain.chain` used to be.
+
+    Blocks are appended as length-prefixed, checksummed records to segment files; an offset index with one
+    fixed-size entry per block maps a height to its record. On open the index is memory-mapped, so startup
+    does not depend on the length of the chain; only the tail is checked, and a record that was torn by a
+    crash (short, or failing its checksum) is cut off together with everything after it.
+
+    Writes are flushed to the OS on every append and fsync'ed in batches: after `sync_every` blocks or
+    `sync_interval` seconds after the first unsynced one, whichever comes first, and on close. A background
+    thread takes care of the interval, so the last blocks reach the disk even when no more are appended.
+
+    One thread appends while API threads read: reads, appends and truncation hold a lock, so a reader never sees
+    the cache, the index map or a segment descriptor half changed.
+    """
+
+    def __init__(self, directory: str, sync_every: int = 64, sync_interval: float = 1.0):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._readers = {}
+        self._cache = OrderedDict()
+        self._unsynced = 0
+        self._unsynced_since = None
+        self._last_sync = time.monotonic()
+        self._closed = threading.Event()
+
+        self._index = open(os.path.join(directory, INDEX_FILE), 'a+b')
+        self._length = self._recover()
+
+        # entries present at open are read through the memory map, the ones appended later from memory
+        self._mapped = None
+        if self._length:
+            self._mapped = mmap.mmap(self._index.fileno(), self._length * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        self._mapped_length = self._length
+        self._appended = bytearray()
+
+        self._segment_number = self._entry(self._length - 1)[0] if self._length else 0
+        self._segment = open(os.path.join(directory, _segment_name(self._segment_number)), 'ab')
+
+        self._syncer = threading.Thread(target=self._sync_periodically, name='chain-store-sync', daemon=True)
+        self._syncer.start()
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    # DROP A TORN TAIL: a partial index entry, index entries whose record is missing or corrupt, and record bytes
+    # that were written without their index entry
+    def _recover(self):
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        length = os.path.getsize(index_path) // INDEX_ENTRY.size
+        self._index.truncate(length * INDEX_ENTRY.size)
+
+        while length:
+            self._index.seek((length - 1) * INDEX_ENTRY.size)
+            segment, offset, _ = INDEX_ENTRY.unpack(self._index.read(INDEX_ENTRY.size))
+            end = self._check_record(segment, offset)
+            if end is not None:
+                self._truncate_segments(segment, end)
+                break
+            length -= 1
+            self._index.truncate(length * INDEX_ENTRY.size)
+        else:
+            self._truncate_segments(0, 0)
+
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        return length
+
+    # end offset of the record at `offset`, or None when it is torn
+    def _check_record(self, segment, offset):
+        path = os.path.join(self.directory, _segment_name(segment))
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            header = file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return None
+            size, checksum = RECORD_HEADER.unpack(header)
+            payload = file.read(size)
+        if len(payload) < size or zlib.crc32(payload) != checksum:
+            return None
+        return offset + RECORD_HEADER.size + size
+
+    # keep segment `segment` up to `end` and remove every later segment
+    def _truncate_segments(self, segment, end):
+        for name in os.listdir(self.directory):
+            if not name.startswith('segment-'):
+                continue
+            number = int(name[len('segment-'):-len('.log')])
+            path = os.path.join(self.directory, name)
+            if number > segment:
+                os.remove(path)
+            elif number == segment and os.path.getsize(path) > end:
+                with open(path, 'r+b') as file:
+                    file.truncate(end)
+                    os.fsync(file.fileno())
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    def _entry(self, position):
+        if position < self._mapped_length:
+            return INDEX_ENTRY.unpack_from(self._mapped, position * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack_from(self._appended, (position - self._mapped_length) * INDEX_ENTRY.size)
+
+    def _reader(self, segment):
+        if segment not in self._readers:
+            self._readers[segment] = os.open(os.path.join(self.directory, _segment_name(segment)), os.O_RDONLY)
+        return self._readers[segment]
+
+    def _read(self, position):
+        segment, offset, _ = self._entry(position)
+        reader = self._reader(segment)
+        size, _ = RECORD_HEADER.unpack(os.pread(reader, RECORD_HEADER.size, offset))
+        return _decode(os.pread(reader, size, offset + RECORD_HEADER.size))
+
+    def _remember(self, position, block):
+        self._cache[position] = block
+        self._cache.move_to_end(position)
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(self._length))]
+        with self._lock:
+            return self._get(position)
+
+    def _get(self, position):
+        if position < 0:
+            position += self._length
+        if not 0 <= position < self._length:
+            raise IndexError('chain index out of range')
+        if position in self._cache:
+            self._cache.move_to_end(position)
+            return self._cache[position]
+        block = self._read(position)
+        self._remember(position, block)
+        return block
+
+    def __iter__(self) -> Iterator[Block]:
+        for position in range(self._length):
+            yield self[position]
+
+    # hash of the block at `position`, read from the index without decoding the block
+    def hash_at(self, position: int) -> bytes:
+        with self._lock:
+            return self._entry(position)[2]
+
+    # the raw 32-byte hashes of every block, in order, straight from the index
+    def raw_hashes(self) -> bytes:
+        with self._lock:
+            hashes = []
+            for index in (self._mapped, self._appended):
+                if index:
+                    hashes.extend(hash for _, _, hash in INDEX_ENTRY.iter_unpack(index))
+            return b''.join(hashes)
+
+    def append(self, block: Block):
+        with self._lock:
+            payload = block.encode()
+            record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+            if self._segment.tell() and self._segment.tell() + len(record) > SEGMENT_SIZE:
+                self._roll_segment()
+
+            offset = self._segment.tell()
+            self._segment.write(record)
+            self._segment.flush()
+
+            # the index entry goes after the record, so a crash in between leaves a record that _recover drops
+            entry = INDEX_ENTRY.pack(self._segment_number, offset, block.hash)
+            self._index.seek(0, os.SEEK_END)
+            self._index.write(entry)
+            self._index.flush()
+            self._appended += entry
+
+            self._remember(self._length, block)
+            self._length += 1
+
+            self._unsynced += 1
+            if self._unsynced_since is None:
+                self._unsynced_since = time.monotonic()
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self.sync()
+
+    def _roll_segment(self):
+        self.sync()
+        self._segment.close()
+        self._segment_number += 1
+        self._segment = open(os.path.join(self.directory, _segment_name(self._segment_number)), 'ab')
+
+    # DROP EVERY BLOCK FROM POSITION `length` ON (a peer's longer branch replaces them)
+    def truncate(self, length: int):
+        with self._lock:
+            if length >= self._length:
+                return
+            self.sync()
+            segment, offset = self._entry(length)[:2]
+
+            if self._mapped is not None:
+                self._mapped.close()
+                self._mapped = None
+            self._segment.close()
+            for number in [number for number in self._readers if number >= segment]:
+                os.close(self._readers.pop(number))
+
+            self._index.truncate(length * INDEX_ENTRY.size)
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            self._truncate_segments(segment, offset)
+
+            self._length = length
+            if length:
+                self._mapped = mmap.mmap(self._index.fileno(), length * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+            self._mapped_length = length
+            self._appended = bytearray()
+            for position in [position for position in self._cache if position >= length]:
+                del self._cache[position]
+
+            self._segment_number = segment
+            self._segment = open(os.path.join(self.directory, _segment_name(segment)), 'ab')
+
+    # force every appended block to disk
+    def sync(self):
+        with self._lock:
+            os.fsync(self._segment.fileno())
+            os.fsync(self._index.fileno())
+            self._unsynced = 0
+            self._unsynced_since = None
+            self._last_sync = time.monotonic()
+
+    # FSYNC THE BLOCKS LEFT UNSYNCED FOR `sync_interval` SECONDS, until the store is closed
+    def _sync_periodically(self):
+        while True:
+            since = self._unsynced_since
+            delay = self.sync_interval if since is None else since + self.sync_interval - time.monotonic()
+            if self._closed.wait(max(delay, 0.0)):
+                return
+            with self._lock:
+                if self._closed.is_set():
+                    return
+                if self._unsynced_since is not None and \
+                        time.monotonic() - self._unsynced_since >= self.sync_interval:
+                    self.sync()
+
+    # ---------------------------------------------------------------------------------------------------------------
+
+    # THE CHAIN RULES THE BLOCKS OF THE STORE ARE BUILT WITH (checkpoint and retarget intervals, block interval,
+    # initial target), as a dict
+    # The first call writes them next to the blocks; every later call, after any restart, must pass the same ones:
+    # the checkpoints and targets of the stored blocks only check out under those rules. Raises ValueError
+    # otherwise. A store written before the rules were recorded takes the rules of its first call.
+    def bind_rules(self, rules: dict):
+        path = os.path.join(self.directory, RULES_FILE)
+        if os.path.exists(path):
+            with open(path) as file:
+                stored = json.load(file)
+            if stored != rules:
+                changed = ', '.join(f"{name} {stored.get(name)} -> {rules.get(name)}"
+                                    for name in sorted(stored.keys() | rules.keys())
+                                    if stored.get(name) != rules.get(name))
+                raise ValueError(f"The chain in {self.directory} was built with other chain rules ({changed})")
+            return
+        with open(path + '.tmp', 'w') as file:
+            json.dump(rules, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    # PENDING TRANSACTIONS AND BALANCES, written on shutdown so a restart does not lose them
+    def save_pending(self, pending: dict):
+        path = os.path.join(self.directory, PENDING_FILE)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(pending, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    # the pending state saved by the last shutdown (removed once read), or None
+    def load_pending(self) -> Optional[dict]:
+        path = os.path.join(self.directory, PENDING_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            pending = json.load(file)
+        os.remove(path)
+        return pending
+
+    def close(self):
+        with self._lock:
+            if self._closed.is_set():
+                return
+            self._closed.set()
+            self.sync()
+            self._segment.close()
+            for reader in self._readers.values():
+                os.close(reader)
+            self._readers.clear()
+            if self._mapped is not None:
+                self._mapped.close()
+            self._index.close()
+
+
+# READ THE BLOCKS AT HEIGHTS [first, last] STRAIGHT FROM THE FILES OF A CHAIN DIRECTORY
+# Yields (hash in the index, block). Nothing is written, so another process (the audit workers) can read a chain
+# that is being appended to; a record that fails its checksum raises ValueError.
+def scan_blocks(directory: str, first: int, last: int):
+    readers = {}
+    try:
+        with open(os.path.join(directory, INDEX_FILE), 'rb') as index:
+            for height in range(first, last + 1):
+                entry = os.pread(index.fileno(), INDEX_ENTRY.size, (height - 1) * INDEX_ENTRY.size)
+                segment, offset, hash = INDEX_ENTRY.unpack(entry)
+                if segment not in readers:
+                    readers[segment] = os.open(os.path.join(directory, _segment_name(segment)), os.O_RDONLY)
+                size, checksum = RECORD_HEADER.unpack(os.pread(readers[segment], RECORD_HEADER.size, offset))
+                payload = os.pread(readers[segment], size, offset + RECORD_HEADER.size)
+                if zlib.crc32(payload) != checksum:
+                    raise ValueError(f"The record of block {height} does not match its checksum")
+                yield hash, _decode(payload)
+    finally:
+        for reader in readers.values():
+            os.close(reader)
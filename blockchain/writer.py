@@ -0,0 +1,70 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+
+# tells the owner thread to stop once every command queued before it has run
+_STOP = object()
+
+
+class ChainWriter:
+    """The single owner of every change to a Blockchain.
+
+    API handlers, the mining job thread and startup/shutdown do not touch the pending pool or the chain
+    themselves: they queue a command (a Blockchain method and its arguments) and get a Future that is answered
+    with the method's result or exception. One thread runs the commands one after the other, so no two changes
+    interleave and a batch submitted as one command is applied as a whole.
+
+    Proof-of-work does not run here: prepare_block only swaps the mempool's buffers (the pending transactions
+    move to the block being mined, new submissions go to a fresh pool), so submissions are answered at full
+    speed while a block is mined. Every queued command is answered: when the queue is full submit raises
+    OverflowError, after stop it raises RuntimeError, and stop waits for the commands already queued.
+    """
+
+    def __init__(self, blockchain, capacity: int = 10_000):
+        self.blockchain = blockchain
+        self.commands = queue.Queue(maxsize=capacity)
+        self._accepting = True
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="chain-writer", daemon=True)
+        self._thread.start()
+
+    # QUEUE `function(*args, **kwargs)` TO RUN ON THE OWNER THREAD
+    def submit(self, function, *args, **kwargs) -> Future:
+        future = Future()
+        with self._lock:
+            if not self._accepting:
+                raise RuntimeError("The chain writer is stopped")
+            try:
+                self.commands.put_nowait((future, function, args, kwargs))
+            except queue.Full:
+                raise OverflowError(f"The chain writer is busy ({self.commands.maxsize} queued commands)")
+        return future
+
+    # run a command and wait for its result (re-raises the command's exception)
+    def call(self, function, *args, **kwargs):
+        return self.submit(function, *args, **kwargs).result()
+
+    # run the commands already queued, refuse new ones and wait for the owner thread to exit
+    def stop(self, timeout: float = 10):
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+        self.commands.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            command = self.commands.get()
+            if command is _STOP:
+                return
+            future, function, args, kwargs = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
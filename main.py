@@ -1,5 +1,6 @@
 from dotenv.parser import Position
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from geoalchemy2 import WKTElement
 from geoalchemy2.functions import ST_DWithin, ST_GeogFromWKB, ST_SetSRID
 from geoalchemy2.shape import from_shape
@@ -8,16 +9,63 @@ from sqlalchemy import select, and_, func
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from authentication.authentication import router as user_router
-from blockchain.Blockchain import Blockchain
-from blockchain.blockchain_DTO import TransactionRequest, BalanceRequest
-from database.geodb import get_async_session
-import copy
+from blockchain.Blockchain import Blockchain, ChainRules
+from blockchain.audit import RANGE_SIZE, audit_chain
+from blockchain.difficulty import DEFAULT_TARGET
+from blockchain.mempool import Mempool
+from blockchain.merkle import merkle_proof
+from blockchain.peers import PeerSync
+from blockchain.mining_jobs import MiningJobManager
+from blockchain.snapshot import restore_snapshot_directory, snapshot_chunks
+from blockchain.storage import ChainStore
+from blockchain.writer import ChainWriter
+from blockchain.encoding import canonical_json
+from blockchain.blockchain_DTO import TransactionRequest, BalanceRequest, PeerRequest
+from database.geodb import async_session_maker, get_async_session
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
 from model.User import User
 from model.Camp import Camp, NearbyCampSchema, CreateCampSchema, CampResponseSchema
-from service.service import is_camp_table_empty, wkb_to_coordinates
+from service.camp_import import CampRows, import_csv, stream_batches
+from service.camp_index import CampEntry, CampIndex
+from service.service import (camp_page, geography, is_camp_table_empty, load_camp_index, nearest_camps, select_camps,
+                             wkb_to_coordinates)
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # put back the pending transactions and balances saved by the last shutdown
+    pending = chain_store.load_pending()
+    if pending:
+        rejected = chain_writer.call(blockchain.restore_pending, pending)
+        if rejected:
+            logger.warning("Dropped %d saved pending transactions that are no longer valid", len(rejected))
+
+    peer_sync.start()
+
+    # radius and nearest-camp queries are answered from memory once the camps are loaded, by PostGIS until then
+    refresh = asyncio.create_task(refresh_camp_index())
+
+    yield
+
+    refresh.cancel()
+    peer_sync.stop()
+    # a block that is being mined is abandoned, its transactions are saved with the rest of the pending pool
+    mining_jobs.shutdown()
+    chain_store.save_pending(chain_writer.call(blockchain.pending_snapshot))
+    chain_writer.stop()
+    chain_store.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(user_router)
 
@@ -32,15 +80,75 @@ async def say_hello(name: str):
     return {"message": f"Hello {name}"}
 
 
+# camps are listed in pages of at most CAMPS_MAX_LIMIT, ordered by id; `next_cursor` is the opaque token of the
+# next page (None on the last one). `city` and `bbox` (min_lon,min_lat,max_lon,max_lat) narrow the listing.
+CAMPS_MAX_LIMIT = 1000
+
+
+# opaque pagination token: the camp id the next page continues after
+def encode_camp_cursor(camp_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'after_id': camp_id}).encode()).decode().rstrip('=')
+
+
+def decode_camp_cursor(cursor: str) -> int:
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))['after_id'])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# the (after_id, bbox) of a camp listing request, 400 when they do not make sense
+def camp_page_arguments(limit: int, cursor: Optional[str], bbox: Optional[str]):
+    if not 1 <= limit <= CAMPS_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {CAMPS_MAX_LIMIT}")
+    after_id = decode_camp_cursor(cursor) if cursor is not None else 0
+    return after_id, parse_bbox(bbox)
+
+
+# min_lon,min_lat,max_lon,max_lat as a tuple of floats, 400 when it is not one
+def parse_bbox(bbox: Optional[str]):
+    if bbox is None:
+        return None
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(value) for value in bbox.split(','))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be min_lon,min_lat,max_lon,max_lat")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise HTTPException(status_code=400, detail="bbox minimums must not exceed its maximums")
+    return min_lon, min_lat, max_lon, max_lat
+
+
 # load camps endpoint
 @app.get("/load-camps")
-async def load_camps(db_session: AsyncSession = Depends(get_async_session)):
+async def load_camps(
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        city: Optional[str] = None,
+        bbox: Optional[str] = None,
+        db_session: AsyncSession = Depends(get_async_session)
+):
+    after_id, box = camp_page_arguments(limit, cursor, bbox)
     try:
-        # Query all camps
-        result = await db_session.execute(select(Camp))
-        camps = result.scalars().all()  # Extract all Camp objects
+        # Query one page of camps, with their position as (latitude, longitude)
+        camps, next_id = await camp_page(
+            db_session,
+            (Camp.id, Camp.camp_name, Camp.city,
+             func.ST_Y(Camp.geo_location).label("latitude"), func.ST_X(Camp.geo_location).label("longitude")),
+            after_id, limit, city, box
+        )
 
-        return camps  # Return the list of camps
+        return {
+            "camps": [
+                {
+                    "id": camp.id,
+                    "camp_name": camp.camp_name,
+                    "city": camp.city,
+                    "geo_location": (camp.latitude, camp.longitude),
+                }
+                for camp in camps
+            ],
+            "next_cursor": encode_camp_cursor(next_id) if next_id is not None else None,
+        }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading camps: {str(e)}")
@@ -60,6 +168,16 @@ async def get_nearby_camps_by_details(
         nearby_camps_schema.km_within
     )
 
+    # answered from the camp index when it is loaded
+    if camp_index.loaded:
+        target = camp_index.find(city, camp_name)
+        if not target:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Camp with provided details was not found",
+            )
+        return [camp.camp_name for camp, _ in camp_index.within(target.latitude, target.longitude, 1000 * km_within)]
+
     # Check if the target camp exists and retrieve its geography
     target_camp_query = select(Camp).where(
         and_(Camp.city == city, Camp.camp_name == camp_name)
@@ -119,6 +237,10 @@ async def create_camp(
             city=new_camp.city,
             geo_location=wkb_to_coordinates(new_camp.geo_location)
         )
+
+        # the camp is committed: nearby queries answered from memory see it from now on
+        if camp_index.loaded:
+            camp_index.add(CampEntry(new_camp.id, new_camp.camp_name, new_camp.city, *response_data.geo_location))
         return response_data  # Return the created camp
 
     except SQLAlchemyError as e:
@@ -128,23 +250,47 @@ async def create_camp(
         raise HTTPException(status_code=400, detail=f"Error: {str(e)}")
 
 
+# import camps endpoint
+# the body is a places CSV such as us_cities.csv (Content-Type: text/csv), streamed into the camp table with COPY;
+# with defer_index=true the spatial index is rebuilt once after the load instead of row by row
+
+@app.post("/import-camps")
+async def import_camps_csv(request: Request, defer_index: bool = False):
+    rows = CampRows()
+    try:
+        report = await import_csv(stream_batches(request.stream(), rows), rows, defer_index)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error importing camps: {str(e)}")
+
+    # the index is filled again from the table rather than row by row
+    if camp_index.loaded and report['imported']:
+        async with async_session_maker() as session:
+            await load_camp_index(session, camp_index)
+    return report
+
+
 # get all camps
 
 @app.get("/get_all_camps")
-async def get_all_camps(db_session: AsyncSession = Depends(get_async_session)):
+async def get_all_camps(
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        city: Optional[str] = None,
+        bbox: Optional[str] = None,
+        db_session: AsyncSession = Depends(get_async_session)
+):
+    after_id, box = camp_page_arguments(limit, cursor, bbox)
     try:
-        # Query to select camps and extract their geography
-        result = await db_session.execute(
-            select(
-                Camp.id,
-                Camp.camp_name,
-                Camp.city,
-                func.ST_AsGeoJSON(func.ST_GeogFromWKB(Camp.geo_location)).label("geojson")
-            )
+        # Query one page of camps and extract their geography
+        camps, next_id = await camp_page(
+            db_session,
+            (Camp.id, Camp.camp_name, Camp.city,
+             func.ST_AsGeoJSON(func.ST_GeogFromWKB(Camp.geo_location)).label("geojson")),
+            after_id, limit, city, box
         )
 
-        camps = result.all()
-
         # Transform the query result into a list of dictionaries
         camps_data = [
             {
@@ -156,11 +302,105 @@ async def get_all_camps(db_session: AsyncSession = Depends(get_async_session)):
             for camp in camps
         ]
 
-        return camps_data
+        return {"camps": camps_data, "next_cursor": encode_camp_cursor(next_id) if next_id is not None else None}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
 
+# export camps endpoint
+# every camp (of `city`, inside `bbox`) as NDJSON, one camp per line, or as a GeoJSON FeatureCollection
+# (format=geojson). Rows are fetched EXPORT_BATCH at a time through a server-side cursor and sent as they come,
+# so the first bytes leave before the query is done and the server never holds more than one batch.
+EXPORT_BATCH = 1000
+
+
+@app.get("/export-camps")
+async def export_camps(format: str = "ndjson", city: Optional[str] = None, bbox: Optional[str] = None):
+    if format not in ("ndjson", "geojson"):
+        raise HTTPException(status_code=400, detail="format must be ndjson or geojson")
+    query = select_camps(
+        (Camp.id, Camp.camp_name, Camp.city,
+         func.ST_Y(Camp.geo_location).label("latitude"), func.ST_X(Camp.geo_location).label("longitude")),
+        city, parse_bbox(bbox)
+    ).execution_options(yield_per=EXPORT_BATCH)
+
+    def line(camp):
+        return canonical_json({"id": camp.id, "camp_name": camp.camp_name, "city": camp.city,
+                               "geo_location": (camp.latitude, camp.longitude)}) + b"\n"
+
+    def feature(camp):
+        return canonical_json({"type": "Feature", "id": camp.id,
+                               "geometry": {"type": "Point", "coordinates": (camp.longitude, camp.latitude)},
+                               "properties": {"camp_name": camp.camp_name, "city": camp.city}})
+
+    # the session lives as long as the response: it is opened here rather than taken from get_async_session,
+    # whose session is closed before a streamed body is sent
+    async def body():
+        async with async_session_maker() as session:
+            result = await session.stream(query)
+            if format == "ndjson":
+                async for camps in result.partitions():
+                    yield b"".join(line(camp) for camp in camps)
+                return
+
+            yield b'{"type":"FeatureCollection","features":['
+            separator = b""
+            async for camps in result.partitions():
+                yield separator + b",".join(feature(camp) for camp in camps)
+                separator = b","
+            yield b"]}"
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/geo+json"
+    return StreamingResponse(body(), media_type=media_type)
+
+
+# nearest camps endpoint
+# the k camps nearest to a point (latitude and longitude), to a camp (camp_id) or to a user's current position
+# (user_id), nearest first, with their distance in metres on the sphere
+
+NEAREST_CAMPS_MAX_K = 100
+
+
+@app.get("/nearest-camps")
+async def get_nearest_camps(
+        k: int = 5,
+        latitude: Optional[float] = None,
+        longitude: Optional[float] = None,
+        camp_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+        db_session: AsyncSession = Depends(get_async_session)
+):
+    point = latitude is not None and longitude is not None
+    if point + (camp_id is not None) + (user_id is not None) != 1:
+        raise HTTPException(status_code=400, detail="Give exactly one of latitude and longitude, camp_id or user_id")
+    if point and not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise HTTPException(status_code=400, detail="latitude or longitude is out of range")
+    if not 1 <= k <= NEAREST_CAMPS_MAX_K:
+        raise HTTPException(status_code=400, detail=f"k must be between 1 and {NEAREST_CAMPS_MAX_K}")
+
+    try:
+        camps = await nearest_camps(db_session, k, latitude, longitude, camp_id, user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+    if camps is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Camp not found" if camp_id is not None else "User not found or position not set.")
+
+    return {
+        "nearest_camps": [
+            {
+                "id": camp.id,
+                "camp_name": camp.camp_name,
+                "city": camp.city,
+                "geo_location": (camp.latitude, camp.longitude),
+                "distance": camp.distance,  # metres
+            }
+            for camp in camps
+        ]
+    }
+
 
 # get camp by id
 
@@ -211,6 +451,20 @@ async def get_nearby_camps(user_id: int, radius: float = 10, db: AsyncSession =
         if not user_position:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or position not set.")
 
+        # answered from the camp index when it is loaded
+        if camp_index.loaded:
+            latitude, longitude = wkb_to_coordinates(user_position)
+            result = [
+                {
+                    "id": camp.id,
+                    "camp_name": camp.camp_name,
+                    "city": camp.city,
+                    "geojson": camp.geojson()
+                }
+                for camp, _ in camp_index.within(latitude, longitude, radius)
+            ]
+            return {"user_id": user_id, "nearby_camps": result}
+
         # Query nearby camps within the specified radius
         query = await db.execute(
             select(
@@ -220,8 +474,8 @@ async def get_nearby_camps(user_id: int, radius: float = 10, db: AsyncSession =
                 func.ST_AsGeoJSON(Camp.geo_location).label("geojson")
             ).where(
                 ST_DWithin(
-                    Camp.geo_location,
-                    func.ST_SetSRID(user_position, 4326),
+                    geography(Camp.geo_location),
+                    geography(func.ST_SetSRID(user_position, 4326)),
                     radius
                 )
             )
@@ -255,12 +509,17 @@ def add_balance(balance_data: BalanceRequest):
     if 'receiver' not in data or 'amount' not in data:
         raise HTTPException(status_code=400, detail="Invalid transaction data")
 
-    # the amount should be more than 0
-    if data['amount'] <= 0:
-        raise HTTPException(status_code=400, detail="Balance must be greater than zero")
+    # the amount should be a number (not NaN or infinity) more than 0
+    if not math.isfinite(data['amount']) or data['amount'] <= 0:
+        raise HTTPException(status_code=400, detail="Balance must be a finite number greater than zero")
 
     # Add the balances to the current list of balances in order to be included in the next mined block
-    index = blockchain.add_balance(data['receiver'], data['amount'])
+    try:
+        index = chain_writer.call(blockchain.add_balance, data['receiver'], data['amount'])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
     response = {'message': f'Balance added to block {index}'}
     return response
 
@@ -268,57 +527,522 @@ def add_balance(balance_data: BalanceRequest):
 # -----------------------------------------------------------------------------------------------------------------------------
 
 
-blockchain = Blockchain()
+# number of processes used for the proof-of-work search (defaults to every core, 1 = single process)
+# every CHECKPOINT_INTERVAL-th block carries the full balances, the others only their balance changes;
+# every RETARGET_INTERVAL blocks the target is adjusted so a block takes about BLOCK_INTERVAL seconds to mine
+chain_rules = ChainRules(initial_target=DEFAULT_TARGET,
+                         retarget_interval=int(os.getenv("RETARGET_INTERVAL", "10")),
+                         block_interval=float(os.getenv("BLOCK_INTERVAL", "60")),
+                         checkpoint_interval=int(os.getenv("CHECKPOINT_INTERVAL", "100")))
+
+# the chain is kept on disk in CHAIN_DATA_DIR, so it survives restarts (and --reload)
+CHAIN_DATA_DIR = os.getenv("CHAIN_DATA_DIR", "chain_data")
+
+# a new node can start from a snapshot exported by another one (GET /snapshot) instead of an empty chain; the
+# snapshot must have been taken with the same chain rules, and the node does not start when it does not check out;
+# RESTORE_SNAPSHOT_TRUSTED=1 skips re-hashing every block, for a snapshot the operator exported themselves
+if os.getenv("RESTORE_SNAPSHOT"):
+    restored = restore_snapshot_directory(os.getenv("RESTORE_SNAPSHOT"), CHAIN_DATA_DIR, chain_rules,
+                                          trusted=os.getenv("RESTORE_SNAPSHOT_TRUSTED", "0") == "1")
+    if restored is not None:
+        print(f"Restored {restored.height} blocks from {os.getenv('RESTORE_SNAPSHOT')}")
+
+chain_store = ChainStore(CHAIN_DATA_DIR)
+
+# at most MEMPOOL_CAPACITY transactions wait for a block, MEMPOOL_EVICTION says what happens when it is full
+# ('reject' the new transaction or evict the 'oldest' one)
+blockchain = Blockchain(mining_workers=int(os.getenv("MINING_WORKERS", "0")) or None,
+                        checkpoint_interval=chain_rules.checkpoint_interval,
+                        store=chain_store,
+                        initial_target=chain_rules.initial_target,
+                        retarget_interval=chain_rules.retarget_interval,
+                        block_interval=chain_rules.block_interval,
+                        mempool=Mempool(capacity=int(os.getenv("MEMPOOL_CAPACITY", "100000")),
+                                        eviction=os.getenv("MEMPOOL_EVICTION", "reject")))
+
+# every change to the pending pool and the chain runs on the writer's thread, one command at a time; at most
+# CHAIN_WRITER_QUEUE commands wait for it, more are answered with 503
+chain_writer = ChainWriter(blockchain, capacity=int(os.getenv("CHAIN_WRITER_QUEUE", "10000")))
+
+# runs /mine_block in a separate process; a job that mines longer than MINING_JOB_TIMEOUT seconds is stopped
+mining_jobs = MiningJobManager(blockchain, chain_writer, timeout=float(os.getenv("MINING_JOB_TIMEOUT", "600")))
+
+# other nodes to keep the chain in line with (comma-separated base URLs in PEERS), polled every SYNC_INTERVAL seconds
+peer_sync = PeerSync(blockchain, chain_writer,
+                     peers=[url for url in os.getenv("PEERS", "").split(",") if url.strip()],
+                     interval=float(os.getenv("SYNC_INTERVAL", "10")))
+
+# every camp, in memory; camps created through this process are added as they are committed, the ones created
+# through other workers are picked up every CAMP_INDEX_REFRESH seconds (CAMP_INDEX=0 sends every query to PostGIS)
+camp_index = CampIndex()
+CAMP_INDEX_ENABLED = os.getenv("CAMP_INDEX", "1") != "0"
+CAMP_INDEX_REFRESH = float(os.getenv("CAMP_INDEX_REFRESH", "30"))
+
+
+async def refresh_camp_index():
+    if not CAMP_INDEX_ENABLED:
+        return
+    while True:
+        try:
+            async with async_session_maker() as session:
+                loaded = await load_camp_index(session, camp_index, incremental=camp_index.loaded)
+            if loaded:
+                print(f"Camp index: {loaded} camps loaded, {len(camp_index)} in total")
+        except Exception as e:
+            # the database is not reachable yet: queries keep going to PostGIS, the load is tried again
+            print(f"Camp index could not be loaded: {e}")
+        await asyncio.sleep(CAMP_INDEX_REFRESH)
 
 
 #  GET INFOS ABOUT A BLOCKCHAIN ENDPOINT
 
+# heights are 1-based and inclusive; a JSON page holds at most GET_CHAIN_MAX_LIMIT blocks, a stream has no limit
+GET_CHAIN_MAX_LIMIT = 1000
+
+
+# opaque pagination token: the height the next page starts at, with the end of the range and the view the
+# first page was asked for, so following it never depends on the client re-sending the other parameters, and the
+# hash of the block at the end of the range, so a cursor into a chain that was rolled back since is refused
+def encode_cursor(height: int, end: int, headers_only: bool, end_hash: bytes) -> str:
+    cursor = {'height': height, 'end': end, 'headers_only': headers_only, 'hash': end_hash.hex()}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str):
+    try:
+        decoded = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return (int(decoded['height']), int(decoded['end']), bool(decoded['headers_only']),
+                bytes.fromhex(decoded['hash']))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+# the length, tip hash and hashes of the blocks at `end` and right before `start`, read together on the writer's
+# thread; `end` is the length when it is None or past the tip
+def chain_snapshot(start: int, end: Optional[int]):
+    length = len(blockchain.chain)
+    end = length if end is None else min(end, length)
+    return length, end, blockchain.tip_hash(), blockchain.hash_at(end), blockchain.hash_at(start - 1)
+
+
+# the blocks at heights `start`..`stop` as read now, as long as each one links to the one before (starting from
+# `previous_hash`, the hash of the block before `start`): a peer's branch adopted while they are read makes them
+# stop at the first block that is not on the same chain as the ones before
+def linked_blocks(start: int, stop: int, previous_hash: bytes):
+    for height in range(start, stop + 1):
+        try:
+            block = blockchain.chain[height - 1]
+        except IndexError:
+            return
+        if block.previous_hash != previous_hash:
+            return
+        previous_hash = block.hash
+        yield block
+
+
+# `start`..`end` (or `cursor`) select the heights, `headers_only` leaves out transactions and balances, and
+# `stream` sends the whole range as NDJSON, one block per line, without building it in memory. The ETag is the
+# hash of the chain tip, so a poller sending it back in If-None-Match gets a 304 until a block is mined.
+# A cursor into blocks that were replaced by a peer's branch since gets a 409: the client starts again from a height.
 @app.get("/get_chain")
-def get_chain():
-    return dict(chain=blockchain.chain, length=len(blockchain.chain))
+def get_chain(
+        start: int = 1,
+        end: Optional[int] = None,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        headers_only: bool = False,
+        stream: bool = False,
+        if_none_match: Optional[str] = Header(None),
+):
+    cursor_hash = None
+    if cursor is not None:
+        start, end, headers_only, cursor_hash = decode_cursor(cursor)
+    if start < 1 or not 1 <= limit <= GET_CHAIN_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"start must be >= 1 and limit between 1 and {GET_CHAIN_MAX_LIMIT}")
+
+    try:
+        length, end, tip_hash, end_hash, previous_hash = chain_writer.call(chain_snapshot, start, end)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    etag = f'"{tip_hash.hex()}"'
+    if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    if cursor_hash is not None and cursor_hash != end_hash:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="The chain changed since the cursor was created, start again from a height")
+
+    # full blocks are sent as the bytes cached when they were sealed, only headers are encoded per request
+    def view(block):
+        return canonical_json(block.summary()) if headers_only else block.encode()
+
+    if stream:
+        # a stream that runs into another branch ends there; the client asks again from the height it got to
+        def lines():
+            for block in linked_blocks(start, end, previous_hash):
+                yield view(block) + b'\n'
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson", headers={'ETag': etag})
+
+    stop = min(end, start + limit - 1)
+    blocks = [view(block) for block in linked_blocks(start, stop, previous_hash)]
+    if len(blocks) < max(0, stop - start + 1):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="The chain changed while the page was read, ask again")
+    next_cursor = encode_cursor(stop + 1, end, headers_only, end_hash) if stop < end else None
+    page = canonical_json({'length': length, 'next_cursor': next_cursor})
+    content = b'{"chain":[' + b','.join(blocks) + b'],' + page[1:]
+    return Response(content, media_type="application/json", headers={'ETag': etag})
+
+
+# The chain endpoints answer through orjson (ORJSONResponse); the ones with large bodies return the response
+# themselves, so FastAPI does not walk the result with jsonable_encoder first.
+
+# HEIGHT AND HASH OF THE LAST BLOCK AND THE SUMMED WORK OF THE CHAIN (what peers poll to find a chain with more
+# work), the work in hex since it does not fit in a JSON number
+@app.get('/tip', response_class=ORJSONResponse)
+def tip():
+    height, hash, work = chain_writer.call(lambda: (len(blockchain.chain), blockchain.tip_hash(), blockchain.work()))
+    return {'height': height, 'hash': hash.hex(), 'work': f'{work:x}'}
+
+
+# PEERS AND WHAT THE LAST SYNC WITH EACH OF THEM FOUND
+@app.get('/peers')
+def get_peers():
+    return {'peers': list(peer_sync.status.values())}
+
+
+@app.post('/peers')
+def add_peer(peer_data: PeerRequest):
+    if not peer_data.url.startswith(('http://', 'https://')):
+        raise HTTPException(status_code=400, detail="Peer url must start with http:// or https://")
+    peer_sync.add_peer(peer_data.url)
+    return {'peers': list(peer_sync.status.values())}
+
+
+@app.delete('/peers')
+def remove_peer(url: str):
+    peer_sync.remove_peer(url)
+    return {'peers': list(peer_sync.status.values())}
+
+
+# SYNC WITH EVERY PEER NOW instead of waiting for the next round
+@app.post('/sync')
+def sync():
+    return {'peers': peer_sync.sync_all(), 'height': len(blockchain.chain)}
+
+
+# BALANCE OF AN ADDRESS, AT THE TIP OR AS OF A GIVEN BLOCK HEIGHT
+# the tip and the balance are read together on the writer's thread, so no rollback shifts the state under them
+
+# the tip and the balance of `address` at `height` (the tip when None), (tip, None) when `height` is not on the chain
+def balance_at(address: str, height: Optional[int]):
+    tip = len(blockchain.chain)
+    if height is not None and not 1 <= height <= tip:
+        return tip, None
+    return tip, blockchain.balance(address, height)
+
+
+@app.get('/balance/{address}', response_class=ORJSONResponse)
+def get_balance(address: str, height: Optional[int] = None):
+    try:
+        tip, balance = chain_writer.call(balance_at, address, height)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    if balance is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Height must be between 1 and {tip}")
+    return {'address': address,
+            'balance': balance,
+            'height': height or tip}
+
+
+# BALANCES OF EVERY ADDRESS AS OF A GIVEN BLOCK HEIGHT (rebuilt from the nearest checkpoint)
+
+# the height and the balances at it, (tip, None) when `height` is not on the chain
+def balances_at(height: Optional[int]):
+    tip = len(blockchain.chain)
+    if height is None:
+        return tip, dict(blockchain.state.balances)
+    if not 1 <= height <= tip:
+        return tip, None
+    return height, blockchain.balances_at(height)
+
+
+@app.get('/balances', response_class=ORJSONResponse)
+def get_balances(height: Optional[int] = None):
+    # the tip and its balances are read together on the writer's thread
+    try:
+        at, balances = chain_writer.call(balances_at, height)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    if balances is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Height must be between 1 and {at}")
+    return ORJSONResponse({'height': at, 'balances': balances})
+
+
+# MERKLE INCLUSION PROOF FOR ONE TRANSACTION OF A BLOCK
+# the client hashes the transaction up the proof to the merkle root, and the header (with the nonce) to the block hash
+# The block is looked up on the writer's thread; a sealed block never changes, so the proof is built off it.
+
+# the block at height `index`, None when the chain is not that long
+def block_at(index: int):
+    return blockchain.chain[index - 1] if 1 <= index <= len(blockchain.chain) else None
+
+
+@app.get('/merkle_proof/{index}/{position}', response_class=ORJSONResponse)
+def get_merkle_proof(index: int, position: int):
+    try:
+        block = chain_writer.call(block_at, index)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    if block is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Block not found")
+    if not 0 <= position < len(block.transactions):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Transaction not found in this block")
+
+    return {'index': index,
+            'position': position,
+            'transaction': block.transactions[position].to_dict(),
+            'proof': merkle_proof(block.transactions, position),
+            'header': block.header.to_dict(),
+            'nonce': block.nonce,
+            'hash': block.hash.hex()}
 
 
 # CHECK THE VALIDITY OF A BLOCKCHAIN ENDPOINT
+# `full=true` re-checks every block instead of only the ones appended since the last check
 @app.get('/valid')
-def valid():
-    if blockchain.is_chain_valid():
+def valid(full: bool = False):
+    try:
+        if full:
+            chain_valid = whole_chain_valid()
+        else:
+            # the few new blocks are checked on the writer's thread, so none is appended or rolled back meanwhile
+            chain_valid = chain_writer.call(blockchain.is_chain_valid)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    if chain_valid:
         return {'message': 'The Blockchain is valid.'}
     else:
         return {'message': 'The Blockchain is not valid.'}
 
 
+# times a full check starts again after the chain it was walking was rolled back under it
+FULL_CHECK_ATTEMPTS = 3
+
+
+# WALK THE WHOLE CHAIN OFF THE WRITER'S THREAD
+# The walk is O(chain), so the writer only takes the height and tip hash and the blocks below them are checked
+# here while it keeps appending. A walk that fails is only believed if the tip it started from is still there;
+# otherwise a peer's branch replaced blocks under it and it starts again.
+def whole_chain_valid():
+    for _ in range(FULL_CHECK_ATTEMPTS):
+        height, tip_hash = chain_writer.call(lambda: (len(blockchain.chain), blockchain.tip_hash()))
+        try:
+            if blockchain.blocks_valid(0, height):
+                return True
+        except IndexError:
+            pass
+        if chain_writer.call(blockchain.hash_at, height) == tip_hash:
+            return False
+    raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="The chain kept changing while it was checked, try again")
+
+
+# FULL CRYPTOGRAPHIC AUDIT OF THE CHAIN
+# Unlike /valid, every block is re-serialized and re-hashed, its proof-of-work, target and merkle root are checked
+# and the balances are replayed against the checkpoints. Streamed as NDJSON: one progress line per audited range
+# (with the problems found in it), then a line with the result.
+@app.get('/audit')
+def audit(workers: Optional[int] = None, range_size: int = RANGE_SIZE):
+    if range_size < 1 or (workers is not None and workers < 1):
+        raise HTTPException(status_code=400, detail="workers and range_size must be at least 1")
+
+    def lines():
+        for report in audit_chain(blockchain, workers=workers, range_size=range_size):
+            yield json.dumps(report) + '\n'
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# BINARY SNAPSHOT OF THE CHAIN AND THE ACCOUNT STATE, for a new node to start from (see RESTORE_SNAPSHOT)
+@app.get('/snapshot')
+def snapshot():
+    return StreamingResponse(snapshot_chunks(blockchain), media_type="application/octet-stream",
+                             headers={'Content-Disposition': 'attachment; filename="chain.snapshot"'})
+
+
 # GET THE PENDING TRANSACTIONS
 
-@app.get('/pending_transactions')
+@app.get('/pending_transactions', response_class=ORJSONResponse)
 def pending_transactions():
-    return {'pending_transactions': blockchain.transactions}
+    # read on the writer's thread: the pool is not iterated while a transaction is added to it
+    try:
+        transactions = chain_writer.call(blockchain.pending_transactions)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    return ORJSONResponse({'pending_transactions': transactions})
+
+
+# THE TRANSACTIONS THAT LEFT THE PENDING POOL WITHOUT A BLOCK, newest first, with the reason (evicted from a full
+# pool, or no longer covered by the sender once a block or a peer's branch came in) and the total ever dropped
+@app.get('/dropped_transactions', response_class=ORJSONResponse)
+def dropped_transactions(limit: int = 100):
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    try:
+        transactions, total = chain_writer.call(blockchain.dropped_transactions, limit)
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    return ORJSONResponse({'dropped_transactions': transactions, 'total': total})
 
 
 # ADD TRANSACTION ENDPOINT
 
-@app.post('/add_transaction')
-def add_transaction(transaction_data: TransactionRequest):
-    # CONVERT THE REQUEST TO A DICTIONARY
-    data = transaction_data.dict()
-
+# what is wrong with a transaction request before it is checked against the balances, None when nothing is
+def transaction_error(data):
     # CHECK THE INTEGRITY OF THE REQUEST
     if 'sender' not in data or 'receiver' not in data or 'amount' not in data:
-        raise HTTPException(status_code=400, detail="Invalid transaction data")
+        return "Invalid transaction data"
 
     # CHECK THAT THE SENDER IS NOT THE RECEIVER
     if data['sender'] == data['receiver']:
-        raise HTTPException(status_code=400, detail="Sender cannot be the same with receiver")
+        return "Sender cannot be the same with receiver"
+
+    # THE AMOUNT MUST BE A NUMBER GREATER THAN 0 (NaN and infinity pass the JSON parser and compare false)
+    if not math.isfinite(data['amount']) or data['amount'] <= 0:
+        return "Transaction amount must be a finite number greater than zero"
+    return None
 
-    # THE AMOUNT MUST BE GREATER THAN 0
-    if data['amount'] <= 0:
-        raise HTTPException(status_code=400, detail="Transaction amount must be greater than zero")
+
+@app.post('/add_transaction')
+def add_transaction(transaction_data: TransactionRequest):
+    # CONVERT THE REQUEST TO A DICTIONARY
+    data = transaction_data.dict()
+
+    error = transaction_error(data)
+    if error:
+        raise HTTPException(status_code=400, detail=error)
 
     # Add the transaction to the current list of transactions to be included in the next mined block
-    index = blockchain.add_transaction(data['sender'], data['receiver'], data['amount'])
+    # (rejected right away if the sender cannot cover it, or if its id was already submitted)
+    try:
+        index = chain_writer.call(blockchain.add_transaction,
+                                  data['sender'], data['receiver'], data['amount'], data['id'])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
     response = {'message': f'Transaction added to block {index}'}
     return response
 
 
+# ADD MANY TRANSACTIONS IN ONE REQUEST
+# The body is a JSON array of transactions, or NDJSON (one transaction per line, Content-Type
+# application/x-ndjson) which is parsed as it arrives. Every transaction gets its own result, in order: accepted
+# with its id, or rejected with the reason; one bad transaction does not reject the others.
+
+ADD_TRANSACTIONS_MAX = int(os.getenv("ADD_TRANSACTIONS_MAX", "10000"))
+
+# bytes one transaction may take in the body (a JSON object of a few short strings and a number, with room to spare),
+# so a body larger than ADD_TRANSACTIONS_MAX of them is refused before it is all read
+ADD_TRANSACTION_BYTES = int(os.getenv("ADD_TRANSACTION_BYTES", "1024"))
+ADD_TRANSACTIONS_MAX_BYTES = ADD_TRANSACTIONS_MAX * ADD_TRANSACTION_BYTES
+
+
+# the body as it arrives, a 413 as soon as it is more than ADD_TRANSACTIONS_MAX_BYTES
+async def bounded_body(request: Request):
+    if int(request.headers.get('content-length') or 0) > ADD_TRANSACTIONS_MAX_BYTES:
+        raise body_too_large()
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > ADD_TRANSACTIONS_MAX_BYTES:
+            raise body_too_large()
+        yield chunk
+
+
+async def ndjson_items(request: Request):
+    buffer = b''
+    async for chunk in bounded_body(request):
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+def parse_transaction(item):
+    try:
+        if isinstance(item, bytes):
+            item = json.loads(item)
+        data = TransactionRequest(**item).dict()
+    except (ValueError, TypeError) as e:
+        return None, f"Invalid transaction data: {e}"
+    return data, transaction_error(data)
+
+
+def too_many_transactions():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"At most {ADD_TRANSACTIONS_MAX} transactions per request")
+
+
+def body_too_large():
+    return HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"The body of a request may be at most {ADD_TRANSACTIONS_MAX_BYTES} bytes")
+
+
+@app.post('/add_transactions', response_class=ORJSONResponse)
+async def add_transactions(request: Request):
+    if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+        # the rest of the body is not read once there are too many lines
+        items = []
+        async for item in ndjson_items(request):
+            items.append(item)
+            if len(items) > ADD_TRANSACTIONS_MAX:
+                raise too_many_transactions()
+    else:
+        # a JSON array is parsed in one go, but the body is read in chunks so an oversized one is not read to the end
+        body = b''.join([chunk async for chunk in bounded_body(request)])
+        try:
+            items = json.loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="The body must be a JSON array of transactions")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="The body must be a JSON array of transactions")
+    if len(items) > ADD_TRANSACTIONS_MAX:
+        raise too_many_transactions()
+
+    results = [None] * len(items)
+    valid = []
+    for position, item in enumerate(items):
+        data, error = parse_transaction(item)
+        if error:
+            results[position] = {'position': position, 'status': 'rejected', 'reason': error}
+        else:
+            valid.append((position, data))
+
+    # the valid ones are checked against the balances and added to the mempool in one writer command
+    try:
+        outcomes, index = await asyncio.wrap_future(chain_writer.submit(
+            blockchain.add_transactions,
+            [(data['sender'], data['receiver'], data['amount'], data['id']) for _, data in valid]))
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+    for (position, _), (transaction_id, error) in zip(valid, outcomes):
+        if error:
+            results[position] = {'position': position, 'status': 'rejected', 'reason': error}
+        else:
+            results[position] = {'position': position, 'status': 'accepted', 'id': transaction_id}
+
+    accepted = sum(result['status'] == 'accepted' for result in results)
+    return {'message': f'{accepted} transactions added to block {index}',
+            'accepted': accepted,
+            'rejected': len(results) - accepted,
+            'results': results}
+
+
 # GET USER BY ID
 @app.get("/get_user/{user_id}")
 async def get_user(user_id: int, db: AsyncSession = Depends(get_async_session)):
@@ -387,19 +1111,25 @@ async def reward_me(email: str, session: AsyncSession = Depends(get_async_sessio
                     detail="User's current position is not set"
                 )
 
-            # Check if there is a camp within a 10-meter radius
-            near_camp_query = await session.execute(
-                select(Camp)
-                .filter(
-                    ST_DWithin(
-                        Camp.geo_location,
-                        ST_SetSRID(user.current_position, 4326),
-                        10
+            # Check if there is a camp within a 10-meter radius (the nearest one), from the camp index when it is loaded
+            if camp_index.loaded:
+                nearest = camp_index.nearest(*wkb_to_coordinates(user.current_position), k=1, max_distance=10)
+                camp = nearest[0][0] if nearest else None
+            else:
+                near_camp_query = await session.execute(
+                    select(Camp)
+                    .filter(
+                        ST_DWithin(
+                            geography(Camp.geo_location),
+                            geography(ST_SetSRID(user.current_position, 4326)),
+                            10
+                        )
                     )
+                    .order_by(geography(Camp.geo_location).distance_centroid(
+                        geography(ST_SetSRID(user.current_position, 4326))))
+                    .limit(1)
                 )
-            )
-            camp = near_camp_query.scalar_one_or_none()
-            print(camp)
+                camp = near_camp_query.scalar_one_or_none()
 
             # If no camp is found, return an error
             if not camp:
@@ -409,11 +1139,17 @@ async def reward_me(email: str, session: AsyncSession = Depends(get_async_sessio
                 )
 
             # Perform the transaction: transfer 10 points from camp to user
-            index = blockchain.add_transaction(
-                sender=camp.camp_name,
-                receiver=user.email,
-                amount=10
-            )
+            try:
+                index = await asyncio.wrap_future(chain_writer.submit(
+                    blockchain.add_transaction,
+                    sender=camp.camp_name,
+                    receiver=user.email,
+                    amount=10
+                ))
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            except OverflowError as e:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
 
             response = {'message': f'Transaction added to block {index}'}
 
@@ -432,69 +1168,38 @@ async def reward_me(email: str, session: AsyncSession = Depends(get_async_sessio
 
 # MINE A BLOCK
 
-@app.get('/mine_block')
-def mine_block():
-    # Check if the blockchain is valid before mining a new block
-    if not blockchain.is_chain_valid():
-        raise HTTPException(status_code=400, detail="Blockchain is not valid")
-
-    # Get the previous block to determine the previous hash
-    previous_block = blockchain.get_previous_block()
-    previous_hash = previous_block['hash']
-
-    # Aggregate balances from the previous block and the current block
-    balances = {k: blockchain.balances.get(k, 0) + previous_block['balances'].get(k, 0) for k in
-                set(blockchain.balances) | set(previous_block['balances'])}
-    # Create a new block with the aggregated balances and previous hash
-    block = blockchain.create_block(balances, previous_hash)
-
-    is_block_valid = True
-    sender_aggregations = {}
-    receiver_aggregations = {}
-    for transaction in block['transactions']:
-        sender = transaction["sender"]
-        receiver = transaction["receiver"]
-        amount = transaction["amount"]
-
-        if sender in sender_aggregations:
-            sender_aggregations[sender] += amount
-        else:
-            sender_aggregations[sender] = amount
-
-        if receiver in receiver_aggregations:
-            receiver_aggregations[receiver] += amount
-        else:
-            receiver_aggregations[receiver] = amount
-
-    if not block['balances'] and sender_aggregations:
-        is_block_valid = False
-        raise HTTPException(status_code=400, detail="Invalid transaction data: Not enough amount")
-
-    if block['balances']:
-        for sender in sender_aggregations:
-            sender_balance = block['balances'].get(sender, 0)
-            if sender_balance < sender_aggregations[sender]:
-                is_block_valid = False
-                raise HTTPException(status_code=400, detail=f"Invalid transaction data for {sender}: Not enough amount")
-            else:
-                block['balances'][sender] = sender_balance - sender_aggregations[sender]
-
-        for receiver in receiver_aggregations:
-            receiver_balance = block['balances'].get(receiver, 0)
-            block['balances'][receiver] = receiver_balance + receiver_aggregations[receiver]
-
-    if is_block_valid:
-        # Append the mined block to the blockchain and update the peer copy
-        blockchain.chain.append(block)
-        blockchain.peer_b = copy.deepcopy(blockchain.chain)
-
-    response = {'message': 'A block is MINED',
-                'index': block['index'],
-                'timestamp': block['timestamp'],
-                'nonce': block['nonce'],
-                'previous_hash': block['previous_hash'],
-                'hash': block['hash'],
-                'balances': block['balances'],
-                'transactions': block['transactions']}
-
-    return response
+# START MINING THE NEXT BLOCK IN THE BACKGROUND AND RETURN THE JOB ID RIGHT AWAY
+@app.post('/mine_block', status_code=status.HTTP_202_ACCEPTED)
+def mine_block(timeout: Optional[float] = None):
+    try:
+        # Check if the blockchain is valid before mining a new block
+        if not chain_writer.call(blockchain.is_chain_valid):
+            raise HTTPException(status_code=400, detail="Blockchain is not valid")
+        job = mining_jobs.submit(timeout=timeout)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except OverflowError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e))
+
+    return {'message': 'Mining started', 'job_id': job.id, 'index': job.block.index}
+
+
+# STATE, PROGRESS AND RESULT OF A MINING JOB
+@app.get('/mine_block/{job_id}', response_class=ORJSONResponse)
+def mining_job_status(job_id: str):
+    job = mining_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Mining job not found")
+    return ORJSONResponse(job.to_dict())
+
+
+# CANCEL A MINING JOB
+@app.delete('/mine_block/{job_id}', response_class=ORJSONResponse)
+def cancel_mining_job(job_id: str):
+    try:
+        job = mining_jobs.cancel(job_id)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Mining job not found")
+    return {'message': 'Mining job cancelled', 'job_id': job.id}
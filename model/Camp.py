@@ -1,7 +1,7 @@
 from typing import Tuple
 
 from geoalchemy2 import Geometry, WKBElement
-from sqlalchemy import Integer, String
+from sqlalchemy import Index, Integer, String, text
 from sqlalchemy.orm import Mapped, mapped_column
 from pydantic import BaseModel, PositiveInt
 from database.geodb import Base
@@ -19,6 +19,13 @@ class Camp(Base):
         Geometry(geometry_type="POINT", srid=4326, spatial_index=True)
     )
 
+    # keyset pages of the camps of one city (WHERE city = ... AND id > ... ORDER BY id), and nearest camps in metres
+    # (ORDER BY geography(geo_location) <-> ...)
+    __table_args__ = (
+        Index("idx_camp_city_id", "city", "id"),
+        Index("idx_camp_geography", text("geography(geo_location)"), postgresql_using="gist"),
+    )
+
 
 # nearby cities schema
 
@@ -0,0 +1,169 @@
+import asyncio
+import codecs
+import csv
+import sys
+import time
+from typing import AsyncIterator, Iterable, List
+
+from database.geodb import engine
+
+# Bulk import of camps from a places CSV such as us_cities.csv (ID,STATE_CODE,STATE_NAME,CITY,COUNTY,LATITUDE,
+# LONGITUDE). Every place becomes a camp named "CITY, STATE_CODE" in city CITY. The rows are validated batch by
+# batch while the file is read, and each batch is sent with COPY into a temporary table. One INSERT ... SELECT
+# then builds the points and adds the places that are not camps yet. Everything runs in one transaction: a failed
+# import adds nothing.
+#
+#   python -m service.camp_import us_cities.csv [--defer-index]
+
+COLUMNS = ('ID', 'CITY', 'STATE_CODE', 'LATITUDE', 'LONGITUDE')
+
+# bytes of the file read (and rows copied) at a time
+BATCH_BYTES = 256 * 1024
+
+# rejected rows listed in the result, the rest are only counted
+MAX_ERRORS = 100
+
+# camp.camp_name and camp.city are String(50)
+MAX_NAME = 50
+
+# the GiST indexes on camp.geo_location, dropped and rebuilt around the insert with --defer-index
+CAMP_INDEXES = {
+    'idx_camp_geo_location': 'gist (geo_location)',
+    'idx_camp_geography': 'gist (geography(geo_location))',
+}
+
+
+class CampRows:
+    """Validates the rows of one CSV, in as many calls to `parse` as there are batches."""
+
+    def __init__(self):
+        self.columns = None
+        self.row = 0
+        self.rejected = 0
+        self.errors = []
+
+    # the valid rows among `lines` as (id, camp_name, city, latitude, longitude) records
+    # raises ValueError when the header lacks a column
+    def parse(self, lines: Iterable[str]) -> List[tuple]:
+        records = []
+        for row in csv.reader(lines):
+            if not row:
+                continue
+            if self.columns is None:
+                header = [name.strip().upper() for name in row]
+                missing = [name for name in COLUMNS if name not in header]
+                if missing:
+                    raise ValueError(f"CSV header lacks the columns {', '.join(missing)}")
+                self.columns = [header.index(name) for name in COLUMNS]
+                continue
+
+            self.row += 1
+            try:
+                records.append(self._record(row))
+            except (ValueError, IndexError) as e:
+                self.rejected += 1
+                if len(self.errors) < MAX_ERRORS:
+                    self.errors.append({'row': self.row, 'error': str(e)})
+        return records
+
+    def _record(self, row):
+        place_id, city, state, latitude, longitude = (row[column].strip() for column in self.columns)
+        camp_name = f"{city}, {state}"
+        if not city:
+            raise ValueError("CITY is empty")
+        if len(camp_name) > MAX_NAME:
+            raise ValueError(f"Camp name {camp_name!r} is longer than {MAX_NAME} characters")
+        latitude, longitude = float(latitude), float(longitude)
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError(f"Position ({latitude}, {longitude}) is out of range")
+        return int(place_id), camp_name, city, latitude, longitude
+
+
+# batches of records from a CSV file
+async def file_batches(path, rows: CampRows) -> AsyncIterator[List[tuple]]:
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        while True:
+            lines = file.readlines(BATCH_BYTES)
+            if not lines:
+                return
+            yield rows.parse(lines)
+
+
+# batches of records from a CSV streamed in chunks of bytes (a request body)
+async def stream_batches(chunks: AsyncIterator[bytes], rows: CampRows) -> AsyncIterator[List[tuple]]:
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    lines, rest, size = [], '', 0
+    async for chunk in chunks:
+        *complete, rest = (rest + decoder.decode(chunk)).split('\n')
+        lines += complete
+        size += len(chunk)
+        if size >= BATCH_BYTES:
+            yield rows.parse(lines)
+            lines, size = [], 0
+    rest += decoder.decode(b'', final=True)
+    yield rows.parse(lines + [rest] if rest else lines)
+
+
+# COPY THE BATCHES INTO THE CAMP TABLE over an asyncpg connection
+# Places that are already camps (same camp_name and city), or that repeat an earlier row, are skipped. With
+# `defer_index` the GiST indexes on camp.geo_location are dropped before the insert and rebuilt once after it,
+# instead of being updated row by row; the camp table is locked until the import commits.
+# Returns the number of rows copied and the number of camps added.
+async def import_camps(connection, batches: AsyncIterator[List[tuple]], defer_index: bool = False):
+    copied = 0
+    async with connection.transaction():
+        await connection.execute("""
+            CREATE TEMPORARY TABLE camp_import (
+                id integer, camp_name varchar(50), city varchar(50), latitude float8, longitude float8
+            ) ON COMMIT DROP
+        """)
+        async for batch in batches:
+            if batch:
+                await connection.copy_records_to_table('camp_import', records=batch)
+                copied += len(batch)
+
+        if defer_index:
+            for name in CAMP_INDEXES:
+                await connection.execute(f"DROP INDEX IF EXISTS {name}")
+        status = await connection.execute("""
+            INSERT INTO camp (camp_name, city, geo_location)
+            SELECT DISTINCT ON (camp_name, city)
+                   camp_name, city, ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)
+            FROM camp_import
+            WHERE NOT EXISTS (
+                SELECT 1 FROM camp WHERE camp.camp_name = camp_import.camp_name AND camp.city = camp_import.city
+            )
+            ORDER BY camp_name, city, id
+        """)
+        if defer_index:
+            for name, definition in CAMP_INDEXES.items():
+                await connection.execute(f"CREATE INDEX {name} ON camp USING {definition}")
+        await connection.execute("ANALYZE camp")
+    return copied, int(status.split()[-1])
+
+
+# IMPORT THE BATCHES over a connection of the application's engine; returns a report of the import
+async def import_csv(batches: AsyncIterator[List[tuple]], rows: CampRows, defer_index: bool = False) -> dict:
+    started = time.perf_counter()
+    async with engine.connect() as connection:
+        raw = await connection.get_raw_connection()
+        copied, imported = await import_camps(raw.driver_connection, batches, defer_index)
+    return {'rows': rows.row, 'imported': imported, 'skipped': copied - imported, 'rejected': rows.rejected,
+            'errors': rows.errors, 'elapsed': time.perf_counter() - started}
+
+
+async def main(path, defer_index):
+    rows = CampRows()
+    try:
+        report = await import_csv(file_batches(path, rows), rows, defer_index)
+    finally:
+        await engine.dispose()
+    for error in report['errors']:
+        print(f"row {error['row']}: {error['error']}")
+    print(f"{report['rows']} rows: {report['imported']} camps added, {report['skipped']} already there, "
+          f"{report['rejected']} rejected, in {report['elapsed']:.2f} s")
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--defer-index']
+    asyncio.run(main(arguments[0] if arguments else 'us_cities.csv', '--defer-index' in sys.argv))
@@ -0,0 +1,151 @@
+import math
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+# Every camp is kept in memory in a grid of CELL_SIZE x CELL_SIZE degree cells, so radius and nearest-camp queries
+# only look at the camps of the few cells around the point instead of asking PostGIS. Distances are great-circle
+# distances in metres on a sphere of the mean earth radius (PostGIS geography uses the spheroid, the two differ by
+# less than 0.5%).
+
+# degrees per cell side (about 11 km of latitude)
+CELL_SIZE = 0.1
+
+EARTH_RADIUS = 6_371_008.8
+
+# half the circumference: no two points are further apart
+MAX_DISTANCE = math.pi * EARTH_RADIUS
+
+
+class CampEntry(NamedTuple):
+    id: int
+    camp_name: str
+    city: str
+    latitude: float
+    longitude: float
+
+    def geojson(self) -> str:
+        return f'{{"type":"Point","coordinates":[{self.longitude!r},{self.latitude!r}]}}'
+
+
+def distance(latitude1, longitude1, latitude2, longitude2) -> float:
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (math.sin((latitude2 - latitude1) / 2) ** 2
+         + math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CampIndex:
+    """In-memory grid of every camp, filled at startup and kept up to date when a camp is created.
+
+    Until `load` has run `loaded` is False and callers use PostGIS instead. It is only used from the event loop, so
+    it needs no lock.
+    """
+
+    def __init__(self, cell_size: float = CELL_SIZE):
+        self.cell_size = cell_size
+        self.columns = math.ceil(360 / cell_size)
+        self.loaded = False
+        self._cells: Dict[Tuple[int, int], List[CampEntry]] = {}
+        self._camps: Dict[int, CampEntry] = {}
+        self._names: Dict[Tuple[str, str], CampEntry] = {}
+
+    def __len__(self):
+        return len(self._camps)
+
+    # highest camp id in the index (0 when empty), camps are only ever added with higher ids
+    @property
+    def last_id(self) -> int:
+        return max(self._camps, default=0)
+
+    def _cell(self, latitude, longitude):
+        return (math.floor((latitude + 90) / self.cell_size),
+                math.floor((longitude + 180) / self.cell_size) % self.columns)
+
+    # REPLACE EVERYTHING IN THE INDEX with `camps`
+    def load(self, camps: Iterable[CampEntry]):
+        cells, by_id, by_name = {}, {}, {}
+        for camp in camps:
+            cells.setdefault(self._cell(camp.latitude, camp.longitude), []).append(camp)
+            by_id[camp.id] = camp
+            by_name[camp.city, camp.camp_name] = camp
+        self._cells, self._camps, self._names = cells, by_id, by_name
+        self.loaded = True
+
+    # ADD A CAMP, or move it when a camp with the same id is already indexed
+    def add(self, camp: CampEntry):
+        self.remove(camp.id)
+        self._cells.setdefault(self._cell(camp.latitude, camp.longitude), []).append(camp)
+        self._camps[camp.id] = camp
+        self._names[camp.city, camp.camp_name] = camp
+
+    def remove(self, camp_id: int):
+        camp = self._camps.pop(camp_id, None)
+        if camp is None:
+            return
+        cell = self._cell(camp.latitude, camp.longitude)
+        self._cells[cell].remove(camp)
+        if not self._cells[cell]:
+            del self._cells[cell]
+        if self._names.get((camp.city, camp.camp_name)) == camp:
+            del self._names[camp.city, camp.camp_name]
+
+    def get(self, camp_id: int) -> Optional[CampEntry]:
+        return self._camps.get(camp_id)
+
+    def find(self, city: str, camp_name: str) -> Optional[CampEntry]:
+        return self._names.get((city, camp_name))
+
+    # the cells that can hold a camp within `radius` metres of the point, or None when scanning every camp is cheaper
+    def _cells_around(self, latitude, longitude, radius):
+        angle = radius / EARTH_RADIUS
+        spread = math.degrees(angle)
+        first_row = math.floor((max(-90.0, latitude - spread) + 90) / self.cell_size)
+        last_row = math.floor((min(90.0, latitude + spread) + 90) / self.cell_size)
+
+        # longitude extent of the circle, every longitude when it reaches a pole
+        ratio = math.sin(angle) / math.cos(math.radians(latitude)) if abs(latitude) < 90 else 2
+        if angle >= math.pi / 2 or ratio >= 1 or abs(latitude) + spread >= 90:
+            columns = range(self.columns)
+        else:
+            width = math.degrees(math.asin(ratio))
+            first_column = math.floor((longitude - width + 180) / self.cell_size)
+            last_column = math.floor((longitude + width + 180) / self.cell_size)
+            if last_column - first_column + 1 >= self.columns:
+                columns = range(self.columns)
+            else:
+                columns = [column % self.columns for column in range(first_column, last_column + 1)]
+
+        if (last_row - first_row + 1) * len(columns) > len(self._cells):
+            return None
+        return [(row, column) for row in range(first_row, last_row + 1) for column in columns]
+
+    # CAMPS WITHIN `radius` METRES OF THE POINT, nearest first, as (camp, distance in metres)
+    def within(self, latitude: float, longitude: float, radius: float) -> List[Tuple[CampEntry, float]]:
+        cells = self._cells_around(latitude, longitude, radius)
+        if cells is None:
+            candidates = (camp for camps in self._cells.values() for camp in camps)
+        else:
+            candidates = (camp for cell in cells for camp in self._cells.get(cell, ()))
+
+        found = []
+        for camp in candidates:
+            metres = distance(latitude, longitude, camp.latitude, camp.longitude)
+            if metres <= radius:
+                found.append((camp, metres))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    # THE `k` CAMPS NEAREST TO THE POINT, nearest first, as (camp, distance in metres); only camps within
+    # `max_distance` metres when it is given
+    # The search radius starts at one cell and doubles until it holds k camps, everything inside a radius is
+    # looked at, so the first k found are the nearest.
+    def nearest(self, latitude: float, longitude: float, k: int = 1,
+                max_distance: float = MAX_DISTANCE) -> List[Tuple[CampEntry, float]]:
+        if k <= 0 or not self._camps:
+            return []
+        radius = min(max_distance, self.cell_size * math.pi / 180 * EARTH_RADIUS)
+        while True:
+            found = self.within(latitude, longitude, radius)
+            if len(found) >= k or radius >= min(max_distance, MAX_DISTANCE):
+                return found[:k]
+            radius = min(radius * 2, max_distance, MAX_DISTANCE)
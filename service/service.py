@@ -1,10 +1,12 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
-from geoalchemy2 import WKBElement
+from geoalchemy2 import Geography, WKBElement
 from geoalchemy2.shape import to_shape
-from sqlalchemy import select, exists
+from sqlalchemy import select, exists, func, true
 from sqlalchemy.ext.asyncio import AsyncSession
 from model.Camp import Camp
+from model.User import User
+from service.camp_index import CampEntry, CampIndex
 
 
 # check if the camp table is empty or not
@@ -23,3 +25,110 @@ def wkb_to_coordinates(wkb_element: WKBElement) -> Tuple[float, float]:
     return point.y, point.x  # Return as (latitude, longitude)
 
 
+
+
+# fill the in-memory camp index from the camp table, or only add the camps created since it was filled
+# (the ones with an id above its highest); returns the number of camps read
+
+async def load_camp_index(db_session: AsyncSession, camp_index: CampIndex, incremental: bool = False) -> int:
+    query = select(
+        Camp.id,
+        Camp.camp_name,
+        Camp.city,
+        func.ST_Y(Camp.geo_location),
+        func.ST_X(Camp.geo_location)
+    ).order_by(Camp.id)
+    if incremental:
+        query = query.where(Camp.id > camp_index.last_id)
+
+    result = await db_session.execute(query)
+    camps = [CampEntry(*row) for row in result.all()]
+    if incremental:
+        for camp in camps:
+            camp_index.add(camp)
+    else:
+        camp_index.load(camps)
+    return len(camps)
+
+
+# the `columns` of the camps of `city` inside `bbox` (min_lon, min_lat, max_lon, max_lat), in id order
+
+def select_camps(columns, city: Optional[str] = None, bbox: Optional[Tuple[float, float, float, float]] = None):
+    query = select(*columns).order_by(Camp.id)
+    if city is not None:
+        query = query.where(Camp.city == city)
+    if bbox is not None:
+        query = query.where(Camp.geo_location.intersects(func.ST_MakeEnvelope(*bbox, 4326)))
+    return query
+
+
+# ONE KEYSET PAGE OF CAMPS: the `columns` of at most `limit` camps with an id above `after_id`, in id order,
+# optionally only the camps of `city` and the ones inside `bbox` (min_lon, min_lat, max_lon, max_lat)
+# Returns the rows and the id to continue after, None on the last page. Every page is an index range scan that
+# starts at `after_id`, so a page costs the same however deep it is.
+
+async def camp_page(db_session: AsyncSession, columns, after_id: int = 0, limit: int = 100,
+                    city: Optional[str] = None, bbox: Optional[Tuple[float, float, float, float]] = None):
+    query = select_camps(columns, city, bbox).where(Camp.id > after_id).limit(limit + 1)
+    result = await db_session.execute(query)
+    rows = result.all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id
+    return rows, None
+
+
+# THE `k` CAMPS NEAREST TO AN ORIGIN, in one query
+# The origin is a point (`latitude`, `longitude`), a camp (`camp_id`, which is left out of the answer) or the
+# current position of a user (`user_id`). A lateral subquery orders the camps by geography <->, the distance in
+# metres on the sphere, so the GiST index on geography(geo_location) hands out exactly the k nearest and the scan
+# stops after them, at any latitude. Distances are on the sphere, like those of the camp index (they differ from
+# the spheroid by less than 0.5%). Returns rows of id, camp_name, city, latitude, longitude and distance, nearest
+# first, or None when the camp or user does not exist or the user has no position.
+
+def geography(geometry):
+    # the same expression as the one of idx_camp_geography, so the planner can use the index for <->
+    return func.geography(geometry, type_=Geography(srid=4326))
+
+
+async def nearest_camps(db_session: AsyncSession, k: int, latitude: Optional[float] = None,
+                        longitude: Optional[float] = None, camp_id: Optional[int] = None,
+                        user_id: Optional[int] = None):
+    if camp_id is not None:
+        origin = select(Camp.geo_location.label("position")).where(Camp.id == camp_id)
+    elif user_id is not None:
+        origin = select(User.current_position.label("position")).where(
+            User.id == user_id, User.current_position.isnot(None))
+    else:
+        origin = select(func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), 4326).label("position"))
+    origin = origin.cte("origin")
+
+    candidates = select(
+        Camp.id,
+        Camp.camp_name,
+        Camp.city,
+        Camp.geo_location,
+        geography(Camp.geo_location).distance_centroid(geography(origin.c.position)).label("distance")
+    ).order_by(
+        geography(Camp.geo_location).distance_centroid(geography(origin.c.position))
+    ).limit(k)
+    if camp_id is not None:
+        candidates = candidates.where(Camp.id != camp_id)
+    candidates = candidates.lateral("candidates")
+
+    query = select(
+        candidates.c.id,
+        candidates.c.camp_name,
+        candidates.c.city,
+        func.ST_Y(candidates.c.geo_location).label("latitude"),
+        func.ST_X(candidates.c.geo_location).label("longitude"),
+        candidates.c.distance
+    ).select_from(
+        # a left join keeps one row for an origin without any camp near it, so "no origin" and "no camps" differ
+        origin.outerjoin(candidates, true())
+    ).order_by(candidates.c.distance)
+
+    result = await db_session.execute(query)
+    rows = result.all()
+    if not rows:
+        return None
+    return [row for row in rows if row.id is not None]
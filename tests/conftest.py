@@ -0,0 +1,32 @@
+import pytest
+
+from blockchain.Blockchain import Blockchain
+from blockchain.difficulty import target_for_zero_bits
+from blockchain.writer import ChainWriter
+
+# a few hashes per block, so every test mines in a few milliseconds
+EASY_TARGET = target_for_zero_bits(4)
+
+
+def easy_chain(**options):
+    return Blockchain(mining_workers=1, initial_target=EASY_TARGET, **options)
+
+
+@pytest.fixture
+def easy_target():
+    return EASY_TARGET
+
+
+@pytest.fixture
+def chain():
+    """Makes single-process Blockchains mining against EASY_TARGET, any options go to the Blockchain."""
+    return easy_chain
+
+
+@pytest.fixture
+def node(chain):
+    """A Blockchain with the ChainWriter that owns it, stopped after the test."""
+    blockchain = chain()
+    writer = ChainWriter(blockchain)
+    yield blockchain, writer
+    writer.stop()
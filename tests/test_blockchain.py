@@ -0,0 +1,247 @@
+import dataclasses
+import logging
+
+import pytest
+
+from blockchain.audit import MAX_FUTURE, audit_chain, check_header
+from blockchain.block import now_timestamp, state_root
+from blockchain.difficulty import block_work
+from blockchain.mining_jobs import JobState, MiningJobManager
+from blockchain.storage import ChainStore
+
+# a second node that shares the first `height` blocks of `blockchain`
+def fork_of(chain, blockchain, height):
+    return chain(store=list(blockchain.chain[:height]))
+
+
+def test_adopt_drops_pending_transactions_the_new_branch_does_not_fund(chain):
+    b1 = chain()
+    b1.add_balance('alice', 10)
+    b1.mine_block()
+    b2 = fork_of(chain, b1, 2)
+
+    # on b1 alice pays bob, on the longer branch of b2 she already spent everything on carol
+    b1.add_transaction('alice', 'bob', 10, 'to-bob')
+    b2.add_transaction('alice', 'carol', 10, 'to-carol')
+    b2.mine_block()
+    b2.mine_block()
+
+    b1.adopt(2, b2.chain[2:])
+    assert b1.balance('alice') == 0
+    assert 'to-bob' not in b1.mempool
+    [dropped], total = b1.dropped_transactions()
+    assert dropped['id'] == 'to-bob' and "peer's branch" in dropped['reason'] and total == 1
+
+    for _ in range(3):
+        b1.mine_block()
+    assert len(b1.chain) == 7
+    assert b1.balance('bob') == 0 and b1.balance('carol') == 10
+
+
+def test_prepare_block_leaves_out_transactions_that_no_longer_fit(chain, caplog):
+    blockchain = chain()
+    blockchain.add_balance('alice', 10)
+    blockchain.mine_block()
+    blockchain.add_transaction('alice', 'bob', 6, 'first')
+    blockchain.add_transaction('alice', 'carol', 4, 'second')
+    # the pending state was changed behind the mempool's back
+    blockchain.state.balances['alice'] = 7
+
+    with caplog.at_level(logging.WARNING, logger='blockchain.Blockchain'):
+        block = blockchain.mine_block()
+    assert [transaction.id for transaction in block.transactions] == ['first']
+    assert blockchain.balance('alice') == 1 and blockchain.balance('carol') == 0
+
+    # the client can find out what happened to the one left out
+    assert blockchain.dropped_transactions() == ([{'id': 'second', 'sender': 'alice', 'receiver': 'carol', 'amount': 4,
+                                                   'reason': "alice cannot cover it"}], 1)
+    assert caplog.messages == ["Dropped pending transaction second: alice cannot cover it"]
+
+
+def test_adopt_compares_work_not_length(chain, easy_target):
+    b1 = chain()
+    b1.mine_block()
+    b2 = fork_of(chain, b1, 2)
+    b1.mine_block()
+    b1.mine_block()
+
+    # three blocks against a target four times easier are less work than two
+    b2.target_at = lambda index: easy_target * 4
+    for _ in range(3):
+        b2.mine_block()
+    # b2's targets do not follow the rules, so b1's work is summed before its branch comes in
+    assert b1.work() == 4 * block_work(easy_target)
+    with pytest.raises(ValueError, match="more work"):
+        b1.adopt(2, b2.chain[2:])
+    assert len(b1.chain) == 4
+
+    # later blocks keep the easy target of their parent, the branch needs more of them
+    del b2.target_at
+    while b2.work_above(2) <= b1.work_above(2):
+        b2.mine_block()
+    b1.adopt(2, b2.chain[2:])
+    assert [block.hash for block in b1.chain] == [block.hash for block in b2.chain]
+    assert b1.work() == b2.work_above(0)
+
+
+def test_check_header_rejects_timestamps_out_of_order_or_in_the_future(chain):
+    blockchain = chain()
+    blockchain.mine_block()
+    block = blockchain.chain[1]
+
+    def errors(timestamp):
+        header = dataclasses.replace(block.header, timestamp=timestamp)
+        return check_header(2, header, block.nonce, block.hash, blockchain.chain[0].hash,
+                            lambda height: blockchain.chain[height - 1].header, blockchain.rules())
+
+    assert errors(block.header.timestamp) == []
+    assert "Timestamp is not after the timestamp of the block before" in errors(blockchain.chain[0].header.timestamp)
+    assert "Timestamp is too far in the future" in errors(now_timestamp() + MAX_FUTURE + 60_000_000)
+
+
+def forge_deltas(blockchain, state_root_too=False):
+    # mallory credits herself in block 2 and every checkpoint after it agrees
+    blockchain.chain[1].deltas['mallory'] = 1000
+    if state_root_too:
+        blockchain.chain[1].header.state_root = state_root(blockchain.chain[1].deltas, blockchain.chain[1].balances)
+    for block in blockchain.chain[2:]:
+        if block.balances is not None:
+            block.balances['mallory'] = 1000
+
+
+def audit_result(blockchain):
+    return list(audit_chain(blockchain))[-1]
+
+
+@pytest.mark.parametrize("state_root_too", [False, True])
+def test_forged_deltas_do_not_pass_validation(chain, state_root_too):
+    blockchain = chain(checkpoint_interval=2)
+    blockchain.add_balance('alice', 10)
+    for _ in range(4):
+        blockchain.mine_block()
+    assert blockchain.is_chain_valid(full=True) and audit_result(blockchain)['valid']
+
+    forge_deltas(blockchain, state_root_too)
+    assert not blockchain.is_chain_valid(full=True)
+    assert not audit_result(blockchain)['valid']
+
+
+@pytest.mark.parametrize("amount", [float('nan'), float('inf'), -float('inf'), 0, -1])
+def test_amounts_must_be_finite_and_positive(chain, amount):
+    blockchain = chain()
+    blockchain.add_balance('alice', 10)
+    with pytest.raises(ValueError, match="finite number"):
+        blockchain.add_transaction('alice', 'bob', amount)
+    with pytest.raises(ValueError, match="finite number"):
+        blockchain.add_balance('bob', amount)
+
+    # nothing was admitted, so alice still cannot overdraw
+    assert blockchain.mempool.debits('alice') == 0
+    with pytest.raises(ValueError, match="Not enough amount"):
+        blockchain.add_transaction('alice', 'bob', 1e9)
+
+
+def test_blocks_valid_checks_a_prefix_taken_earlier(chain):
+    blockchain = chain()
+    blockchain.mine_block()
+    height, tip_hash = len(blockchain.chain), blockchain.tip_hash()
+    blockchain.mine_block()
+
+    # the blocks appended after the height was taken are not read
+    assert blockchain.blocks_valid(0, height)
+    assert blockchain.hash_at(height) == tip_hash
+    assert blockchain.hash_at(len(blockchain.chain) + 1) is None
+
+    blockchain.chain[1] = dataclasses.replace(blockchain.chain[1], nonce=blockchain.chain[1].nonce + 1)
+    assert not blockchain.blocks_valid(0, height)
+
+
+def test_edited_transactions_do_not_pass_validation(chain):
+    blockchain = chain()
+    blockchain.add_balance('alice', 10)
+    blockchain.mine_block()
+    blockchain.add_transaction('alice', 'bob', 4, 'to-bob')
+    blockchain.mine_block()
+    assert blockchain.is_chain_valid(full=True)
+
+    transaction = blockchain.chain[2].transactions[0]
+    transaction.amount = 9999
+    transaction.receiver = 'mallory'
+    assert not blockchain.is_chain_valid(full=True)
+    assert not audit_result(blockchain)['valid']
+
+
+def test_cancelled_job_gives_back_pending_balances_added_up(node):
+    blockchain, writer = node
+    jobs = MiningJobManager(blockchain, writer)
+    # no hash meets a target of 1, the job mines until it is cancelled
+    blockchain.target_at = lambda index: 1
+    try:
+        blockchain.add_balance('alice', 10)
+        job = jobs.submit()
+        writer.call(blockchain.add_balance, 'alice', 5)
+        writer.call(blockchain.add_transaction, 'alice', 'carol', 12, 't2')
+        # a new pending balance replaces the 5, t2 must still be covered with the in-flight 10 counted
+        with pytest.raises(ValueError, match="would not cover"):
+            writer.call(blockchain.add_balance, 'alice', 1)
+        writer.call(blockchain.add_balance, 'alice', 2)
+
+        jobs.cancel(job.id)
+        jobs.shutdown()
+        assert job.state == JobState.CANCELLED
+        assert blockchain.balances == {'alice': 12}
+    finally:
+        writer.stop()
+
+    del blockchain.target_at
+    block = blockchain.mine_block()
+    assert [transaction.id for transaction in block.transactions] == ['t2']
+    assert blockchain.balance('alice') == 0 and blockchain.balance('carol') == 12
+
+
+# a chain whose balances change in every block, with the balances at the tip recorded after each block
+def busy_chain(chain, **options):
+    blockchain = chain(checkpoint_interval=3, **options)
+    history = {1: {}}
+    blockchain.add_balance('alice', 100)
+    for height in range(2, 10):
+        if height > 2:
+            blockchain.add_transaction('alice', f'user{height % 3}', height)
+        if height % 4 == 0:
+            blockchain.add_balance('bob', height)
+        blockchain.mine_block()
+        history[height] = dict(blockchain.state.balances)
+    return blockchain, history
+
+
+def test_balances_at_every_height_across_checkpoints(chain):
+    blockchain, history = busy_chain(chain)
+    assert [block.balances is not None for block in blockchain.chain] == [
+        True, False, True, False, False, True, False, False, True]
+    for height, balances in history.items():
+        assert blockchain.balances_at(height) == balances
+
+
+def test_balance_at_older_heights_also_after_reopening_the_store(chain, tmp_path):
+    blockchain, history = busy_chain(chain, store=ChainStore(str(tmp_path)))
+    addresses = {address for balances in history.values() for address in balances} | {'nobody'}
+
+    def assert_balances(node):
+        for height, balances in history.items():
+            for address in addresses:
+                assert node.balance(address, height) == balances.get(address, 0)
+        assert node.balance('alice') == history[9]['alice']
+
+    assert_balances(blockchain)
+    blockchain.chain.close()
+
+    # a reopened store only indexes the tip, older heights are rebuilt from the checkpoints
+    reopened = chain(checkpoint_interval=3, store=ChainStore(str(tmp_path)))
+    try:
+        assert reopened.state.base_height == 9
+        assert_balances(reopened)
+        reopened.mine_block()
+        assert reopened.balance('alice', 9) == history[9]['alice']
+        assert reopened.balance('alice', 5) == history[5]['alice']
+    finally:
+        reopened.chain.close()
@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("asyncpg")
+
+from service.camp_import import MAX_ERRORS, MAX_NAME, CampRows  # noqa: E402
+
+HEADER = 'ID,STATE_CODE,STATE_NAME,CITY,COUNTY,LATITUDE,LONGITUDE\n'
+
+
+def test_rows_become_camp_records():
+    rows = CampRows()
+    records = rows.parse([HEADER, '1,AK,Alaska,Adak,Aleutians West,55.999722,-161.207778\n'])
+    assert records == [(1, 'Adak, AK', 'Adak', 55.999722, -161.207778)]
+    assert (rows.row, rows.rejected, rows.errors) == (1, 0, [])
+
+
+def test_the_header_is_read_once_in_any_order_and_case():
+    rows = CampRows()
+    assert rows.parse([' longitude , latitude,city,state_code,id\n', '10,20,Here,XX,7\n']) == [
+        (7, 'Here, XX', 'Here', 20.0, 10.0)]
+    # later batches are all rows, blank lines are skipped
+    assert rows.parse(['\n', '11,21,There,YY,8\n']) == [(8, 'There, YY', 'There', 21.0, 11.0)]
+    assert rows.row == 2
+
+
+def test_a_header_without_a_column_is_refused():
+    with pytest.raises(ValueError, match="LATITUDE, LONGITUDE"):
+        CampRows().parse(['ID,STATE_CODE,CITY\n', '1,AK,Adak\n'])
+
+
+@pytest.mark.parametrize("row, error", [
+    ('1,AK,Alaska,Adak,X,91,0', "out of range"),
+    ('1,AK,Alaska,Adak,X,0,-180.5', "out of range"),
+    ('1,AK,Alaska,Adak,X,north,0', "could not convert"),
+    ('1,AK,Alaska,,X,0,0', "CITY is empty"),
+    (f'1,AK,Alaska,{"x" * (MAX_NAME - 3)},X,0,0', f"longer than {MAX_NAME}"),
+    ('one,AK,Alaska,Adak,X,0,0', "invalid literal"),
+    ('1,AK,Alaska', "index out of range"),
+])
+def test_invalid_rows_are_rejected_and_reported(row, error):
+    rows = CampRows()
+    records = rows.parse([HEADER, row + '\n', '2,AK,Alaska,Akutan,X,54.13,-165.77\n'])
+    assert [record[0] for record in records] == [2]
+    assert rows.rejected == 1 and rows.errors[0]['row'] == 1
+    assert error in rows.errors[0]['error']
+
+
+def test_a_name_of_max_name_characters_is_accepted():
+    rows = CampRows()
+    city = 'x' * (MAX_NAME - 4)
+    assert rows.parse([HEADER, f'1,AK,Alaska,{city},X,0,0\n'])[0][1] == f'{city}, AK'
+
+
+def test_only_the_first_errors_are_listed():
+    rows = CampRows()
+    rows.parse([HEADER] + ['1,AK,Alaska,Adak,X,100,0\n'] * (MAX_ERRORS + 5))
+    assert rows.rejected == MAX_ERRORS + 5 and len(rows.errors) == MAX_ERRORS
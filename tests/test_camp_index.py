@@ -0,0 +1,80 @@
+import random
+
+import pytest
+
+from service.camp_index import CampEntry, CampIndex, distance
+
+
+def camps_around(points, count=40, spread=3.0, seed=0):
+    # `count` camps scattered within `spread` degrees of every point, wrapped like real coordinates
+    rng = random.Random(seed)
+    camps = []
+    for latitude, longitude in points:
+        for _ in range(count):
+            camp_latitude = rng.uniform(max(-90.0, latitude - spread), min(90.0, latitude + spread))
+            camp_longitude = (longitude + rng.uniform(-spread, spread) + 180) % 360 - 180
+            camps.append(CampEntry(len(camps) + 1, f'camp {len(camps) + 1}', 'city', camp_latitude, camp_longitude))
+    return camps
+
+
+def brute_force(camps, latitude, longitude):
+    return sorted(((camp, distance(latitude, longitude, camp.latitude, camp.longitude)) for camp in camps),
+                  key=lambda item: item[1])
+
+
+# the antimeridian, both poles, and an ordinary place
+POINTS = [(10.0, 179.95), (-20.0, -179.99), (89.97, 30.0), (-89.9, -120.0), (45.0, 7.0)]
+CAMPS = camps_around(POINTS)
+
+
+@pytest.fixture(scope='module')
+def index():
+    index = CampIndex()
+    index.load(CAMPS)
+    return index
+
+
+def ids(found):
+    return [camp.id for camp, _ in found]
+
+
+@pytest.mark.parametrize("latitude, longitude", POINTS + [(0.0, 180.0), (90.0, 0.0), (-90.0, 0.0)])
+@pytest.mark.parametrize("radius", [5_000, 50_000, 300_000])
+def test_within_matches_brute_force(index, latitude, longitude, radius):
+    expected = [(camp, metres) for camp, metres in brute_force(CAMPS, latitude, longitude) if metres <= radius]
+    found = index.within(latitude, longitude, radius)
+    assert ids(found) == ids(expected)
+    assert [metres for _, metres in found] == pytest.approx([metres for _, metres in expected])
+
+
+@pytest.mark.parametrize("latitude, longitude", POINTS + [(0.0, -180.0), (90.0, 100.0)])
+@pytest.mark.parametrize("k", [1, 5, 60])
+def test_nearest_matches_brute_force(index, latitude, longitude, k):
+    assert ids(index.nearest(latitude, longitude, k)) == ids(brute_force(CAMPS, latitude, longitude)[:k])
+
+
+def test_nearest_within_a_max_distance(index):
+    latitude, longitude = POINTS[0]
+    expected = [camp for camp, metres in brute_force(CAMPS, latitude, longitude) if metres <= 20_000]
+    assert ids(index.nearest(latitude, longitude, k=1000, max_distance=20_000)) == [camp.id for camp in expected]
+    assert index.nearest(latitude, longitude, k=0) == []
+    assert CampIndex().nearest(latitude, longitude) == []
+
+
+def test_nearest_finds_a_camp_on_the_other_side_of_the_earth():
+    index = CampIndex()
+    index.load([CampEntry(1, 'far', 'city', -45.0, -170.0)])
+    assert ids(index.nearest(45.0, 10.0)) == [1]
+
+
+def test_add_moves_and_remove_drops_a_camp():
+    index = CampIndex()
+    index.load([CampEntry(1, 'a', 'city', 0.0, 0.0)])
+    index.add(CampEntry(1, 'a', 'city', 0.0, 179.99))
+    assert index.within(0.0, 0.0, 10_000) == []
+    assert ids(index.within(0.0, -179.99, 10_000)) == [1]
+    assert index.find('city', 'a').longitude == 179.99 and index.last_id == 1
+
+    index.remove(1)
+    assert len(index) == 0 and index.find('city', 'a') is None
+    assert index.within(0.0, 179.99, 10_000) == []
@@ -0,0 +1,65 @@
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("geoalchemy2")
+
+os.environ.setdefault("CHAIN_DATA_DIR", tempfile.mkdtemp(prefix="chain-test-"))
+
+from fastapi import HTTPException  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+from database.geodb import get_async_session  # noqa: E402
+
+
+class EmptyResult:
+    def all(self):
+        return []
+
+
+# answers every query with no rows and keeps the statements, so the tests need no database
+class RecordingSession:
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, statement):
+        self.statements.append(statement)
+        return EmptyResult()
+
+
+@pytest.fixture
+def session():
+    session = RecordingSession()
+
+    async def override():
+        yield session
+
+    main.app.dependency_overrides[get_async_session] = override
+    yield session
+    main.app.dependency_overrides.clear()
+
+
+def test_parse_bbox():
+    assert main.parse_bbox(None) is None
+    assert main.parse_bbox('-10,-10,10,10') == (-10.0, -10.0, 10.0, 10.0)
+    for bbox in ('1,2', 'a,b,c,d', '10,0,-10,1'):
+        with pytest.raises(HTTPException) as error:
+            main.parse_bbox(bbox)
+        assert error.value.status_code == 400
+
+
+@pytest.mark.parametrize("path", ["/load-camps", "/get_all_camps"])
+def test_listing_with_bbox(session, path):
+    response = TestClient(main.app).get(path, params={"bbox": "-10,-10,10,10", "limit": 5})
+    assert response.status_code == 200
+    assert response.json() == {"camps": [], "next_cursor": None}
+    assert "ST_MakeEnvelope" in str(session.statements[0])
+
+
+@pytest.mark.parametrize("path", ["/load-camps", "/get_all_camps", "/export-camps"])
+def test_listing_with_bad_bbox(session, path):
+    response = TestClient(main.app).get(path, params={"bbox": "10,0,-10,1"})
+    assert response.status_code == 400
@@ -0,0 +1,206 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from blockchain import storage
+from blockchain.Blockchain import Blockchain
+from blockchain.block import Block, BlockHeader, Transaction
+from blockchain.difficulty import DEFAULT_TARGET, target_for_zero_bits
+from blockchain.storage import INDEX_ENTRY, INDEX_FILE, RECORD_HEADER, ChainStore, scan_blocks
+
+
+# blocks without proof-of-work: the store only cares about their bytes and hashes
+def blocks(count):
+    previous_hash = bytes(32)
+    chain = []
+    for index in range(1, count + 1):
+        block = Block(
+            header=BlockHeader(index, 1733924256549201 + index, previous_hash,
+                               hashlib.sha256(str(index).encode()).digest(),
+                               hashlib.sha256(str(index).encode() + b'state').digest(), DEFAULT_TARGET),
+            transactions=[Transaction(str(index), 'camp', f'user{index}', 10)],
+            nonce=index,
+            hash=hashlib.sha256(str(index).encode() + b'block').digest(),
+            deltas={'camp': -10, f'user{index}': 10},
+        )
+        chain.append(block)
+        previous_hash = block.hash
+    return chain
+
+
+def written(directory, chain, **options):
+    store = ChainStore(str(directory), **options)
+    for block in chain:
+        store.append(block)
+    store.close()
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith('segment-'))
+
+
+def last_segment(directory):
+    return os.path.join(directory, segments(directory)[-1])
+
+
+def assert_holds(directory, chain):
+    store = ChainStore(str(directory))
+    try:
+        assert len(store) == len(chain)
+        assert [block.to_dict() for block in store] == [block.to_dict() for block in chain]
+        assert store.raw_hashes() == b''.join(block.hash for block in chain)
+    finally:
+        store.close()
+
+
+def test_reopen_reads_back_every_block(tmp_path):
+    chain = blocks(5)
+    written(tmp_path, chain)
+    assert_holds(tmp_path, chain)
+
+
+@pytest.mark.parametrize("cut", [1, RECORD_HEADER.size + 1])
+def test_a_short_last_record_is_cut_off(tmp_path, cut):
+    chain = blocks(5)
+    written(tmp_path, chain)
+    path = last_segment(tmp_path)
+    os.truncate(path, os.path.getsize(path) - cut)
+
+    assert_holds(tmp_path, chain[:4])
+    # the store goes on from the last whole block
+    store = ChainStore(str(tmp_path))
+    store.append(chain[4])
+    store.close()
+    assert_holds(tmp_path, chain)
+
+
+def test_a_last_record_failing_its_checksum_is_cut_off(tmp_path):
+    chain = blocks(5)
+    written(tmp_path, chain)
+    path = last_segment(tmp_path)
+    with open(path, 'r+b') as file:
+        file.seek(-2, os.SEEK_END)
+        byte = file.read(1)
+        file.seek(-2, os.SEEK_END)
+        file.write(bytes([byte[0] ^ 1]))
+
+    assert_holds(tmp_path, chain[:4])
+
+
+def test_a_partial_index_entry_is_dropped(tmp_path):
+    chain = blocks(5)
+    written(tmp_path, chain)
+    with open(os.path.join(tmp_path, INDEX_FILE), 'ab') as index:
+        index.write(b'\x01' * (INDEX_ENTRY.size // 2))
+
+    assert_holds(tmp_path, chain)
+
+
+def test_a_record_without_its_index_entry_is_dropped(tmp_path):
+    chain = blocks(5)
+    written(tmp_path, chain[:4])
+    size = os.path.getsize(last_segment(tmp_path))
+    written(tmp_path, chain[4:])
+    index = os.path.join(tmp_path, INDEX_FILE)
+    os.truncate(index, os.path.getsize(index) - INDEX_ENTRY.size)
+
+    assert_holds(tmp_path, chain[:4])
+    assert os.path.getsize(last_segment(tmp_path)) == size
+
+
+def test_truncate_drops_the_blocks_after_a_length(tmp_path):
+    chain = blocks(6)
+    store = ChainStore(str(tmp_path))
+    for block in chain:
+        store.append(block)
+    store.truncate(3)
+    assert len(store) == 3
+    with pytest.raises(IndexError):
+        store[3]
+
+    # another branch is appended in their place
+    branch = blocks(4)[3:]
+    branch[0].header = BlockHeader(4, 1, chain[2].hash, bytes(32), bytes(32), DEFAULT_TARGET)
+    branch[0].hash = b'\x07' * 32
+    store.append(branch[0])
+    assert store[3].hash == branch[0].hash
+    store.close()
+
+    assert_holds(tmp_path, chain[:3] + branch)
+
+
+def test_segments_roll_over_and_truncate_removes_later_ones(tmp_path, monkeypatch):
+    chain = blocks(20)
+    monkeypatch.setattr(storage, 'SEGMENT_SIZE', 2 * len(chain[0].encode()))
+    written(tmp_path, chain)
+    assert len(segments(tmp_path)) >= 5
+
+    assert_holds(tmp_path, chain)
+    assert [block.hash for _, block in scan_blocks(str(tmp_path), 1, 20)] == [block.hash for block in chain]
+
+    store = ChainStore(str(tmp_path))
+    segment, offset, _ = store._entry(5)
+    store.truncate(5)
+    store.close()
+    # the segment the dropped blocks start in is cut where they start, the later ones are gone
+    assert segments(tmp_path)[-1] == storage._segment_name(segment)
+    assert os.path.getsize(last_segment(tmp_path)) == offset
+    assert_holds(tmp_path, chain[:5])
+
+
+def test_unsynced_blocks_are_synced_after_the_interval(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(storage.os, 'fsync', lambda fd: (synced.append(fd), fsync(fd))[1])
+
+    store = ChainStore(str(tmp_path), sync_every=1000, sync_interval=0.2)
+    try:
+        synced.clear()
+        store.append(blocks(1)[0])
+        assert store._unsynced == 1 and not synced
+        deadline = time.monotonic() + 5
+        while store._unsynced and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # no more appends: the background thread synced the block
+        assert store._unsynced == 0
+        assert store._segment.fileno() in synced and store._index.fileno() in synced
+    finally:
+        store.close()
+
+
+def test_scan_blocks_fails_on_a_corrupt_record(tmp_path):
+    chain = blocks(3)
+    written(tmp_path, chain)
+    store = ChainStore(str(tmp_path))
+    segment, offset, _ = store._entry(1)
+    store.close()
+    with open(os.path.join(tmp_path, storage._segment_name(segment)), 'r+b') as file:
+        file.seek(offset + RECORD_HEADER.size + 5)
+        byte = file.read(1)
+        file.seek(offset + RECORD_HEADER.size + 5)
+        file.write(bytes([byte[0] ^ 1]))
+
+    assert [block.hash for _, block in scan_blocks(str(tmp_path), 1, 1)] == [chain[0].hash]
+    with pytest.raises(ValueError, match="block 2"):
+        list(scan_blocks(str(tmp_path), 1, 3))
+
+
+@pytest.mark.parametrize("rules", [{'checkpoint_interval': 3}, {'retarget_interval': 5}, {'block_interval': 30},
+                                   {'initial_target': target_for_zero_bits(5)}])
+def test_a_stored_chain_cannot_be_reopened_with_other_rules(tmp_path, rules):
+    options = {'mining_workers': 1, 'initial_target': target_for_zero_bits(4), 'checkpoint_interval': 2}
+    blockchain = Blockchain(store=ChainStore(str(tmp_path)), **options)
+    for _ in range(4):
+        blockchain.mine_block()
+    blockchain.chain.close()
+
+    store = ChainStore(str(tmp_path))
+    try:
+        with pytest.raises(ValueError, match=f"other chain rules \\({next(iter(rules))} "):
+            Blockchain(store=store, **{**options, **rules})
+        reopened = Blockchain(store=store, **options)
+        assert len(reopened.chain) == 5 and reopened.is_chain_valid(full=True)
+    finally:
+        store.close()
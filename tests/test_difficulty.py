@@ -0,0 +1,63 @@
+import pytest
+
+from blockchain.block import BlockHeader
+from blockchain.difficulty import MAX_ADJUSTMENT, MAX_TARGET, retarget, target_at, target_for_zero_bits
+
+INITIAL_TARGET = target_for_zero_bits(20)
+INTERVAL = 4
+BLOCK_INTERVAL = 60
+# a window of INTERVAL blocks spans INTERVAL - 1 block intervals, in microseconds
+EXPECTED = (INTERVAL - 1) * BLOCK_INTERVAL * 1_000_000
+
+
+def headers(spacing, count, target=INITIAL_TARGET):
+    # blocks `spacing` seconds apart, every one with `target`
+    return {height: BlockHeader(height, height * spacing * 1_000_000, bytes(32), bytes(32), bytes(32), target)
+            for height in range(1, count + 1)}
+
+
+def target(chain, index):
+    return target_at(index, chain.__getitem__, INITIAL_TARGET, INTERVAL, BLOCK_INTERVAL)
+
+
+def test_the_first_block_gets_the_initial_target():
+    assert target({}, 1) == INITIAL_TARGET
+
+
+def test_the_target_only_changes_at_the_start_of_a_window():
+    # blocks twice as fast as they should be
+    chain = headers(BLOCK_INTERVAL // 2, 2 * INTERVAL)
+    for index in range(2, INTERVAL + 1):
+        assert target(chain, index) == INITIAL_TARGET
+    assert target(chain, INTERVAL + 1) == INITIAL_TARGET // 2
+    # inside the next window a block keeps its parent's target
+    chain[INTERVAL + 1].target = INITIAL_TARGET // 2
+    assert target(chain, INTERVAL + 2) == INITIAL_TARGET // 2
+
+
+def test_a_window_on_schedule_keeps_the_target():
+    chain = headers(BLOCK_INTERVAL, INTERVAL)
+    assert target(chain, INTERVAL + 1) == INITIAL_TARGET
+
+
+def test_slow_blocks_raise_the_target():
+    chain = headers(BLOCK_INTERVAL * 3, INTERVAL)
+    assert target(chain, INTERVAL + 1) == INITIAL_TARGET * 3
+
+
+@pytest.mark.parametrize("spacing, clamped", [(0, EXPECTED // MAX_ADJUSTMENT),
+                                               (BLOCK_INTERVAL * 100, EXPECTED * MAX_ADJUSTMENT)])
+def test_a_window_moves_the_target_by_at_most_max_adjustment(spacing, clamped):
+    chain = headers(spacing, INTERVAL)
+    assert target(chain, INTERVAL + 1) == INITIAL_TARGET * clamped // EXPECTED
+
+
+def test_retarget_clamps_the_actual_time_and_the_result():
+    assert retarget(1000, EXPECTED // 2, EXPECTED) == 500
+    assert retarget(1000, 0, EXPECTED) == 1000 // MAX_ADJUSTMENT
+    # clocks set back give a negative time, it is clamped like a window that was too fast
+    assert retarget(1000, -EXPECTED, EXPECTED) == 1000 // MAX_ADJUSTMENT
+    assert retarget(1000, EXPECTED * 10, EXPECTED) == 1000 * MAX_ADJUSTMENT
+    # the target never reaches 0 or goes above MAX_TARGET
+    assert retarget(1, 0, EXPECTED) == 1
+    assert retarget(MAX_TARGET, EXPECTED * 10, EXPECTED) == MAX_TARGET
@@ -0,0 +1,140 @@
+import pytest
+
+from blockchain.mempool import Mempool
+
+
+def totals(mempool):
+    return dict(mempool.sent), dict(mempool.received)
+
+
+def test_add_keeps_arrival_order_and_totals():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 3, 'a')
+    mempool.add('alice', 'carol', 2, 'b')
+    mempool.add('bob', 'carol', 1, 'c')
+
+    assert [transaction.id for transaction in mempool] == ['a', 'b', 'c']
+    assert totals(mempool) == ({'alice': 5, 'bob': 1}, {'bob': 3, 'carol': 3})
+    assert mempool.debits('alice') == 5 and mempool.debits('dave') == 0
+
+    mempool.remove('b')
+    assert totals(mempool) == ({'alice': 3, 'bob': 1}, {'bob': 3, 'carol': 1})
+
+
+def test_duplicate_ids_are_rejected_while_pending_in_flight_or_confirmed():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 1, 'a')
+    with pytest.raises(ValueError, match="already submitted"):
+        mempool.add('alice', 'bob', 1, 'a')
+
+    mempool.drain()
+    with pytest.raises(ValueError, match="already submitted"):
+        mempool.add('alice', 'bob', 1, 'a')
+    mempool.confirm()
+    with pytest.raises(ValueError, match="already submitted"):
+        mempool.add('alice', 'bob', 1, 'a')
+
+    # an id that was rolled back with its block may be submitted again
+    mempool.forget(['a'])
+    mempool.add('alice', 'bob', 1, 'a')
+    assert 'a' in mempool
+
+
+def test_only_the_most_recent_confirmed_ids_are_remembered():
+    mempool = Mempool(remembered=2)
+    mempool.confirm_ids(['a', 'b', 'c'])
+    assert 'a' not in mempool and 'b' in mempool and 'c' in mempool
+
+
+def test_a_full_pool_rejects_by_default():
+    mempool = Mempool(capacity=2)
+    mempool.add('alice', 'bob', 1, 'a')
+    mempool.add('alice', 'bob', 1, 'b')
+    with pytest.raises(OverflowError, match="full"):
+        mempool.add('alice', 'bob', 1, 'c')
+    assert [transaction.id for transaction in mempool] == ['a', 'b']
+
+
+def test_a_full_pool_can_evict_the_oldest_transaction():
+    mempool = Mempool(capacity=2, eviction='oldest')
+    mempool.add('alice', 'bob', 1, 'a')
+    mempool.add('carol', 'bob', 2, 'b')
+    evicted = mempool.add('dave', 'erin', 4, 'c')
+
+    assert [transaction.id for transaction in evicted] == ['a']
+    assert [transaction.id for transaction in mempool] == ['b', 'c']
+    assert totals(mempool) == ({'carol': 2, 'dave': 4}, {'bob': 2, 'erin': 4})
+    # the evicted transaction was never confirmed, its id is free again
+    assert 'a' not in mempool
+    assert mempool.dropped['a'] == (evicted[0], "evicted, the mempool was full") and mempool.dropped_total == 1
+
+
+def test_only_the_most_recent_drops_are_kept_and_a_resubmitted_one_is_pending_again():
+    mempool = Mempool(capacity=1, eviction='oldest', remembered=2)
+    for transaction_id in 'abcd':
+        mempool.add('alice', 'bob', 1, transaction_id)
+    assert list(mempool.dropped) == ['b', 'c'] and mempool.dropped_total == 3
+
+    mempool.add('alice', 'bob', 1, 'b')
+    assert list(mempool.dropped) == ['c', 'd'] and mempool.dropped_total == 4
+
+
+def test_unknown_eviction_policy():
+    with pytest.raises(ValueError, match="eviction policy"):
+        Mempool(eviction='newest')
+
+
+def test_drain_moves_the_pool_to_the_in_flight_batch():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 3, 'a')
+    batch = mempool.drain()
+    assert list(batch.transactions) == ['a'] and batch.sent == {'alice': 3} and batch.received == {'bob': 3}
+    assert len(mempool) == 0 and totals(mempool) == ({}, {})
+
+    # new submissions go to the next block, but the in-flight ones still count as spent
+    mempool.add('alice', 'carol', 1, 'b')
+    assert mempool.debits('alice') == 4
+    with pytest.raises(RuntimeError, match="already being mined"):
+        mempool.drain()
+
+
+def test_confirm_recycles_the_batch_containers():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 3, 'a')
+    batch = mempool.drain()
+    mempool.add('alice', 'carol', 1, 'b')
+    mempool.confirm()
+
+    assert mempool.in_flight is None and mempool.debits('alice') == 1
+    assert batch.transactions == {} and batch.sent == {} and batch.received == {}
+    # the next drain hands the emptied containers back to the pool
+    assert mempool.drain().transactions is not batch.transactions
+    assert mempool.transactions is batch.transactions
+
+
+def test_restore_puts_the_batch_back_in_front():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 3, 'a')
+    mempool.add('bob', 'carol', 1, 'b')
+    mempool.drain()
+    mempool.add('alice', 'carol', 2, 'c')
+    mempool.restore()
+
+    assert mempool.in_flight is None
+    assert [transaction.id for transaction in mempool] == ['a', 'b', 'c']
+    assert totals(mempool) == ({'alice': 5, 'bob': 1}, {'bob': 3, 'carol': 3})
+    assert mempool.debits('alice') == 5
+
+    # nothing in flight, nothing to restore
+    mempool.restore()
+    assert len(mempool) == 3
+
+
+def test_batch_remove_updates_its_totals():
+    mempool = Mempool()
+    mempool.add('alice', 'bob', 3, 'a')
+    mempool.add('alice', 'carol', 2, 'b')
+    batch = mempool.drain()
+    batch.remove('a')
+    assert list(batch.transactions) == ['b']
+    assert batch.sent == {'alice': 2} and batch.received == {'carol': 2}
@@ -0,0 +1,51 @@
+import hashlib
+
+import pytest
+
+from blockchain.block import Transaction
+from blockchain.merkle import leaf_hash, merkle_proof, merkle_root, node_hash, verify_proof
+
+
+def transactions(count):
+    return [Transaction(str(index), 'alice', f'user{index}', index + 1) for index in range(count)]
+
+
+def test_root_of_no_transactions_and_of_one():
+    assert merkle_root([]) == hashlib.sha256(b'').digest()
+    [transaction] = transactions(1)
+    assert merkle_root([transaction]) == leaf_hash(transaction)
+    assert merkle_proof([transaction], 0) == []
+
+
+def test_an_odd_node_is_carried_up():
+    a, b, c = transactions(3)
+    assert merkle_root([a, b, c]) == node_hash(node_hash(leaf_hash(a), leaf_hash(b)), leaf_hash(c))
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 4, 5, 7, 8, 13])
+def test_every_transaction_has_a_proof_to_the_root(count):
+    block = transactions(count)
+    root = merkle_root(block)
+    for position, transaction in enumerate(block):
+        assert verify_proof(transaction, merkle_proof(block, position), root)
+
+
+def test_a_proof_does_not_verify_what_was_tampered_with():
+    block = transactions(5)
+    root = merkle_root(block)
+    proof = merkle_proof(block, 2)
+
+    tampered = Transaction(block[2].id, block[2].sender, 'mallory', block[2].amount)
+    assert not verify_proof(tampered, proof, root)
+    # another transaction of the block, a sibling hash changed, a side flipped
+    assert not verify_proof(block[3], proof, root)
+    assert not verify_proof(block[2], [dict(proof[0], hash=bytes(32).hex())] + proof[1:], root)
+    flipped = 'left' if proof[0]['side'] == 'right' else 'right'
+    assert not verify_proof(block[2], [dict(proof[0], side=flipped)] + proof[1:], root)
+    assert not verify_proof(block[2], proof, merkle_root(block[:4]))
+
+
+@pytest.mark.parametrize("position", [-1, 5])
+def test_a_position_out_of_range_has_no_proof(position):
+    with pytest.raises(IndexError):
+        merkle_proof(transactions(5), position)
@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import hashlib
+
+import pytest
+
+from blockchain.mining import START_METHOD, SUFFIX_SPAN, Miner, search_range
+
+ENCODED = b'{"index":2,"previous_hash":"00ff"}'
+
+
+def digests(start, stop):
+    return [hashlib.sha256(ENCODED + str(nonce).encode()).digest() for nonce in range(start, stop)]
+
+
+# the first nonce in [start, stop) whose plain sha256 is at most `target` (32 big-endian bytes), the way the search
+# is specified
+def naive(target, start, stop):
+    for nonce, digest in enumerate(digests(start, stop), start=start):
+        if digest <= target:
+            return nonce, digest.hex()
+    return None
+
+
+RANGES = [
+    (0, 10),
+    (0, SUFFIX_SPAN + 5),                    # the plain loop below SUFFIX_SPAN, then the suffix table
+    (SUFFIX_SPAN - 3, SUFFIX_SPAN + 3),      # across the first span boundary
+    (3 * SUFFIX_SPAN - 7, 5 * SUFFIX_SPAN + 11),  # unaligned start and stop, several spans
+    (12 * SUFFIX_SPAN + 17, 12 * SUFFIX_SPAN + 40),  # shorter than one span
+    (99 * SUFFIX_SPAN + 9_990, 100 * SUFFIX_SPAN + 20),  # where the leading digits gain a digit
+]
+
+
+@pytest.mark.parametrize("start, stop", RANGES)
+def test_search_range_matches_a_plain_scan(start, stop):
+    in_range = digests(start, stop)
+    for nonce in (start, SUFFIX_SPAN - 1, SUFFIX_SPAN, (start + stop) // 2, stop - 1):
+        if start <= nonce < stop:
+            target = in_range[nonce - start]
+            assert search_range(ENCODED, target, start, stop) == naive(target, start, stop)
+
+
+@pytest.mark.parametrize("start, stop", RANGES)
+def test_search_range_returns_the_first_nonce_that_meets_the_target(start, stop):
+    # every nonce whose hash is lower than the hash of every nonce before it in the range is the first match for
+    # a target of its own hash, the last one of them is the only match for the lowest hash of the range
+    lowest = None
+    for nonce, digest in enumerate(digests(start, stop), start=start):
+        if lowest is None or digest < lowest:
+            lowest = digest
+            assert search_range(ENCODED, digest, start, stop) == (nonce, digest.hex())
+    # just below the lowest hash of the range nothing in the range matches
+    below = (int.from_bytes(lowest, 'big') - 1).to_bytes(32, 'big')
+    assert search_range(ENCODED, below, start, stop) is None
+    assert search_range(ENCODED, bytes(32), start, stop) is None
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_miner_finds_a_nonce_that_meets_the_target(workers):
+    target = int.from_bytes(bytes([0, 0x0f]) + b'\xff' * 30, 'big')
+    result = Miner(workers=workers, chunk_size=SUFFIX_SPAN).mine(ENCODED, target)
+
+    digest = hashlib.sha256(ENCODED + str(result.nonce).encode()).digest()
+    assert result.hash == digest.hex() and int.from_bytes(digest, 'big') <= target
+    if workers == 1:
+        assert result.nonce == naive(target.to_bytes(32, 'big'), 0, result.nonce + 1)[0]
+        assert result.hashes == result.nonce + 1
+    # a worker tries whole chunks, so the one that found the nonce tried every nonce of its chunk before it
+    assert result.hashes > result.nonce % SUFFIX_SPAN
+
+
+def test_a_parallel_search_reports_progress_and_stops_when_asked():
+    context = multiprocessing.get_context(START_METHOD)
+    progress = context.Value('Q', 0)
+    stop = context.Event()
+    threading.Timer(0.5, stop.set).start()
+    assert Miner(workers=2, chunk_size=SUFFIX_SPAN).mine(ENCODED, 0, progress=progress, stop=stop) is None
+    assert progress.value > 0 and progress.value % SUFFIX_SPAN == 0
+    assert multiprocessing.active_children() == []
+
+
+def test_a_killed_worker_fails_the_search_instead_of_hanging_it():
+    def kill_a_worker():
+        deadline = time.time() + 10
+        while not multiprocessing.active_children() and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)
+        os.kill(multiprocessing.active_children()[0].pid, signal.SIGKILL)
+
+    threading.Thread(target=kill_a_worker, daemon=True).start()
+    # no hash meets a target of 0, the workers search until one of them is gone
+    with pytest.raises(RuntimeError, match="exited with code -9"):
+        Miner(workers=2).mine(b'block', 0)
+    assert multiprocessing.active_children() == []
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from blockchain.mining_jobs import JobState, MiningJobManager
+
+
+def wait(job, timeout=10):
+    deadline = time.time() + timeout
+    while not job.is_finished() and time.time() < deadline:
+        time.sleep(0.01)
+    return job.state
+
+
+def never_done(blockchain):
+    # no hash meets a target of 1, the job mines until it is stopped
+    blockchain.target_at = lambda index: 1
+
+
+def test_a_job_appends_its_block(node):
+    blockchain, writer = node
+    writer.call(blockchain.add_balance, 'alice', 10)
+    writer.call(blockchain.mine_block)
+    writer.call(blockchain.add_transaction, 'alice', 'bob', 4, 'to-bob')
+    jobs = MiningJobManager(blockchain, writer)
+    job = jobs.submit()
+
+    assert wait(job) == JobState.DONE
+    assert len(blockchain.chain) == 3 and blockchain.chain[-1] is job.block
+    assert job.to_dict()['block']['transactions'][0]['id'] == 'to-bob'
+    assert blockchain.balance('bob') == 4 and len(blockchain.mempool) == 0
+    with pytest.raises(RuntimeError, match="already done"):
+        jobs.cancel(job.id)
+
+
+def test_only_one_job_mines_at_a_time(node):
+    blockchain, writer = node
+    never_done(blockchain)
+    jobs = MiningJobManager(blockchain, writer)
+    job = jobs.submit()
+    try:
+        with pytest.raises(RuntimeError, match="already being mined"):
+            jobs.submit()
+    finally:
+        jobs.cancel(job.id)
+        wait(job)
+
+
+def test_a_cancelled_job_gives_its_transactions_back(node):
+    blockchain, writer = node
+    writer.call(blockchain.add_balance, 'alice', 10)
+    writer.call(blockchain.mine_block)
+    writer.call(blockchain.add_transaction, 'alice', 'bob', 4, 'to-bob')
+    never_done(blockchain)
+    jobs = MiningJobManager(blockchain, writer)
+    job = jobs.submit()
+    assert 'to-bob' not in [transaction.id for transaction in blockchain.mempool]
+
+    assert jobs.cancel(job.id) is job
+    assert wait(job) == JobState.CANCELLED
+    assert len(blockchain.chain) == 2
+    assert [transaction.id for transaction in blockchain.mempool] == ['to-bob']
+    assert blockchain.mempool.in_flight is None
+    assert jobs.cancel('unknown') is None
+
+
+def test_a_job_that_mines_too_long_times_out(node):
+    blockchain, writer = node
+    writer.call(blockchain.add_balance, 'alice', 10)
+    never_done(blockchain)
+    jobs = MiningJobManager(blockchain, writer)
+    job = jobs.submit(timeout=0.2)
+
+    assert wait(job) == JobState.TIMED_OUT
+    assert 'longer than 0.2 seconds' in job.error
+    assert len(blockchain.chain) == 1 and blockchain.balances == {'alice': 10}
+    # the next job can start right away
+    del blockchain.target_at
+    assert wait(jobs.submit()) == JobState.DONE
+    assert blockchain.balance('alice') == 10
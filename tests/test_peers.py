@@ -0,0 +1,116 @@
+import json
+import time
+
+from blockchain.peers import PeerSync
+from blockchain.writer import ChainWriter
+
+
+class FakePeer:
+    """Answers /tip and /get_chain from a Blockchain the way the API does, or with `answers` where given."""
+
+    def __init__(self, blockchain, url='http://peer', answers=None):
+        self.blockchain = blockchain
+        self.url = url
+        self.answers = answers or {}
+
+    def get(self, path, **params):
+        if path in self.answers:
+            return self.answers[path]
+        if path == '/tip':
+            return {'height': len(self.blockchain.chain), 'hash': self.blockchain.tip_hash().hex(),
+                    'work': f'{self.blockchain.work():x}'}
+        start = params['start']
+        end = min(params.get('end') or len(self.blockchain.chain), start + params['limit'] - 1)
+        blocks = self.blockchain.chain[start - 1:end]
+        view = 'summary' if params.get('headers_only') == 'true' else 'to_dict'
+        # through JSON, so nothing is shared with the peer's chain
+        return json.loads(json.dumps({'chain': [getattr(block, view)() for block in blocks]}))
+
+    def close(self):
+        pass
+
+
+def peer_sync(blockchain, *peers, **options):
+    writer = ChainWriter(blockchain)
+    sync = PeerSync(blockchain, writer, **options)
+    for peer in peers:
+        sync.add_peer(peer.url)
+        sync.peers[peer.url] = peer
+    return sync, writer
+
+
+def test_sync_adopts_the_branch_with_more_work(chain):
+    ours = chain()
+    ours.add_balance('alice', 10)
+    ours.mine_block()
+    theirs = chain(store=list(ours.chain))
+    theirs.add_transaction('alice', 'bob', 4)
+    for _ in range(3):
+        theirs.mine_block()
+    ours.mine_block()
+
+    sync, writer = peer_sync(ours, FakePeer(theirs))
+    try:
+        [status] = sync.sync_all()
+    finally:
+        writer.stop()
+    assert status['error'] is None
+    assert (status['fork'], status['adopted'], status['rolled_back']) == (2, 3, 1)
+    assert [block.hash for block in ours.chain] == [block.hash for block in theirs.chain]
+    assert ours.balance('bob') == 4
+
+
+def test_a_branch_checked_against_a_tip_that_moved_is_not_adopted(chain):
+    ours = chain()
+    theirs = chain(store=list(ours.chain))
+    for _ in range(3):
+        theirs.mine_block()
+    peer = FakePeer(theirs)
+    sync, writer = peer_sync(ours, peer)
+
+    # a block is mined here while the bodies of the peer's branch are downloaded
+    get = peer.get
+
+    def get_mining_once(path, **params):
+        if path == '/get_chain' and 'headers_only' not in params and len(ours.chain) == 1:
+            writer.call(ours.mine_block)
+        return get(path, **params)
+
+    peer.get = get_mining_once
+    try:
+        [status] = sync.sync_all()
+        assert 'changed' in status['error']
+        assert len(ours.chain) == 2 and ours.chain[1].hash != theirs.chain[1].hash
+
+        # the next round starts from the new tip
+        [status] = sync.sync_all()
+    finally:
+        writer.stop()
+    assert status['error'] is None and status['rolled_back'] == 1
+    assert [block.hash for block in ours.chain] == [block.hash for block in theirs.chain]
+
+
+def test_a_malformed_peer_does_not_stop_the_sync_thread(chain):
+    ours = chain()
+    # claims more work than we have, then sends no blocks
+    broken = FakePeer(ours, 'http://broken', answers={
+        '/tip': {'height': 5, 'hash': '00', 'work': f'{ours.work() * 10:x}'},
+        '/get_chain': {'chain': []},
+    })
+    garbled = FakePeer(ours, 'http://garbled', answers={'/tip': ['not', 'a', 'tip']})
+
+    sync, writer = peer_sync(ours, broken, garbled, interval=0.01)
+    sync.start()
+    try:
+        deadline = time.time() + 5
+        while time.time() < deadline and not all(status['error'] for status in sync.status.values()):
+            time.sleep(0.01)
+        # a peer removed in the middle of a round does not break it either
+        sync.remove_peer(garbled.url)
+        time.sleep(0.05)
+        assert sync._thread.is_alive()
+        assert 'sent 0 blocks' in sync.status[broken.url]['error']
+    finally:
+        sync.stop()
+        writer.stop()
+    assert len(ours.chain) == 1
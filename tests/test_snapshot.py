@@ -0,0 +1,52 @@
+import pytest
+
+from blockchain.snapshot import export_snapshot, import_snapshot, restore_snapshot
+
+
+@pytest.fixture
+def snapshot(chain, tmp_path):
+    blockchain = chain(checkpoint_interval=3)
+    blockchain.add_balance('alice', 10)
+    blockchain.add_balance('bob', 2.5)
+    blockchain.mine_block()
+    # ids and addresses longer than 65535 bytes still fit
+    blockchain.add_transaction('alice', 'c' * 70_000, 4, 'x' * 70_000)
+    blockchain.add_transaction('bob', 'alice', 0.5)
+    for _ in range(4):
+        blockchain.mine_block()
+    path = str(tmp_path / 'chain.snapshot')
+    export_snapshot(blockchain, path)
+    return blockchain, path
+
+
+@pytest.mark.parametrize("trusted", [False, True])
+def test_snapshot_round_trip(snapshot, trusted):
+    blockchain, path = snapshot
+    restored = import_snapshot(path, trusted=trusted, mining_workers=1)
+
+    assert restored.rules() == blockchain.rules()
+    assert [block.to_dict() for block in restored.chain] == [block.to_dict() for block in blockchain.chain]
+    assert restored.balances_at(len(restored.chain)) == blockchain.balances_at(len(blockchain.chain))
+    assert restored.balance('c' * 70_000) == 4 and isinstance(restored.balance('alice'), float)
+    assert restored.is_chain_valid(full=True)
+
+
+@pytest.mark.parametrize("trusted", [False, True])
+def test_corrupt_snapshot_is_rejected(snapshot, trusted):
+    _, path = snapshot
+    with open(path, 'r+b') as file:
+        file.seek(200)
+        byte = file.read(1)
+        file.seek(200)
+        file.write(bytes([byte[0] ^ 0xFF]))
+
+    chain = []
+    with pytest.raises(ValueError, match="checksum"):
+        restore_snapshot(path, chain, trusted=trusted)
+    assert chain == []
+
+
+def test_snapshot_with_other_rules_is_rejected(snapshot):
+    blockchain, path = snapshot
+    with pytest.raises(ValueError, match="this chain runs with"):
+        restore_snapshot(path, [], blockchain.rules()._replace(checkpoint_interval=100))
@@ -0,0 +1,148 @@
+import json
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("geoalchemy2")
+
+os.environ.setdefault("CHAIN_DATA_DIR", tempfile.mkdtemp(prefix="chain-test-"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+
+
+# json.dumps writes NaN and Infinity, and the API's JSON parser reads them back as floats
+def post(path, body):
+    return TestClient(main.app).post(path, content=json.dumps(body), headers={'content-type': 'application/json'})
+
+
+@pytest.mark.parametrize("amount", [float('nan'), float('inf')])
+def test_non_finite_amounts_are_rejected(amount):
+    response = post('/add_balance', {'receiver': 'nobody', 'amount': amount})
+    assert response.status_code == 400
+
+    response = post('/add_transaction', {'sender': 'nobody', 'receiver': 'x', 'amount': amount})
+    assert response.status_code == 400
+    assert 'finite' in response.json()['detail']
+
+    response = post('/add_transactions', [{'sender': 'nobody', 'receiver': 'x', 'amount': amount}])
+    assert response.status_code == 200
+    assert response.json()['results'][0]['status'] == 'rejected'
+    assert main.blockchain.mempool.debits('nobody') == 0
+
+
+def test_full_validity_check():
+    response = TestClient(main.app).get('/valid', params={'full': 'true'})
+    assert response.status_code == 200
+    assert response.json()['message'] == 'The Blockchain is valid.'
+
+
+@pytest.mark.parametrize("content_type", ['application/json', 'application/x-ndjson'])
+def test_oversized_transaction_bodies_are_refused(monkeypatch, content_type):
+    monkeypatch.setattr(main, 'ADD_TRANSACTIONS_MAX_BYTES', 1000)
+    client = TestClient(main.app)
+
+    def body(count):
+        transactions = [{'sender': 'nobody', 'receiver': 'x', 'amount': 1}] * count
+        if content_type == 'application/json':
+            return json.dumps(transactions).encode()
+        return '\n'.join(json.dumps(transaction) for transaction in transactions).encode()
+
+    response = client.post('/add_transactions', content=body(5), headers={'content-type': content_type})
+    assert response.status_code == 200
+
+    # with a Content-Length, and without one (chunked, so the bound is found while reading)
+    large = body(100)
+    response = client.post('/add_transactions', content=large, headers={'content-type': content_type})
+    assert response.status_code == 413
+    chunks = (large[start:start + 100] for start in range(0, len(large), 100))
+    response = client.post('/add_transactions', content=chunks, headers={'content-type': content_type})
+    assert response.status_code == 413
+
+
+def test_chain_cursor_and_stream_stay_on_one_branch(chain, monkeypatch):
+    def three_blocks(store=None):
+        blockchain = chain(store=store)
+        for _ in range(3 - len(blockchain.chain)):
+            blockchain.mine_block()
+        return blockchain
+
+    b1 = three_blocks()
+    b2 = three_blocks(store=list(b1.chain[:1]))
+    monkeypatch.setattr(main, 'blockchain', b1)
+    client = TestClient(main.app)
+
+    page = client.get('/get_chain', params={'limit': 1}).json()
+    assert [block['index'] for block in page['chain']] == [1]
+    assert client.get('/get_chain', params={'cursor': page['next_cursor']}).json()['chain'][0]['index'] == 2
+
+    # blocks 2 and 3 were replaced by another branch: the cursor into the old one is refused
+    monkeypatch.setattr(main, 'blockchain', b2)
+    assert client.get('/get_chain', params={'cursor': page['next_cursor']}).status_code == 409
+
+    # a block of another branch read in the middle of a range ends the stream and fails the page
+    monkeypatch.setattr(b1, 'chain', b1.chain[:2] + b2.chain[2:])
+    monkeypatch.setattr(main, 'blockchain', b1)
+    lines = client.get('/get_chain', params={'stream': 'true'}).text.splitlines()
+    assert [json.loads(line)['index'] for line in lines] == [1, 2]
+    assert client.get('/get_chain').status_code == 409
+
+
+def test_balance_reads_answer_from_the_writer(chain, monkeypatch):
+    blockchain = chain()
+    blockchain.add_balance('alice', 10)
+    blockchain.mine_block()
+    blockchain.add_transaction('alice', 'bob', 4)
+    blockchain.mine_block()
+    monkeypatch.setattr(main, 'blockchain', blockchain)
+    client = TestClient(main.app)
+
+    assert client.get('/balance/alice').json() == {'address': 'alice', 'balance': 6, 'height': 3}
+    assert client.get('/balance/alice', params={'height': 2}).json()['balance'] == 10
+    assert client.get('/balance/alice', params={'height': 4}).status_code == 404
+    assert client.get('/balances', params={'height': 2}).json() == {'height': 2, 'balances': {'alice': 10}}
+    assert client.get('/balances', params={'height': 0}).status_code == 404
+
+
+def test_merkle_proof_endpoint(chain, monkeypatch):
+    from blockchain.block import Transaction
+    from blockchain.merkle import verify_proof
+
+    blockchain = chain()
+    blockchain.add_balance('alice', 10)
+    blockchain.mine_block()
+    for receiver in ('bob', 'carol', 'dave'):
+        blockchain.add_transaction('alice', receiver, 1)
+    blockchain.mine_block()
+    monkeypatch.setattr(main, 'blockchain', blockchain)
+    client = TestClient(main.app)
+
+    for position in range(3):
+        answer = client.get(f'/merkle_proof/3/{position}').json()
+        assert verify_proof(Transaction.from_dict(answer['transaction']), answer['proof'],
+                            bytes.fromhex(answer['header']['merkle_root']))
+        assert answer['hash'] == blockchain.chain[2].hash.hex()
+    assert client.get('/merkle_proof/3/3').status_code == 404
+    assert client.get('/merkle_proof/4/0').status_code == 404
+    assert client.get('/merkle_proof/0/0').status_code == 404
+
+
+def test_dropped_transactions_endpoint(chain, monkeypatch):
+    from blockchain.mempool import Mempool
+
+    blockchain = chain(mempool=Mempool(capacity=1, eviction='oldest'))
+    blockchain.add_balance('alice', 10)
+    blockchain.mine_block()
+    for transaction_id in ('first', 'second', 'third'):
+        blockchain.add_transaction('alice', 'bob', 1, transaction_id)
+    monkeypatch.setattr(main, 'blockchain', blockchain)
+    client = TestClient(main.app)
+
+    answer = client.get('/dropped_transactions', params={'limit': 1}).json()
+    assert answer['total'] == 2
+    assert [(dropped['id'], dropped['reason']) for dropped in answer['dropped_transactions']] == [
+        ('second', "evicted, the mempool was full")]
+    assert client.get('/dropped_transactions', params={'limit': 0}).status_code == 400